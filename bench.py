@@ -0,0 +1,268 @@
+#!/bin/env python3
+
+# Fontimize benchmarks
+#
+# Not part of the library: these measure Fontimize itself, to check changes made for performance.
+# Run from the repository root, eg:
+#   python3 bench.py startup
+
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import median
+
+_ROOT: str = os.path.dirname(os.path.abspath(__file__))
+
+
+# Runs a command several times in fresh processes, returning the median wall-clock time in seconds
+def _time_command(args: list[str], runs: int) -> float:
+    times: list[float] = []
+    for _ in range(runs):
+        start: float = time.perf_counter()
+        subprocess.run(args, cwd=_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return median(times)
+
+
+# Parses -X importtime output into (module, cumulative microseconds), slowest first
+def _import_times(code: str) -> list[tuple[str, int]]:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=_ROOT,
+                            capture_output=True, text=True, check=True)
+    times: list[tuple[str, int]] = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)', line)
+        if match and not match.group(2): # Top-level imports only; nested ones are included in their parent
+            times.append((match.group(3), int(match.group(1))))
+    return sorted(times, key=lambda t: -t[1])
+
+
+# Cold start: importing fontimize, and command lines that don't subset anything
+def bench_startup(runs: int) -> None:
+    print(f"Startup (median of {runs} runs, each in a new process):")
+    baseline: float = _time_command([sys.executable, '-c', 'pass'], runs)
+    print(f"  Python interpreter alone:   {baseline * 1000:7.1f} ms")
+    for label, args in [("import fontimize", ['-c', 'import fontimize']),
+                        ("fontimize.py --help", ['fontimize.py', '--help']),
+                        ("fontimize.py (no input)", ['fontimize.py'])]:
+        print(f"  {label + ':':27} {_time_command([sys.executable] + args, runs) * 1000:7.1f} ms")
+
+    print("Slowest imports for 'import fontimize' (-X importtime, cumulative):")
+    for module, microseconds in _import_times('import fontimize')[:10]:
+        print(f"  {module:30} {microseconds / 1000:7.1f} ms")
+
+
+# Times _get_char_ranges and building the uranges string for count code points, in a new process so
+# FONTIMIZE_PRODUCTION takes effect at import. Every other code point is used, so that there are
+# many ranges (and so many charPair objects), as for a real site's characters.
+_HOT_PATH_CODE: str = """
+import timeit, fontimize
+chars = [chr(cp) for cp in range(0x4E00, 0x4E00 + 2 * {count}, 2)]
+def ranges(): fontimize._get_char_ranges(list(chars))
+def uranges(): ', '.join(r.get_range() for r in fontimize._get_char_ranges(list(chars)))
+ranges(), uranges() # Warm up, so beartype's one-off setup isn't timed
+print(min(timeit.repeat(ranges, number=1, repeat={repeat})), min(timeit.repeat(uranges, number=1, repeat={repeat})))
+"""
+
+def _time_hot_paths(count: int, repeat: int, production: bool) -> tuple[float, float]:
+    env: dict[str, str] = dict(os.environ, FONTIMIZE_PRODUCTION='1' if production else '0')
+    result = subprocess.run([sys.executable, '-c', _HOT_PATH_CODE.format(count=count, repeat=repeat)],
+                            cwd=_ROOT, env=env, capture_output=True, text=True, check=True)
+    ranges, uranges = result.stdout.split()
+    return (float(ranges), float(uranges))
+
+
+# Runtime type checking on the per-character helpers, with and without production mode
+def bench_hot_paths(count: int, repeat: int) -> None:
+    checked: tuple[float, float] = _time_hot_paths(count, repeat, production=False)
+    production: tuple[float, float] = _time_hot_paths(count, repeat, production=True)
+    print(f"Character ranges for {count} code points (best of {repeat}):")
+    print(f"  {'':22} {'checked':>10} {'production':>12} {'speedup':>8}")
+    for label, c, p in [("_get_char_ranges", checked[0], production[0]), ("uranges string", checked[1], production[1])]:
+        print(f"  {label:22} {c * 1000:8.1f} ms {p * 1000:10.1f} ms {c / p:7.1f}x")
+
+
+# Fonts in tests/ used by the synthetic sites. There's no bundled CJK font, so CJK text is extracted
+# and counted but has no glyphs to keep, as for a site whose CSS falls back to system fonts.
+_SITE_FONTS: list[str] = ['EBGaramond-VariableFont_wght.ttf', 'EBGaramond-Italic-VariableFont_wght.ttf',
+                          'NotoSans-VariableFont_wdth,wght.ttf', 'SortsMillGoudy-Regular.ttf',
+                          'SortsMillGoudy-Italic.ttf', 'Spirax-Regular.ttf', 'Whisper-Regular.ttf']
+
+# Letters for each script, and the pool of common characters CJK words are drawn from
+_SCRIPT_LETTERS: dict[str, str] = {
+    'latin': 'abcdefghijklmnopqrstuvwxyz' * 4 + 'ABCDEFGHIJKLMNOPQRSTUVWXYZéèàçüöñ',
+    'cyrillic': 'абвгдежзийклмнопрстуфхцчшщъыьэюя' * 4 + 'АБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЭЮЯ',
+    'cjk': ''.join(chr(cp) for cp in range(0x4E00, 0x4E00 + 3000)) + 'ぁあぃいぅうぇえぉおかがきぎくぐけげこご',
+}
+
+# Number of pages in each directory of a synthetic site
+_PAGES_PER_DIR: int = 1000
+
+
+def _parse_script_mix(value: str) -> dict[str, float]:
+    """Parse eg 'latin=0.7,cyrillic=0.2,cjk=0.1' into weights for each page's main script."""
+    mix: dict[str, float] = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in _SCRIPT_LETTERS:
+            raise ValueError(f"Unknown script '{name.strip()}', expected one of: {', '.join(_SCRIPT_LETTERS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _words(rng: random.Random, script: str, length: int) -> str:
+    """Roughly length characters of words in a script, with Latin punctuation and digits mixed in."""
+    letters: str = _SCRIPT_LETTERS[script]
+    parts: list[str] = []
+    total: int = 0
+    while total < length:
+        word: str = ''.join(rng.choices(letters, k=rng.randint(1, 4) if script == 'cjk' else rng.randint(2, 10)))
+        word += rng.choice(['', '', '', ',', '.', '!', '?', ';', ' ' + str(rng.randint(1, 2024))])
+        parts.append(word)
+        total += len(word) + 1
+    return ' '.join(parts)
+
+
+def generate_site(directory: str, pages: int, page_size: int = 2000, scripts: dict[str, float] | None = None,
+                  css_files: int = 4, font_faces: int = 6, pseudo_rules: int = 20, seed: int = 1) -> None:
+    """Write a synthetic site to directory: pages HTML pages of about page_size characters of text each,
+    in scripts chosen by weight, each linking one or two of css_files stylesheets. Each stylesheet has
+    font_faces @font-face rules, using the fonts in tests/ (copied into the site), and pseudo_rules
+    ::before rules with content. The same arguments always produce the same site."""
+    rng: random.Random = random.Random(seed)
+    mix: dict[str, float] = scripts or {'latin': 1.0}
+    script_names: list[str] = list(mix)
+    weights: list[float] = [mix[name] for name in script_names]
+
+    os.makedirs(os.path.join(directory, 'fonts'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'css'), exist_ok=True)
+    for font in _SITE_FONTS:
+        shutil.copy(os.path.join(_ROOT, 'tests', font), os.path.join(directory, 'fonts', font))
+
+    for index in range(css_files):
+        rules: list[str] = []
+        for face in range(font_faces):
+            font: str = _SITE_FONTS[(index + face) % len(_SITE_FONTS)]
+            rules.append(f"@font-face {{ font-family: 'Face{face}'; src: url('../fonts/{font}') format('truetype'); }}")
+        for rule in range(pseudo_rules):
+            content: str = _words(rng, rng.choices(script_names, weights)[0], 8).replace('"', '')
+            rules.append(f'.note{rule}::before {{ content: "{content}"; }}')
+        with open(os.path.join(directory, 'css', f'style{index}.css'), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(rules) + '\n')
+
+    for page in range(pages):
+        page_dir: str = os.path.join(directory, 'pages', str(page // _PAGES_PER_DIR))
+        if page % _PAGES_PER_DIR == 0:
+            os.makedirs(page_dir, exist_ok=True)
+        script: str = rng.choices(script_names, weights)[0]
+        links: str = ''.join(f'<link rel="stylesheet" href="../../css/style{css}.css">'
+                             for css in sorted(set(rng.choices(range(css_files), k=rng.randint(1, 2)))))
+        paragraphs: str = ''.join(f'<p>{_words(rng, script, 200)}</p>' for _ in range(max(1, page_size // 200)))
+        with open(os.path.join(page_dir, f'page{page}.html'), 'w', encoding='utf-8') as file:
+            file.write(f'<html><head><title>Page {page}</title>{links}</head><body>{paragraphs}</body></html>')
+
+
+# Runs optimise_fonts_for_files on a site in a new process, so its peak memory can be measured on its own.
+# Phases are timed with fontimize's profiler, without cProfile or tracemalloc, which would slow it down.
+_SCALING_CODE: str = """
+import json, resource, sys, time, fontimize
+profiler = fontimize._Profiler(memory=False)
+fontimize._active_profiler.set(profiler)
+start = time.perf_counter()
+res = fontimize.optimise_fonts_for_files(fontimize.discover_files([sys.argv[1]]), font_output_dir=sys.argv[2],
+                                         print_stats=False, workers=int(sys.argv[3]))
+seconds = time.perf_counter() - start
+kilobytes = 1 if sys.platform != 'darwin' else 1024 # ru_maxrss is in KB on Linux, bytes on macOS
+peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+print(json.dumps({"seconds": seconds, "peak_rss": peak_rss * 1024 // kilobytes, "chars": len(res["chars"]),
+                  "fonts": len(res["fonts"]), "phases": {name: phase["seconds"] for name, phase in profiler.phases.items()}}))
+"""
+
+def _version() -> str:
+    """The package version and git commit being benchmarked, to compare results between versions."""
+    with open(os.path.join(_ROOT, 'pyproject.toml'), 'r') as file:
+        match = re.search(r'^version\s*=\s*"([^"]+)"', file.read(), re.MULTILINE)
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_ROOT, capture_output=True, text=True, check=False)
+    return f"{match.group(1) if match else '?'}+{commit.stdout.strip() or 'unknown'}"
+
+
+# End-to-end runs of optimise_fonts_for_files on synthetic sites of increasing size, to catch
+# behaviour that scales worse than linearly with the number of pages
+def bench_scaling(sizes: list[int], page_size: int, scripts: dict[str, float], css_files: int, font_faces: int,
+                  pseudo_rules: int, workers: int, seed: int, results_file: str) -> None:
+    settings: dict[str, object] = {"page_size": page_size, "scripts": scripts, "css_files": css_files,
+                                   "font_faces": font_faces, "pseudo_rules": pseudo_rules, "workers": workers, "seed": seed}
+    previous: dict[str, dict[str, float]] = {}
+    if results_file and os.path.exists(results_file):
+        with open(results_file, 'r') as file:
+            for line in file:
+                record = json.loads(line)
+                if record["settings"] == settings:
+                    previous[str(record["pages"])] = record # The most recent run of each size with these settings
+
+    print(f"Scaling ({page_size} characters per page, scripts {scripts}, {css_files} CSS files, "
+          f"{font_faces} @font-face and {pseudo_rules} pseudo-element rules each):")
+    print(f"  {'pages':>7} {'seconds':>9} {'pages/s':>9} {'peak RSS':>10}  phases")
+    for pages in sizes:
+        with tempfile.TemporaryDirectory(prefix='fontimize-bench-') as directory:
+            site: str = os.path.join(directory, 'site')
+            output: str = os.path.join(directory, 'output')
+            os.makedirs(output)
+            generate_site(site, pages, page_size, scripts, css_files, font_faces, pseudo_rules, seed)
+            result = subprocess.run([sys.executable, '-c', _SCALING_CODE, os.path.join(site, 'pages'), output, str(workers)],
+                                    cwd=_ROOT, capture_output=True, text=True, check=True)
+        measured: dict[str, object] = json.loads(result.stdout.splitlines()[-1])
+        record: dict[str, object] = {"version": _version(), "time": time.strftime('%Y-%m-%dT%H:%M:%S'), "pages": pages,
+                                     "settings": settings, **measured}
+
+        phases: dict[str, float] = measured["phases"] # type: ignore
+        subsetting: float = sum(t for name, t in phases.items() if name.startswith('subset'))
+        summary: str = f"extraction {phases.get('extraction', 0):.2f}s, css {phases.get('css', 0):.2f}s, " \
+                       f"subsetting {subsetting:.2f}s, rewrite {phases.get('rewrite', 0):.2f}s"
+        seconds: float = measured["seconds"] # type: ignore
+        peak_rss: int = measured["peak_rss"] # type: ignore
+        print(f"  {pages:7} {seconds:9.2f} {pages / seconds:9.0f} {peak_rss / 1024 ** 2:8.0f} MB  {summary}")
+        if str(pages) in previous:
+            before = previous[str(pages)]
+            print(f"  {'':7} was {before['seconds']:.2f}s and {before['peak_rss'] / 1024 ** 2:.0f} MB in {before['version']}")
+
+        if results_file:
+            with open(results_file, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks for Fontimize")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    startup = subparsers.add_parser('startup', help='Time to import fontimize and run trivial command lines')
+    startup.add_argument('--runs', type=int, default=10, help='Number of runs of each command (default 10)')
+    hot_paths = subparsers.add_parser('hotpaths', help='Cost of runtime type checks on per-character helpers, with and without FONTIMIZE_PRODUCTION')
+    hot_paths.add_argument('--count', type=int, default=20000, help='Number of code points (default 20000)')
+    hot_paths.add_argument('--repeat', type=int, default=5, help='Number of timings to take the best of (default 5)')
+    scaling = subparsers.add_parser('scaling', help='End-to-end runs on generated sites of increasing size')
+    scaling.add_argument('--pages', type=int, nargs='+', default=[10, 1000, 10000, 100000], help='Site sizes to run, in pages (default 10 1000 10000 100000)')
+    scaling.add_argument('--page-size', type=int, default=2000, dest='page_size', help='Characters of text per page (default 2000)')
+    scaling.add_argument('--scripts', type=_parse_script_mix, default='latin=0.7,cyrillic=0.2,cjk=0.1',
+                         help='Weights of each script for the pages (default latin=0.7,cyrillic=0.2,cjk=0.1)')
+    scaling.add_argument('--css-files', type=int, default=4, dest='css_files', help='Number of CSS files (default 4)')
+    scaling.add_argument('--font-faces', type=int, default=6, dest='font_faces', help='@font-face rules in each CSS file (default 6)')
+    scaling.add_argument('--pseudo-rules', type=int, default=20, dest='pseudo_rules', help='::before rules with content in each CSS file (default 20)')
+    scaling.add_argument('--workers', type=int, default=1, help='Fonts subset at once (default 1)')
+    scaling.add_argument('--seed', type=int, default=1, help='Random seed for the generated sites (default 1)')
+    scaling.add_argument('--results', default='bench_results.jsonl', help="File each run's results are appended to, and compared with (default bench_results.jsonl; '' to not store them)")
+    args = parser.parse_args()
+
+    if args.benchmark == 'startup':
+        bench_startup(args.runs)
+    elif args.benchmark == 'hotpaths':
+        bench_hot_paths(args.count, args.repeat)
+    elif args.benchmark == 'scaling':
+        bench_scaling(args.pages, args.page_size, args.scripts, args.css_files, args.font_faces, args.pseudo_rules,
+                      args.workers, args.seed, args.results)
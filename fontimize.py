@@ -21,21 +21,119 @@ import re
 import sys
 import logging
 import warnings
-from bs4 import BeautifulSoup
-from fontTools.ttLib import TTFont
-from fontTools.subset import Subsetter
+import unicodedata
+import fnmatch
+import contextlib
+import contextvars
+import functools
+import glob
+import json
+import hashlib
+import threading
+import io
+import time
+import types
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from urllib.parse import urljoin, urlsplit, unquote
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import path
-import cssutils
 import pathlib
-from pathvalidate import ValidationError, validate_filename
-from typing import TypedDict
-from collections.abc import Callable, Collection
-from beartype import beartype
-
-cssutils.log.setLevel(logging.CRITICAL)
+from typing import TYPE_CHECKING, Any, Literal, TypedDict, TypeVar
+from collections.abc import Callable, Collection, Iterable, Iterator, Mapping
+
+# BeautifulSoup, fontTools, cssutils, pathvalidate, http.client and beartype are slow to import, so
+# they are imported where they're used rather than here. Importing fontimize, and running the command
+# line for --help or an argument error, then doesn't pay for them. Signatures that use their types
+# name them in full as strings, eg 'fontTools.ttLib.TTFont', which beartype resolves on first call.
+if TYPE_CHECKING: # Only for type checkers, so they can resolve those names
+    import http.client
+    import http.server
+    import bs4
+    import cssutils
+    import fontTools.ttLib
+    from fontTools.ttLib import TTFont
+
+_T = TypeVar('_T')
+
+def _lazy_beartype_function(func: Callable[..., Any]) -> Callable[..., Any]:
+    checked: Callable[..., Any] | None = None
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        nonlocal checked
+        if checked is None:
+            from beartype import beartype as beartype_decorator
+            checked = beartype_decorator(func)
+        return checked(*args, **kwargs)
+    return wrapper
+
+# Type-checks calls to a function or class's methods with beartype. The checks are only generated
+# (and beartype imported) when each function is first called, rather than when fontimize is imported.
+def beartype(obj: _T) -> _T:
+    if isinstance(obj, type):
+        for name, attr in list(vars(obj).items()):
+            if isinstance(attr, staticmethod):
+                setattr(obj, name, staticmethod(_lazy_beartype_function(attr.__func__)))
+            elif isinstance(attr, types.FunctionType):
+                setattr(obj, name, _lazy_beartype_function(attr))
+        return obj
+    return _lazy_beartype_function(obj) # type: ignore
+
+# Production mode: set the environment variable FONTIMIZE_PRODUCTION=1 before importing fontimize to
+# skip runtime type checks on small internal functions called once per character or range, where
+# checking costs more than the work. Public functions are still checked. Tests run without it.
+_PRODUCTION_MODE: bool = os.environ.get('FONTIMIZE_PRODUCTION', '').lower() in ('1', 'true', 'yes')
+
+# Like beartype, but skipped in production mode; for hot paths only
+def _hot_path_beartype(obj: _T) -> _T:
+    return obj if _PRODUCTION_MODE else beartype(obj)
+
+# Progress and stats output (with verbose or print_stats) is logged here rather than printed, so callers
+# running several calls at once can tell it apart; the command line sends it to stdout
+_logger: logging.Logger = logging.getLogger('fontimize')
+_logger.addHandler(logging.NullHandler())
+
+@functools.cache
+def _cssutils() -> types.ModuleType:
+    """Import cssutils on first use, silencing its log messages about CSS it doesn't understand."""
+    import cssutils
+    cssutils.log.setLevel(logging.CRITICAL)
+    return cssutils
+
+# cssutils keeps its parser's state in the module, so parsing in several threads at once corrupts it.
+# Functions using cssutils hold this while they do; it's reentrant since they call each other
+_cssutils_lock: threading.RLock = threading.RLock()
+
+def _holds_cssutils_lock(func: _T) -> _T:
+    @functools.wraps(func) # type: ignore
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with _cssutils_lock:
+            return func(*args, **kwargs) # type: ignore
+    return wrapper # type: ignore
 
 _SUPPORTED_FONT_EXTENSIONS: set[str] = {'.ttf', '.otf', '.woff', '.woff2'}
 
+# Which files discover_files() picks up from directories when no include patterns are given
+_DEFAULT_INCLUDE_PATTERNS: tuple[str, ...] = ('*.html', '*.htm')
+
+# Values accepted by the CSS font-display descriptor
+FontDisplay = Literal['auto', 'block', 'swap', 'fallback', 'optional']
+
+# Callback receiving progress events: dicts with an "event" key naming the event, plus its details
+ProgressCallback = Callable[[dict[str, Any]], None]
+
+
+class FontFileBreakdown(TypedDict):
+    """What a subset font contains, to show why it's the size it is."""
+    glyphs_before: int # In the original font
+    glyphs_after: int
+    cmap_glyphs: int # Mapped directly from the characters used
+    layout_glyphs: int # Added by the closure over GSUB, eg ligatures and alternates
+    other_glyphs: int # Eg .notdef, components of composite glyphs, and COLR layers
+    table_sizes: dict[str, int] # Uncompressed size in bytes of each table in the subset
+    pruned_kerning: int # Kerning pair records removed by layout pruning, as the text never uses them
+    pruned_ligatures: int # Ligatures removed by layout pruning
 
 class FontFileStats(TypedDict):
     """Size statistics for a single font file."""
@@ -43,6 +141,9 @@ class FontFileStats(TypedDict):
     generated: str
     original_size: int
     generated_size: int
+    quantized_glyphs: int
+    uncovered_chars: int
+    breakdown: FontFileBreakdown
 
 class FontimizeStats(TypedDict):
     """Aggregate statistics about the font subsetting operation."""
@@ -52,27 +153,255 @@ class FontimizeStats(TypedDict):
     total_generated_size: int
     savings_bytes: int
     savings_percent: float
+    quantized_chars: int
+    quantized_glyphs: int
 
 @beartype
 def _empty_stats() -> FontimizeStats:
     """Return a FontimizeStats with all fields zeroed out."""
     return {"fonts_processed": 0, "files": [], "total_original_size": 0,
-            "total_generated_size": 0, "savings_bytes": 0, "savings_percent": 0.0}
+            "total_generated_size": 0, "savings_bytes": 0, "savings_percent": 0.0,
+            "quantized_chars": 0, "quantized_glyphs": 0}
+
+class FontimizeCluster(TypedDict):
+    """One group of pages with similar characters, which share their own set of subset fonts."""
+    name: str
+    pages: list[str]
+    chars: set[str]
+    uranges: str
+    fonts: dict[str, str]
+    rewritten_css: dict[str, str]
+    stats: FontimizeStats
+
+class FontimizePlanEntry(TypedDict):
+    """Whether an existing subset font matches what would be generated now, found in check mode."""
+    font: str
+    status: Literal['current', 'stale', 'missing']
+    added: list[str]
+    removed: list[str]
+
+class FontimizePhaseProfile(TypedDict):
+    """Time and memory used by one phase of a profiled run."""
+    seconds: float
+    peak_memory: int
+    top_allocations: list[str]
 
 class FontimizeResult(TypedDict):
     """Result dictionary returned by all optimise_fonts* functions."""
     css: set[str]
-    fonts: dict[str, str]
+    fonts: dict[str, str] # Empty when clustering: each font has one subset per cluster, in clusters
     chars: set[str]
     uranges: str
-    rewritten_css: dict[str, str]
+    rewritten_css: dict[str, str] # Likewise empty when clustering
+    preloads: dict[str, list[str]]
     stats: FontimizeStats
+    clusters: list[FontimizeCluster]
+    font_data: dict[str, bytes]
+    plan: dict[str, FontimizePlanEntry]
+    profile: dict[str, FontimizePhaseProfile]
+    uncovered: dict[str, set[str]]
+    warnings: list[str]
+
+@beartype
+def _empty_result(css: set[str] | None = None) -> FontimizeResult:
+    """Return a FontimizeResult with nothing generated, used when there is no work to do."""
+    return {
+        "css": css if css is not None else set(),
+        "fonts": {},
+        "chars": set(),
+        "uranges": "",
+        "rewritten_css": {},
+        "preloads": {},
+        "stats": _empty_stats(),
+        "clusters": [],
+        "font_data": {},
+        "plan": {},
+        "profile": {},
+        "uncovered": {},
+        "warnings": [],
+    }
 
 @beartype
+def _emit(progress: ProgressCallback | None, event: str, **details: Any) -> None:
+    """Send a progress event to the callback, if there is one."""
+    if progress is not None:
+        progress({"event": event, **details})
+
+class _Profiler:
+    """Records the time, and optionally the memory, used by each phase of a profiled run."""
+
+    def __init__(self, memory: bool) -> None:
+        self.memory: bool = memory
+        self.phases: dict[str, FontimizePhaseProfile] = {}
+
+# The profiler for the call being profiled in this thread, if any, so the functions it calls can mark
+# their phases without it being passed down to each of them
+_active_profiler: contextvars.ContextVar[_Profiler | None] = contextvars.ContextVar('fontimize_profiler', default=None)
+
+# Number of allocation sites reported for each phase with profile_memory
+_TOP_ALLOCATIONS: int = 10
+
+@contextlib.contextmanager
+def _profile_phase(name: str) -> Iterator[None]:
+    """Record the time and memory used by the code inside as the phase name, if a profiled call is running.
+    A phase that runs several times, eg once per cluster, adds up its times and keeps its highest peak."""
+    profiler: _Profiler | None = _active_profiler.get()
+    if profiler is None:
+        yield
+        return
+
+    import tracemalloc
+    if profiler.memory:
+        start_snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_memory: int = tracemalloc.get_traced_memory()[0]
+    start_time: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase: FontimizePhaseProfile = profiler.phases.setdefault(name, {"seconds": 0.0, "peak_memory": 0, "top_allocations": []})
+        phase["seconds"] = round(phase["seconds"] + time.perf_counter() - start_time, 6)
+        if profiler.memory:
+            peak: int = tracemalloc.get_traced_memory()[1] - start_memory
+            if peak >= phase["peak_memory"]:
+                # The sites holding the most memory allocated during the phase, by file and line
+                own: list[tracemalloc.Filter] = [tracemalloc.Filter(False, tracemalloc.__file__)] # tracemalloc's own snapshots
+                stats: list[tracemalloc.StatisticDiff] = tracemalloc.take_snapshot().filter_traces(own).compare_to(
+                    start_snapshot.filter_traces(own), 'lineno')
+                phase["peak_memory"] = peak
+                phase["top_allocations"] = [str(stat) for stat in stats[:_TOP_ALLOCATIONS] if stat.size_diff > 0]
+
+class _Tracer:
+    """Collects spans in Chrome trace event format, for viewing in Perfetto or chrome://tracing."""
+
+    def __init__(self) -> None:
+        self.events: list[dict[str, Any]] = []
+        self._lock: threading.Lock = threading.Lock()
+
+    def add(self, events: list[dict[str, Any]]) -> None:
+        with self._lock:
+            self.events.extend(events)
+
+    def save(self, trace_file: str) -> None:
+        # Name each process, so worker processes' spans are labelled as such
+        names: list[dict[str, Any]] = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                                        "args": {"name": "fontimize" if pid == os.getpid() else "fontimize worker"}}
+                                       for pid in sorted({event["pid"] for event in self.events})]
+        with open(trace_file, 'w') as file:
+            json.dump({"traceEvents": names + self.events, "displayTimeUnit": "ms"}, file)
+
+# The tracer for the call being traced in this thread, if any, in the same way as _active_profiler
+_active_tracer: contextvars.ContextVar[_Tracer | None] = contextvars.ContextVar('fontimize_tracer', default=None)
+
+@contextlib.contextmanager
+def _trace_span(name: str, category: str, **details: Any) -> Iterator[None]:
+    """Record the code inside as a span in the trace, if a traced call is running. Otherwise this only
+    costs a context variable lookup, so spans can mark fine-grained work such as each file read."""
+    tracer: _Tracer | None = _active_tracer.get()
+    if tracer is None:
+        yield
+        return
+    start: int = time.perf_counter_ns() # Monotonic across processes, so worker spans line up with this one's
+    try:
+        yield
+    finally:
+        tracer.add([{"name": name, "cat": category, "ph": "X", "ts": start / 1000, "dur": (time.perf_counter_ns() - start) / 1000,
+                     "pid": os.getpid(), "tid": threading.get_native_id(), "args": details}])
+
+# The warnings raised so far by the call running in this thread, if any, in the same way as _active_tracer,
+# so each call's result holds its own warnings even when several calls run at once
+_active_warnings: contextvars.ContextVar[list[str] | None] = contextvars.ContextVar('fontimize_warnings', default=None)
+
+def _warn(message: str) -> None:
+    """Issue a warning, and record it in the result of the call that raised it."""
+    collected: list[str] | None = _active_warnings.get()
+    if collected is not None:
+        collected.append(message)
+    warnings.warn(message, stacklevel=2)
+
+@contextlib.contextmanager
+def _collecting_warnings() -> Iterator[list[str]]:
+    """Collect the warnings raised by the code inside. Inside another call collecting them, such as
+    optimise_fonts called by optimise_fonts_for_files, they're added to that call's list."""
+    collected: list[str] | None = _active_warnings.get()
+    if collected is not None:
+        yield collected
+        return
+    collected = []
+    token: contextvars.Token[list[str] | None] = _active_warnings.set(collected)
+    try:
+        yield collected
+    finally:
+        _active_warnings.reset(token)
+
+# Wraps a public function returning a FontimizeResult, adding the warnings raised during the call to it
+def _reports_warnings(func: Callable[..., FontimizeResult]) -> Callable[..., FontimizeResult]:
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> FontimizeResult:
+        with _collecting_warnings() as collected:
+            res: FontimizeResult = func(*args, **kwargs)
+        res["warnings"] = list(collected)
+        return res
+    return wrapper
+
+# Wraps a public function taking profile_cpu, profile_memory and trace arguments: while it runs, phases
+# are recorded and the whole call is profiled with cProfile if asked, and the phases are added to its
+# result; and with trace, spans are recorded and written to that file in Chrome trace event format
+def _profiled(func: Callable[..., FontimizeResult]) -> Callable[..., FontimizeResult]:
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> FontimizeResult:
+        profile_cpu: str = kwargs.get('profile_cpu', "")
+        profile_memory: bool = kwargs.get('profile_memory', False)
+        trace: str = kwargs.get('trace', "")
+        if not (profile_cpu or profile_memory or trace) or _active_profiler.get() is not None or _active_tracer.get() is not None:
+            return func(*args, **kwargs)
+
+        import tracemalloc
+        profiler: _Profiler | None = _Profiler(profile_memory) if profile_cpu or profile_memory else None
+        tracer: _Tracer | None = _Tracer() if trace else None
+        profiler_token: contextvars.Token[_Profiler | None] = _active_profiler.set(profiler)
+        tracer_token: contextvars.Token[_Tracer | None] = _active_tracer.set(tracer)
+        started_tracing: bool = profile_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if profile_cpu:
+            import cProfile
+            cpu_profile: cProfile.Profile = cProfile.Profile()
+            cpu_profile.enable()
+        try:
+            with _trace_span(func.__name__, "call"):
+                res: FontimizeResult = func(*args, **kwargs)
+        finally:
+            if profile_cpu:
+                cpu_profile.disable()
+                cpu_profile.dump_stats(profile_cpu)
+            if started_tracing:
+                tracemalloc.stop()
+            _active_profiler.reset(profiler_token)
+            _active_tracer.reset(tracer_token)
+            if tracer is not None:
+                tracer.save(trace)
+        if profiler is not None:
+            res["profile"] = profiler.phases
+        return res
+    return wrapper
+
+@beartype
+def _print_profile(profile: dict[str, FontimizePhaseProfile]) -> None:
+    print("Profile:")
+    for name, phase in profile.items():
+        line: str = f"  {name}: {phase['seconds']:.3f}s"
+        if phase["peak_memory"]:
+            line += f", peak memory {_file_size_to_readable(phase['peak_memory'])}"
+        print(line)
+        for allocation in phase["top_allocations"]:
+            print("    " + allocation)
+
+@_hot_path_beartype
 def _get_unicode_string(char : str, withU : bool = True) -> str:
     return ('U+' if withU else '') + hex(ord(char))[2:].upper().zfill(4) # eg U+1234
 
-@beartype
+@_hot_path_beartype
 def get_used_characters_in_str(s : str) -> set[str]:
     res: set[str] = { " " } # Always contain space, otherwise no font file generated by TTF2Web 
     for c in s:
@@ -91,13 +420,54 @@ def get_used_characters_in_str(s : str) -> set[str]:
 
     return res
 
+# Elements whose contents the page's fonts never draw: scripts, styles and templates (which get_text already
+# leaves out), noscript fallbacks, the document title (shown by the browser itself), and the fallback
+# content of embedded frames and media
+_NON_RENDERED_ELEMENTS: frozenset[str] = frozenset({'script', 'style', 'template', 'noscript', 'title', 'iframe',
+                                                    'noembed', 'noframes', 'object', 'video', 'audio', 'canvas'})
+# Attributes whose values readers see, eg as alternative text, tooltips and placeholders, or hear from screen readers
+_TEXT_ATTRIBUTES: tuple[str, ...] = ('alt', 'title', 'placeholder', 'aria-label')
+
 @beartype
-def get_used_characters_in_html(html : str) -> set[str]:
+def _html_text(soup: 'bs4.BeautifulSoup', rendered_only: bool = False, text_attributes: bool | Collection[str] = False) -> str:
+    """Return the text in parsed HTML, as get_text does. With rendered_only, the contents of elements that
+    aren't rendered are left out, and the labels of input buttons are added. text_attributes adds the values
+    of these attributes, or with True, of _TEXT_ATTRIBUTES. The soup isn't changed."""
+    if not rendered_only and text_attributes is False:
+        return soup.get_text()
+    from bs4 import CData, NavigableString, Tag
+    attributes: Collection[str] = _TEXT_ATTRIBUTES if text_attributes is True else \
+                                  () if text_attributes is False else text_attributes
+    parts: list[str] = []
+    stack: list['bs4.PageElement'] = [soup] # Walked in document order, without recursion, since pages can be deeply nested
+    while stack:
+        node: 'bs4.PageElement' = stack.pop()
+        if isinstance(node, NavigableString):
+            if type(node) in (NavigableString, CData): # Not comments, doctypes, or script and style contents
+                parts.append(str(node))
+            continue
+        if not isinstance(node, Tag):
+            continue
+        if rendered_only:
+            if node.name in _NON_RENDERED_ELEMENTS:
+                continue
+            if node.name == 'input' and str(node.get('type', '')).lower() in ('submit', 'button', 'reset'):
+                parts.append(str(node.get('value', '')))
+        for attribute in attributes:
+            value: str | list[str] | None = node.get(attribute)
+            if value:
+                parts.append(" ".join(value) if isinstance(value, list) else str(value))
+        stack.extend(reversed(node.contents))
+    return "".join(parts)
+
+@beartype
+def get_used_characters_in_html(html : str, rendered_only : bool = False, text_attributes : bool | Collection[str] = False) -> set[str]:
+    from bs4 import BeautifulSoup
     soup: BeautifulSoup = BeautifulSoup(html, 'html.parser')
-    text: str = soup.get_text()
+    text: str = _html_text(soup, rendered_only, text_attributes)
     return get_used_characters_in_str(text)
 
-@beartype
+@_hot_path_beartype
 class charPair:
     def __init__(self, first : str, second : str) -> None:
         self.first: str = first
@@ -124,7 +494,7 @@ class charPair:
 
 # Taking a sorted list of characters, find the sequential subsets and return pairs of the start and end
 # of each sequential subset
-@beartype
+@_hot_path_beartype
 def _get_char_ranges(chars : list[str]) -> list[charPair]:
     chars.sort()
     if not chars:
@@ -152,86 +522,585 @@ def _get_char_ranges(chars : list[str]) -> list[charPair]:
 def _file_size_to_readable(size : int) -> str:
     return str(round(size / 1024)) + "KB" if size < 1024 * 1024 else str(round(size / (1024 * 1024), 1)) + "MB" # nKB or n.nMB
 
-# Takes the input text, and the fonts, and generates new font files
-# Other methods (eg taking HTML files, or multiple pieces of text) all end up here
 @beartype
-def optimise_fonts(text : str, fonts : Collection[str] | str, fontpath : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True) -> FontimizeResult:
-    unique_fonts: set[str] = {fonts} if isinstance(fonts, str) else set(fonts)  # Deduplicate; accept single string
+class FontimizeCache:
+    """Keeps recently used font files in memory, so subsetting the same font repeatedly doesn't re-read it.
+
+    fontTools' subsetter modifies the font it is given, so every subset needs its own TTFont.
+    Rather than keeping parsed TTFonts and deep-copying them (which is two to three times
+    slower than parsing), the cache holds each font's bytes and opens a fresh, lazily-loaded
+    TTFont over them: only the tables the subsetter touches are decompiled. Entries are keyed
+    on the file's path, size and modification time, so a font that changes on disk is re-read.
+    At most max_fonts fonts are kept, least recently used first out. Safe to share between threads.
+
+    Stylesheets are cached too: parsing CSS for its @font-face URLs and pseudo-element text is
+    slow, and when many sites share the same stylesheets it only needs doing once.
+    """
 
-    res: FontimizeResult = {
-        "css": set(),  # at this level there are no CSS files, include to prevent errors for API consumer
-        "fonts": {},
-        "chars": set(),
-        "uranges": "",
-        "rewritten_css": {},
-        "stats": _empty_stats(),
-    }
+    def __init__(self, max_fonts: int = 16, max_stylesheets: int = 64) -> None:
+        self.max_fonts: int = max(1, max_fonts)
+        self.max_stylesheets: int = max(1, max_stylesheets)
+        self.hits: int = 0
+        self.misses: int = 0
+        self._fonts: OrderedDict[tuple[str, int, int], bytes] = OrderedDict()
+        self._stylesheets: OrderedDict[tuple[str, int, int], tuple[str, list[str], frozenset[str]]] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    @staticmethod
+    def _key(file: str) -> tuple[str, int, int]:
+        st: os.stat_result = os.stat(file)
+        return (path.abspath(file), st.st_size, st.st_mtime_ns)
+
+    def stylesheet(self, css_file: str) -> tuple[str, list[str], frozenset[str]]:
+        """Return the pseudo-element text, @font-face URLs and OpenType features of a CSS file, parsing it only once."""
+        key: tuple[str, int, int] = self._key(css_file)
+        with self._lock:
+            parsed: tuple[str, list[str], frozenset[str]] | None = self._stylesheets.get(key)
+            if parsed is not None:
+                self._stylesheets.move_to_end(key)
+                return parsed
+        with open(css_file, 'r') as file:
+            parsed = _parse_stylesheet(file.read())
+        with self._lock:
+            self._stylesheets[key] = parsed
+            while len(self._stylesheets) > self.max_stylesheets:
+                self._stylesheets.popitem(last=False)
+        return parsed
+
+    def font_data(self, font: str) -> bytes:
+        """Return the contents of a font file, from memory if it's cached."""
+        key: tuple[str, int, int] = self._key(font)
+        with self._lock:
+            data: bytes | None = self._fonts.get(key)
+            if data is not None:
+                self._fonts.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        with open(font, 'rb') as file:
+            data = file.read()
+        with self._lock:
+            self._fonts[key] = data
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return data
+
+    def open_font(self, font: str) -> 'fontTools.ttLib.TTFont':
+        """Return a new TTFont for the font file, which the caller is free to modify."""
+        from fontTools.ttLib import TTFont
+        return TTFont(io.BytesIO(self.font_data(font)))
+
+# Version of the coverage index file format written by FontimizeCoverageIndex.save
+_COVERAGE_INDEX_VERSION: int = 1
 
-    characters: set[str] = get_used_characters_in_str(text)
+@beartype
+def _read_codepoints(font: str) -> frozenset[int]:
+    """Return the code points font has glyphs for, reading only its cmap table."""
+    from fontTools.ttLib import TTFont
+    tt_font: TTFont = TTFont(font, lazy=True)
+    codepoints: frozenset[int] = frozenset(tt_font.getBestCmap() or {}) # None if it has no Unicode cmap
+    tt_font.close()
+    return codepoints
 
-    char_list: list[str] = list(characters)
-    if verbose:
-        print("Characters:")
-        print("  " + str(char_list))
-    res["chars"] = characters # set of characters used in the input text
+@beartype
+def _covered_characters(characters: Collection[str], codepoints: frozenset[int]) -> set[str]:
+    """Return the characters a font with these code points has glyphs for, and the ones that don't need a glyph."""
+    return {c for c in characters if ord(c) in codepoints or not _needs_glyph(c)}
 
-    char_ranges: list[charPair] = _get_char_ranges(char_list)
-    if verbose:
-        print("Character ranges:")
-        print("  " + str(char_ranges))
+@beartype
+class FontimizeCoverageIndex:
+    """Records the characters each font has glyphs for, so they're only read from the font once.
+
+    A font's coverage is the code points in its cmap table, which is all that's read: the rest of
+    the font isn't parsed. Entries are keyed on the font's path and checked against its size and
+    modification time. If index_file is given, the index is loaded from it, and save() writes it
+    back, so it's reused across runs; each entry then also holds a hash of the font's contents, so a
+    font that's copied or touched without changing is recognised without reading its cmap again.
+    Safe to share between threads.
+    """
 
-    uranges_str: str = ', '.join(r.get_range() for r in char_ranges)
-    if verbose:
-        print("Unicode ranges:")
-        print("  " + uranges_str)
-    res["uranges"] = uranges_str # unicode ranges matching the characters used in the input text
+    def __init__(self, index_file: str = "") -> None:
+        self.index_file: str = index_file
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: dict[str, dict[str, Any]] = {}
+        self._by_hash: dict[str, frozenset[int]] = {}
+        self._codepoints: dict[str, frozenset[int]] = {}
+        self._dirty: bool = False
+        self._lock: threading.Lock = threading.Lock()
+        if index_file and path.isfile(index_file):
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_file, 'r') as file:
+                data: Any = json.load(file)
+            if not isinstance(data, dict) or data.get("version") != _COVERAGE_INDEX_VERSION:
+                raise ValueError("unknown format")
+            for font, entry in data["fonts"].items():
+                codepoints: frozenset[int] = frozenset(cp for first, last in entry["ranges"] for cp in range(first, last + 1))
+                self._entries[font] = {"size": entry["size"], "mtime_ns": entry["mtime_ns"], "sha256": entry["sha256"]}
+                self._codepoints[font] = codepoints
+                self._by_hash[entry["sha256"]] = codepoints
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            _warn(f"Ignoring unreadable coverage index {self.index_file}: {e}")
+            self._entries.clear()
+            self._codepoints.clear()
+            self._by_hash.clear()
+
+    def codepoints(self, font: str) -> frozenset[int]:
+        """Return the code points font has glyphs for, reading its cmap only if it isn't indexed yet."""
+        key: str = path.abspath(font)
+        st: os.stat_result = os.stat(font)
+        with self._lock:
+            entry: dict[str, Any] | None = self._entries.get(key)
+            if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                self.hits += 1
+                return self._codepoints[key]
+
+        digest: str = ""
+        codepoints: frozenset[int] | None = None
+        if self.index_file: # Only needed to recognise the font in a later run
+            with open(font, 'rb') as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+            with self._lock:
+                codepoints = self._by_hash.get(digest)
+        if codepoints is None:
+            codepoints = _read_codepoints(font)
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+            self._codepoints[key] = codepoints
+            if digest:
+                self._by_hash[digest] = codepoints
+            self._dirty = True
+        return codepoints
+
+    def missing(self, font: str, characters: Collection[str]) -> set[str]:
+        """Return the characters font has no glyphs for, which browsers will draw with a fallback font."""
+        codepoints: frozenset[int] = self.codepoints(font)
+        return {c for c in characters if ord(c) not in codepoints and _needs_glyph(c)}
+
+    def save(self) -> None:
+        """Write the index to its index_file, if it has one and anything has been added since it was read."""
+        if not self.index_file:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            fonts: dict[str, dict[str, Any]] = {}
+            for font, entry in self._entries.items():
+                ranges: list[list[int]] = []
+                for cp in sorted(self._codepoints[font]):
+                    if ranges and ranges[-1][1] == cp - 1:
+                        ranges[-1][1] = cp
+                    else:
+                        ranges.append([cp, cp])
+                fonts[font] = {**entry, "ranges": ranges}
+            self._dirty = False
+        os.makedirs(path.dirname(self.index_file) or ".", exist_ok=True)
+        temp_path: str = self.index_file + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({"version": _COVERAGE_INDEX_VERSION, "fonts": fonts}, file)
+        os.replace(temp_path, self.index_file)
 
-    # For each font, generate a subset WOFF2 containing only the used characters.
-    # By default, place it in the same folder as the respective font, unless fontpath is specified.
-    # fontTools' subsetter preserves ligatures, contextual alternates, kerning and other
-    # OpenType layout features by default (layout_closure=True), so the subset font
-    # will still render correctly for the included characters.
-    for font in unique_fonts:
-        font_ext: str = pathlib.Path(font).suffix.lower()
-        if font_ext not in _SUPPORTED_FONT_EXTENSIONS:
-            warnings.warn(f"Unrecognised font format '{font_ext}' for {font}, "
-                          f"supported formats: {', '.join(sorted(_SUPPORTED_FONT_EXTENSIONS))}")
+@beartype
+def _text_pairs(text: str) -> set[str]:
+    """Return the pairs of adjacent characters in text, which are the only places kerning and ligatures can
+    apply. Pairs are also taken with combining marks skipped, since lookups usually ignore marks, and
+    in upper, lower and title case, for text the CSS transforms."""
+    runs: list[str] = [text]
+    bases: str = ''.join(c for c in text if not unicodedata.category(c).startswith('M'))
+    if bases != text:
+        runs.append(bases)
+    found: set[str] = set()
+    for run in runs:
+        found.update(run[i:i + 2] for i in range(len(run) - 1))
+    pairs: set[str] = set(found)
+    for pair in found:
+        pairs.update(p for p in (pair.upper(), pair.lower(), pair.title()) if len(p) == 2)
+    return pairs
 
-        assetdir: str = fontpath or path.dirname(font) or "."
-        os.makedirs(assetdir, exist_ok=True)
+@beartype
+def _layout_pairs(text: str, prune_layout: bool | Collection[str]) -> frozenset[str] | None:
+    """The character pairs layout pruning keeps kerning and ligatures for, or None not to prune.
+    prune_layout is True to use the pairs in text, or the text runs to use instead."""
+    if prune_layout is False:
+        return None
+    if prune_layout is True:
+        return frozenset(_text_pairs(text))
+    pairs: set[str] = set()
+    for run in [prune_layout] if isinstance(prune_layout, str) else prune_layout:
+        pairs.update(_text_pairs(run))
+    return frozenset(pairs)
 
-        if verbose:
-            print(f"Processing {font}")
+@beartype
+def _layout_subtables(tt_font: 'fontTools.ttLib.TTFont', tag: str, lookup_type: int) -> Iterator[Any]:
+    """Yield each subtable of lookup_type in the font's tag (GSUB or GPOS) table, looking inside extension subtables."""
+    if tag not in tt_font:
+        return
+    layout_table: Any = tt_font[tag] # Typed as any table, but GSUB and GPOS are otTables
+    if layout_table.table.LookupList is None:
+        return
+    for lookup in layout_table.table.LookupList.Lookup:
+        for subtable in lookup.SubTable:
+            subtable = getattr(subtable, 'ExtSubTable', subtable)
+            if subtable.LookupType == lookup_type:
+                yield subtable
+
+@beartype
+def _glyph_characters(tt_font: 'fontTools.ttLib.TTFont') -> dict[str, tuple[set[str], set[str]]]:
+    """Map each glyph to the characters its text can start and end with: a character's own glyph is just
+    that character, an alternate (eg a small cap) is the character it replaces, and a ligature starts
+    with its first component and ends with its last.
+
+    Glyphs left out can't be traced to the text, eg ones a substitution splits a glyph into, so
+    pruning keeps everything that uses them."""
+    # Each substitution output, with the glyphs it takes its first and last characters from
+    sources: list[tuple[str, str, str]] = []
+    untraced: set[str] = set()
+    for subtable in _layout_subtables(tt_font, 'GSUB', 1):
+        sources.extend((g, g, out) for g, out in subtable.mapping.items())
+    for subtable in _layout_subtables(tt_font, 'GSUB', 2):
+        for g, sequence in subtable.mapping.items():
+            if len(sequence) == 1:
+                sources.append((g, g, sequence[0]))
+            else:
+                untraced.update(sequence)
+    for subtable in _layout_subtables(tt_font, 'GSUB', 3):
+        sources.extend((g, g, out) for g, alternates in subtable.alternates.items() for out in alternates)
+    for subtable in _layout_subtables(tt_font, 'GSUB', 4):
+        sources.extend((first, (lig.Component or [first])[-1], lig.LigGlyph)
+                       for first, ligatures in subtable.ligatures.items() for lig in ligatures)
+    for subtable in _layout_subtables(tt_font, 'GSUB', 8):
+        sources.extend((g, g, out) for g, out in zip(subtable.Coverage.glyphs, subtable.Substitute))
+
+    characters: dict[str, tuple[set[str], set[str]]] = {}
+    for cp, glyph in (tt_font.getBestCmap() or {}).items():
+        firsts, lasts = characters.setdefault(glyph, (set(), set()))
+        firsts.add(chr(cp))
+        lasts.add(chr(cp))
+    changed: bool = True
+    while changed: # Substitutions can feed each other, so repeat until nothing more is learnt
+        changed = False
+        for first, last, out in sources:
+            if first in characters and last in characters:
+                firsts, lasts = characters.setdefault(out, (set(), set()))
+                if not (characters[first][0] <= firsts and characters[last][1] <= lasts):
+                    firsts.update(characters[first][0])
+                    lasts.update(characters[last][1])
+                    changed = True
+    # Anything made from a glyph that can't be traced can't be traced either
+    untraced.update(g for g in tt_font.getGlyphOrder() if g not in characters)
+    changed = True
+    while changed:
+        changed = False
+        for first, last, out in sources:
+            if out not in untraced and (first in untraced or last in untraced):
+                untraced.add(out)
+                changed = True
+    return {g: chars for g, chars in characters.items() if g not in untraced}
+
+@beartype
+def _prune_ligatures(tt_font: 'fontTools.ttLib.TTFont', pairs: frozenset[str]) -> int:
+    """Remove the GSUB ligatures with two adjacent components that never occur next to each other in pairs.
+    Run before subsetting so their ligature glyphs are dropped too. Returns how many were removed."""
+    characters: dict[str, tuple[set[str], set[str]]] = _glyph_characters(tt_font)
+
+    def can_follow(left: str, right: str) -> bool:
+        if left not in characters or right not in characters:
+            return True
+        return any(last + first in pairs for last in characters[left][1] for first in characters[right][0])
+
+    pruned: int = 0
+    for subtable in _layout_subtables(tt_font, 'GSUB', 4):
+        for first, ligatures in list(subtable.ligatures.items()):
+            kept: list[Any] = [lig for lig in ligatures
+                               if all(can_follow(a, b) for a, b in zip([first] + lig.Component, lig.Component))]
+            pruned += len(ligatures) - len(kept)
+            if kept:
+                subtable.ligatures[first] = kept
+            else:
+                del subtable.ligatures[first]
+    return pruned
 
-        tt_font: TTFont = TTFont(font)
-        subsetter: Subsetter = Subsetter()
+@beartype
+def _prune_kerning(tt_font: 'fontTools.ttLib.TTFont', pairs: frozenset[str]) -> int:
+    """Remove the GPOS pair adjustments (kerning) for glyphs that never occur next to each other in pairs.
+    Run on the subset font, which is much smaller. Returns how many pair records were removed.
+
+    Class-based kerning is pruned by dropping unused first glyphs and moving unused second glyphs out
+    of their classes, and then removing the classes left empty."""
+    characters: dict[str, tuple[set[str], set[str]]] = _glyph_characters(tt_font)
+    glyph_order: list[str] = tt_font.getGlyphOrder()
+    untraced: set[str] = set(glyph_order[1:]) - set(characters) # Not .notdef, which is never kerned
+    starting_with: dict[str, set[str]] = {}
+    for glyph, (firsts, _) in characters.items():
+        for c in firsts:
+            starting_with.setdefault(c, set()).add(glyph)
+    followers: dict[str, set[str]] = {}
+    for pair in pairs:
+        followers.setdefault(pair[0], set()).update(starting_with.get(pair[1], ()))
+
+    def partners(glyph: str) -> set[str]:
+        if glyph not in characters:
+            return set(glyph_order)
+        return untraced.union(*(followers.get(c, ()) for c in characters[glyph][1]))
+
+    pruned: int = 0
+    for subtable in _layout_subtables(tt_font, 'GPOS', 2):
+        coverage: list[str] = []
+        if subtable.Format == 1:
+            pair_sets: list[Any] = []
+            for first, pair_set in zip(subtable.Coverage.glyphs, subtable.PairSet):
+                seconds: set[str] = partners(first)
+                kept: list[Any] = [r for r in pair_set.PairValueRecord if r.SecondGlyph in seconds]
+                pruned += len(pair_set.PairValueRecord) - len(kept)
+                pair_set.PairValueRecord = kept
+                pair_set.PairValueCount = len(kept)
+                if kept:
+                    coverage.append(first)
+                    pair_sets.append(pair_set)
+            subtable.PairSet = pair_sets
+            subtable.PairSetCount = len(pair_sets)
+        elif subtable.Format == 2:
+            class1: dict[str, int] = subtable.ClassDef1.classDefs if subtable.ClassDef1 else {}
+            class2: dict[str, int] = subtable.ClassDef2.classDefs if subtable.ClassDef2 else {}
+            used_class1: set[int] = {0}
+            used_class2: set[int] = {0}
+            used_seconds: set[str] = set()
+            for first in subtable.Coverage.glyphs:
+                seconds = partners(first)
+                if seconds:
+                    coverage.append(first)
+                    used_class1.add(class1.get(first, 0))
+                    used_class2.update(class2.get(g, 0) for g in seconds)
+                    used_seconds.update(seconds)
+            pruned += subtable.Class1Count * subtable.Class2Count - len(used_class1) * len(used_class2)
+            # Renumber the classes left, keeping class 0 first
+            class1_map: dict[int, int] = {c: i for i, c in enumerate(sorted(used_class1))}
+            class2_map: dict[int, int] = {c: i for i, c in enumerate(sorted(used_class2))}
+            subtable.Class1Record = [subtable.Class1Record[c] for c in class1_map]
+            for record in subtable.Class1Record:
+                record.Class2Record = [record.Class2Record[c] for c in class2_map]
+            subtable.Class1Count = len(class1_map)
+            subtable.Class2Count = len(class2_map)
+            if subtable.ClassDef1:
+                subtable.ClassDef1.classDefs = {g: class1_map[class1[g]] for g in coverage if g in class1}
+            if subtable.ClassDef2:
+                subtable.ClassDef2.classDefs = {g: class2_map[c] for g, c in class2.items() if g in used_seconds}
+        else:
+            continue
+        subtable.Coverage.glyphs = coverage
+    # Subtables left with nothing to kern are removed
+    if 'GPOS' in tt_font and tt_font['GPOS'].table.LookupList is not None:
+        for lookup in tt_font['GPOS'].table.LookupList.Lookup:
+            lookup.SubTable = [s for s in lookup.SubTable
+                               if getattr(s, 'ExtSubTable', s).LookupType != 2 or getattr(s, 'ExtSubTable', s).Coverage.glyphs]
+            lookup.SubTableCount = len(lookup.SubTable)
+    return pruned
+
+@beartype
+def _subset_font(tt_font: 'fontTools.ttLib.TTFont', characters: Collection[str], pairs: frozenset[str] | None = None,
+                 layout_features: Collection[str] | None = None) -> FontFileBreakdown:
+    """Subset tt_font in place to the glyphs needed to render characters, and return where its glyphs came
+    from. The table sizes are filled in by _add_table_sizes once the font is saved. With pairs, the kerning
+    and ligatures for characters that are never next to each other in them are removed too. layout_features
+    are the OpenType features to keep, instead of fontTools' defaults ('*' for all of them)."""
+    from fontTools.subset import Options, Subsetter
+    pruned_ligatures: int = 0
+    if pairs is not None:
+        with _trace_span("prune ligatures", "font"):
+            pruned_ligatures = _prune_ligatures(tt_font, pairs)
+    with _trace_span("subset", "font", characters=len(characters)): # Glyph closure over layout features, then pruning
+        options: Options = Options()
+        if layout_features is not None:
+            options.layout_features = list(layout_features)
+        subsetter: Subsetter = Subsetter(options)
         subsetter.populate(unicodes=[ord(c) for c in characters])
         subsetter.subset(tt_font)
+    pruned_kerning: int = 0
+    if pairs is not None:
+        with _trace_span("prune kerning", "font"):
+            pruned_kerning = _prune_kerning(tt_font, pairs)
+    glyphs_after: int = len(subsetter.glyphs_retained)
+    cmap_glyphs: int = len(subsetter.glyphs_cmaped)
+    layout_glyphs: int = len(subsetter.glyphs_gsubed - subsetter.glyphs_mathed)
+    return {"glyphs_before": len(subsetter.orig_glyph_order), "glyphs_after": glyphs_after, "cmap_glyphs": cmap_glyphs,
+            "layout_glyphs": layout_glyphs, "other_glyphs": glyphs_after - cmap_glyphs - layout_glyphs, "table_sizes": {},
+            "pruned_kerning": pruned_kerning, "pruned_ligatures": pruned_ligatures}
 
-        basename: str = os.path.splitext(os.path.basename(font))[0]
-        outfile: str = os.path.join(assetdir, f"{basename}.{subsetname}.woff2")
+@beartype
+def _add_table_sizes(breakdown: FontFileBreakdown, data: bytes) -> FontFileBreakdown:
+    """Fill in the size of each table in the WOFF2 font data, read from its table directory."""
+    from fontTools.ttLib.woff2 import WOFF2Reader
+    reader: WOFF2Reader = WOFF2Reader(io.BytesIO(data))
+    breakdown["table_sizes"] = {tag: getattr(entry, 'origLength', entry.length) for tag, entry in sorted(reader.tables.items())}
+    return breakdown
+
+# Roughly how many bytes of memory subsetting uses per byte of each font table. fontTools decompiles
+# the layout tables into large trees of Python objects, so they dominate; glyph outlines are
+# only decompiled for glyphs that are kept. Measured with tracemalloc on Latin and variable fonts.
+_TABLE_MEMORY_FACTORS: dict[str, int] = {'GPOS': 90, 'GSUB': 90, 'GDEF': 40, 'morx': 40, 'CFF ': 20, 'CFF2': 20,
+                                         'glyf': 4, 'cmap': 10, 'post': 10, 'name': 10}
+_DEFAULT_TABLE_MEMORY_FACTOR: int = 2
+# Fixed cost of subsetting any font, regardless of its size
+_BASE_FONT_MEMORY: int = 512 * 1024
+
+@beartype
+def _estimate_font_memory(font: str) -> int:
+    """Estimate the peak memory, in bytes, used to subset a font, from the sizes of its tables.
 
-        if os.path.exists(outfile):
-            warnings.warn(f"Output font file already exists and will be overwritten: {outfile}")
+    Only the font's table directory is read, so this is cheap compared to subsetting.
+    """
+    from fontTools.ttLib import TTFont
+    try:
+        tt_font: TTFont = TTFont(font, lazy=True)
+    except Exception:
+        return _BASE_FONT_MEMORY + 20 * path.getsize(font) # Let subsetting report the problem; assume the worst
+    estimate: int = _BASE_FONT_MEMORY
+    if tt_font.reader is None: # Only a font built in memory has no reader
+        return estimate
+    for tag, entry in tt_font.reader.tables.items():
+        length: int = getattr(entry, 'origLength', entry.length) # WOFF table lengths are compressed
+        estimate += length * _TABLE_MEMORY_FACTORS.get(tag, _DEFAULT_TABLE_MEMORY_FACTOR)
+    tt_font.close()
+    return estimate
+
+@beartype
+def _schedule_by_memory(estimates: dict[str, int], running: dict[str, int], workers: int, max_memory: int) -> str | None:
+    """Pick the next font to start, or None to wait for a running one to finish.
 
+    The largest waiting font that fits within the memory left in the budget is started, so big
+    fonts start early and small ones fill the remaining space. A font too big for the budget on
+    its own is only started once nothing else is running.
+    """
+    if not estimates or len(running) >= workers:
+        return None
+    available: int = max_memory - sum(running.values()) if max_memory > 0 else sys.maxsize
+    for font in sorted(estimates, key=lambda f: (-estimates[f], f)):
+        if estimates[font] <= available:
+            return font
+    if not running:
+        return max(estimates, key=lambda f: (estimates[f], f))
+    return None
+
+@beartype
+def _save_woff2(tt_font: 'fontTools.ttLib.TTFont') -> bytes:
+    """Return the font as WOFF2 data, and close it."""
+    with _trace_span("save woff2", "font"):
         tt_font.flavor = 'woff2'
-        tt_font.save(outfile)
+        buffer: io.BytesIO = io.BytesIO()
+        tt_font.save(buffer)
         tt_font.close()
+    return buffer.getvalue()
 
-        res["fonts"][font] = outfile
+@beartype
+def _subset_font_file(font: str, characters: frozenset[str], pairs: frozenset[str] | None, layout_features: tuple[str, ...] | None,
+                      trace: bool) -> tuple[bytes, FontFileBreakdown, frozenset[int], list[dict[str, Any]]]:
+    """Subset a font file to the characters it has glyphs for and return it as WOFF2 data, with its breakdown and
+    the code points it has glyphs for. Run in worker processes, so it opens the font itself. With trace, the spans
+    recorded in the worker are returned too, for the calling process's trace."""
+    from fontTools.ttLib import TTFont
+    tracer: _Tracer | None = _Tracer() if trace else None
+    token: contextvars.Token[_Tracer | None] = _active_tracer.set(tracer)
+    try:
+        with _trace_span("font", "font", font=font):
+            with _trace_span("load font", "font", font=font):
+                tt_font: TTFont = TTFont(font)
+            codepoints: frozenset[int] = frozenset(tt_font.getBestCmap() or {}) # None if it has no Unicode cmap
+            breakdown: FontFileBreakdown = _subset_font(tt_font, _covered_characters(characters, codepoints), pairs, layout_features)
+            data: bytes = _save_woff2(tt_font)
+    finally:
+        _active_tracer.reset(token)
+    return (data, breakdown, codepoints, tracer.events if tracer is not None else [])
 
-        if verbose:
-            print(f"  Generated {outfile}")
+@beartype
+def _subset_font_files_in_parallel(outfiles: dict[str, str], characters: set[str], workers: int, max_memory: int, verbose: bool,
+                                   finished: Callable[[str, bytes, FontFileBreakdown, frozenset[int], float], None], progress: ProgressCallback | None = None,
+                                   pairs: frozenset[str] | None = None, layout_features: Collection[str] | None = None) -> None:
+    """Subset each font (key of outfiles) to the characters it has glyphs for, and its layout to pairs and layout_features (see _subset_font), using up to workers processes, keeping the estimated memory of
+    the fonts being processed at once within max_memory bytes (0 for no limit). finished is called, in
+    this process, with each font, its WOFF2 data, its breakdown, the code points it has glyphs for and how long it took, as each one completes."""
+    from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+    estimates: dict[str, int] = {font: _estimate_font_memory(font) for font in outfiles}
+    if max_memory > 0:
+        for font_file, estimate in estimates.items():
+            if estimate > max_memory:
+                _warn(f"Font {font_file} is estimated to need {_file_size_to_readable(estimate)} of memory, more than "
+                      f"the budget of {_file_size_to_readable(max_memory)}; it will be processed on its own")
+
+    running: dict[str, int] = {}
+    started: dict[str, float] = {}
+    tracer: _Tracer | None = _active_tracer.get()
+    futures: dict[Future[tuple[bytes, FontFileBreakdown, frozenset[int], list[dict[str, Any]]]], str] = {}
+    # A worker process keeps its peak memory after subsetting a large font, so with a budget each font
+    # gets a new process, and the memory in use stays what the estimates say. Python 3.10 can't do this.
+    pool_options: dict[str, Any] = {"max_tasks_per_child": 1} if max_memory > 0 and sys.version_info >= (3, 11) else {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(outfiles)), **pool_options) as executor:
+        while estimates or futures:
+            font: str | None = _schedule_by_memory(estimates, running, workers, max_memory)
+            if font is not None:
+                running[font] = estimates.pop(font)
+                if verbose:
+                    _logger.info(f"Processing {font} (estimated memory {_file_size_to_readable(running[font])})")
+                _emit(progress, "font_started", font=font, output=outfiles[font])
+                started[font] = time.perf_counter()
+                futures[executor.submit(_subset_font_file, font, frozenset(characters), pairs,
+                                        None if layout_features is None else tuple(layout_features), tracer is not None)] = font
+                continue
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                done_font: str = futures.pop(future)
+                del running[done_font]
+                data, breakdown, codepoints, spans = future.result() # Re-raises any error from the worker
+                if tracer is not None:
+                    tracer.add(spans)
+                finished(done_font, data, breakdown, codepoints, time.perf_counter() - started[done_font])
 
-    # Build structured stats
-    file_stats: list[FontFileStats] = []
-    for original, generated in res["fonts"].items():
-        file_stats.append({
-            "original": original,
-            "generated": generated,
-            "original_size": path.getsize(original),
-            "generated_size": path.getsize(generated),
-        })
+@beartype
+def _start_result(text: str, verbose: bool) -> FontimizeResult:
+    """Return a result holding the characters in text, and their Unicode ranges, ready for fonts to be added."""
+    res: FontimizeResult = _empty_result()  # at this level there are no CSS files; keys are present to prevent errors for API consumer
+
+    characters: set[str] = get_used_characters_in_str(text)
+
+    char_list: list[str] = list(characters)
+    if verbose:
+        _logger.info("Characters:")
+        _logger.info("  " + str(char_list))
+    res["chars"] = characters # set of characters used in the input text
+
+    char_ranges: list[charPair] = _get_char_ranges(char_list)
+    if verbose:
+        _logger.info("Character ranges:")
+        _logger.info("  " + str(char_ranges))
+
+    uranges_str: str = ', '.join(r.get_range() for r in char_ranges)
+    if verbose:
+        _logger.info("Unicode ranges:")
+        _logger.info("  " + uranges_str)
+    res["uranges"] = uranges_str # unicode ranges matching the characters used in the input text
+    return res
+
+@beartype
+def _print_breakdown(breakdown: FontFileBreakdown) -> None:
+    """Log what a subset font contains: where its glyphs came from, and its tables, largest first."""
+    _logger.info(f"      Glyphs: {breakdown['glyphs_before']} -> {breakdown['glyphs_after']} ({breakdown['cmap_glyphs']} for the "
+                 f"characters used, {breakdown['layout_glyphs']} by layout closure, {breakdown['other_glyphs']} others)")
+    tables: list[tuple[str, int]] = sorted(breakdown["table_sizes"].items(), key=lambda item: -item[1])
+    _logger.info("      Tables: " + ", ".join(f"{tag.strip()} {size:,}" for tag, size in tables) + " bytes")
+    if breakdown["pruned_kerning"] or breakdown["pruned_ligatures"]:
+        _logger.info(f"      Layout pruning removed {breakdown['pruned_kerning']} kerning pairs and "
+                     f"{breakdown['pruned_ligatures']} ligatures the text never uses")
+
+@beartype
+def _finish_result(res: FontimizeResult, file_stats: list[FontFileStats], verbose: bool, print_stats: bool,
+                   quantized_chars: int = 0) -> FontimizeResult:
+    """Add the stats for the generated fonts to the result, printing them if asked to. quantized_chars is
+    the number of characters quantization added to the ones found."""
     sum_orig: int = sum(fs["original_size"] for fs in file_stats)
     sum_new: int = sum(fs["generated_size"] for fs in file_stats)
     savings: int = sum_orig - sum_new
@@ -243,42 +1112,440 @@ def optimise_fonts(text : str, fonts : Collection[str] | str, fontpath : str = "
         "total_generated_size": sum_new,
         "savings_bytes": savings,
         "savings_percent": round(savings_percent, 1),
+        "quantized_chars": quantized_chars,
+        "quantized_glyphs": sum(fs["quantized_glyphs"] for fs in file_stats),
     }
 
     if verbose or print_stats:
-        print("Results:")
-        print("  Fonts processed: " + str(res["stats"]["fonts_processed"]))
+        _logger.info("Results:")
+        _logger.info("  Fonts processed: " + str(res["stats"]["fonts_processed"]))
         if not verbose: # If verbose, already printed per-font above
-            print("  Generated (use verbose output for input -> generated map):")
+            _logger.info("  Generated (use verbose output for input -> generated map):")
             for fs in file_stats:
-                print("    " + fs["generated"])
+                _logger.info("    " + fs["generated"])
+                _print_breakdown(fs["breakdown"])
         else:
-            print("  Generated the following fonts from the originals:")
+            _logger.info("  Generated the following fonts from the originals:")
             for fs in file_stats:
-                print("    " + fs["original"] + " -> " + fs["generated"])
-        print("  Total original font size: " + _file_size_to_readable(sum_orig))
-        print("  Total optimised font size: " + _file_size_to_readable(sum_new))
-        print("  Savings: " +  _file_size_to_readable(savings) + " less, which is " + str(round(savings_percent, 1)) + "%!")
-        print("Thankyou for using Fontimize!") # A play on Font and Optimise, haha, so good pun clever. But seriously - hopefully a memorable name!
+                _logger.info("    " + fs["original"] + " -> " + fs["generated"])
+                _print_breakdown(fs["breakdown"])
+        _logger.info("  Total original font size: " + _file_size_to_readable(sum_orig))
+        _logger.info("  Total optimised font size: " + _file_size_to_readable(sum_new))
+        _logger.info("  Savings: " +  _file_size_to_readable(savings) + " less, which is " + str(round(savings_percent, 1)) + "%!")
+        if quantized_chars:
+            _logger.info(f"  Quantization added {quantized_chars} characters, which is {res['stats']['quantized_glyphs']} glyphs across all fonts")
+        for font, uncovered in sorted(res["uncovered"].items()):
+            shown: str = ' '.join(repr(c) for c in sorted(uncovered)[:10]) + (' ...' if len(uncovered) > 10 else '')
+            _logger.info(f"  {font} has no glyphs for {len(uncovered)} characters, which will use a fallback font: {shown}")
+        _logger.info("Thankyou for using Fontimize!") # A play on Font and Optimise, haha, so good pun clever. But seriously - hopefully a memorable name!
 
     return res
 
-# Takes a list of strings, and otherwise does the same as optimise_fonts
+# Blocks that quantization rounds the characters used up to. They're Unicode blocks small enough to include
+# whole; larger ones, such as CJK, aren't listed, so their characters are still kept individually.
+_QUANTIZE_BLOCKS: dict[str, tuple[int, int]] = {
+    'Basic Latin': (0x0020, 0x007E), # Printable ASCII
+    'Latin-1 Supplement': (0x00A0, 0x00FF),
+    'Latin Extended-A': (0x0100, 0x017F),
+    'Latin Extended-B': (0x0180, 0x024F),
+    'Greek and Coptic': (0x0370, 0x03FF),
+    'Cyrillic': (0x0400, 0x04FF),
+    'Hebrew': (0x0590, 0x05FF),
+    'Arabic': (0x0600, 0x06FF),
+    'General Punctuation': (0x2000, 0x206F),
+    'Currency Symbols': (0x20A0, 0x20CF),
+    'Letterlike Symbols': (0x2100, 0x214F),
+    'Arrows': (0x2190, 0x21FF),
+}
+
+@beartype
+def quantize_characters(characters : set[str], blocks : Collection[str] | None = None) -> set[str]:
+    """Round characters up to whole blocks: every character of each block that any of them is in.
+
+    The subsets then only change when text uses a block for the first time, rather than for each new
+    punctuation mark or accented letter, so browser and subset caches stay valid for longer. blocks are
+    names from _QUANTIZE_BLOCKS (by default, all of them), or ranges in the same format as uranges,
+    eg 'U+0400-04FF'. Characters outside every block are kept as they are.
+    """
+    if isinstance(blocks, str):
+        blocks = [blocks]
+    ranges: list[tuple[int, int]] = []
+    for block in (blocks if blocks is not None else _QUANTIZE_BLOCKS):
+        if block in _QUANTIZE_BLOCKS:
+            ranges.append(_QUANTIZE_BLOCKS[block])
+        elif re.fullmatch(r'\s*U\+[0-9A-Fa-f]+(-[0-9A-Fa-f]+)?\s*', block):
+            codepoints: list[int] = sorted(ord(c) for c in _parse_uranges(block))
+            ranges.append((codepoints[0], codepoints[-1]))
+        else:
+            raise ValueError(f"Unknown quantization block '{block}', expected a Unicode range such as 'U+0400-04FF' "
+                             f"or one of: {', '.join(_QUANTIZE_BLOCKS)}")
+
+    quantized: set[str] = set(characters)
+    for first, last in ranges:
+        if any(first <= ord(c) <= last for c in characters):
+            quantized.update(chr(cp) for cp in range(first, last + 1))
+    return quantized
+
+@_hot_path_beartype
+def _needs_glyph(c: str) -> bool:
+    """Whether a character is drawn with a glyph from the font: control and format characters, line and
+    paragraph separators, and variation selectors (which fonts map in cmap format 14, not as glyphs) aren't."""
+    cp: int = ord(c)
+    if 0xFE00 <= cp <= 0xFE0F or 0xE0100 <= cp <= 0xE01EF:
+        return False
+    return unicodedata.category(c) not in ('Cc', 'Cf', 'Zl', 'Zp')
+
+@beartype
+def _plan_font(font: str, outfile: str, characters: set[str], codepoints: frozenset[int]) -> FontimizePlanEntry:
+    """Compare the characters in an existing subset font with the ones subsetting font would keep now.
+
+    Only the fonts' cmap tables are read, so this is much quicker than subsetting."""
+    from fontTools.ttLib import TTFont
+    wanted: set[int] = {ord(c) for c in characters} & codepoints
+
+    if not path.isfile(outfile):
+        return {"font": font, "status": "missing", "added": sorted(chr(c) for c in wanted), "removed": []}
+    try:
+        generated: TTFont = TTFont(outfile, lazy=True)
+        existing: set[int] = set(generated.getBestCmap() or {}) # None if it has no Unicode cmap
+        generated.close()
+    except Exception as e:
+        _warn(f"Could not read existing subset font {outfile}: {e}")
+        return {"font": font, "status": "stale", "added": sorted(chr(c) for c in wanted), "removed": []}
+    added: list[str] = sorted(chr(c) for c in wanted - existing)
+    removed: list[str] = sorted(chr(c) for c in existing - wanted)
+    return {"font": font, "status": "stale" if added or removed else "current", "added": added, "removed": removed}
+
+@beartype
+def _print_plan(plan: dict[str, FontimizePlanEntry]) -> None:
+    _logger.info("Check:")
+    for outfile, entry in sorted(plan.items()):
+        _logger.info(f"  {entry['status'].capitalize()}: {outfile}")
+        if entry["added"]:
+            _logger.info("    Added: " + ', '.join(r.get_range() for r in _get_char_ranges(entry["added"])))
+        if entry["removed"]:
+            _logger.info("    Removed: " + ', '.join(r.get_range() for r in _get_char_ranges(entry["removed"])))
+    stale: int = sum(1 for entry in plan.values() if entry["status"] != 'current')
+    _logger.info(f"  {stale} of {len(plan)} subset fonts would change")
+
+@beartype
+def plan_is_stale(res: FontimizeResult) -> bool:
+    """Return True if a check mode result found any subset font that is missing or out of date."""
+    return any(entry["status"] != 'current' for entry in res["plan"].values())
+
+# Takes the input text, and the fonts, and generates new font files
+# Other methods (eg taking HTML files, or multiple pieces of text) all end up here
+@_reports_warnings
+@_profiled
+@beartype
+def optimise_fonts(text : str, fonts : Collection[str] | str, fontpath : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True, cache : FontimizeCache | None = None, workers : int = 1, max_memory : int = 0, progress : ProgressCallback | None = None, font_writer : Callable[[str, bytes], None] | None = None, check : bool = False, profile_cpu : str = "", profile_memory : bool = False, trace : str = "", quantize : bool | Collection[str] = False, prune_layout : bool | Collection[str] = False, layout_features : bool | Collection[str] | None = None, coverage_index : FontimizeCoverageIndex | None = None) -> FontimizeResult:
+    unique_fonts: set[str] = {fonts} if isinstance(fonts, str) else set(fonts)  # Deduplicate; accept single string
+
+    res: FontimizeResult = _start_result(text, verbose)
+    characters: set[str] = res["chars"]
+
+    # Quantization rounds the characters up to whole blocks, so the subsets change less often. The
+    # result's chars and uranges are still the characters found; the extra ones are counted in the stats.
+    if quantize is not False:
+        characters = quantize_characters(characters, None if quantize is True else quantize)
+    quantized: set[int] = {ord(c) for c in characters - res["chars"]}
+    # Layout pruning drops the kerning and ligatures for characters that are never next to each other
+    pairs: frozenset[str] | None = _layout_pairs(text, prune_layout)
+    features: Collection[str] | None = _resolve_layout_features(text, layout_features)
+
+    # For each font, generate a subset WOFF2 containing only the used characters.
+    # By default, place it in the same folder as the respective font, unless fontpath is specified.
+    # fontTools' subsetter preserves ligatures, contextual alternates, kerning and other
+    # OpenType layout features by default (layout_closure=True), so the subset font
+    # will still render correctly for the included characters.
+    outfiles: dict[str, str] = {}
+    for font in unique_fonts:
+        font_ext: str = pathlib.Path(font).suffix.lower()
+        if font_ext not in _SUPPORTED_FONT_EXTENSIONS:
+            _warn(f"Unrecognised font format '{font_ext}' for {font}, "
+                  f"supported formats: {', '.join(sorted(_SUPPORTED_FONT_EXTENSIONS))}")
+
+        assetdir: str = fontpath or path.dirname(font) or "."
+        basename: str = os.path.splitext(os.path.basename(font))[0]
+        outfile: str = os.path.join(assetdir, f"{basename}.{subsetname}.woff2")
+
+        # With a font_writer, the caller stores the generated fonts, so nothing is written here;
+        # in check mode nothing is written at all
+        if font_writer is None and not check:
+            os.makedirs(assetdir, exist_ok=True)
+            if os.path.exists(outfile):
+                _warn(f"Output font file already exists and will be overwritten: {outfile}")
+
+        outfiles[font] = outfile
+
+    # Each font is only given the characters it has glyphs for. The ones it doesn't have are reported,
+    # since browsers draw them with a fallback font. Without a coverage index, the code points are taken
+    # from each font as it's loaded for subsetting, rather than reading its cmap separately
+    font_codepoints: dict[str, frozenset[int]] = {}
+    if coverage_index is not None:
+        font_codepoints = {font: coverage_index.codepoints(font) for font in outfiles}
+        coverage_index.save()
+    def record_coverage(font: str, codepoints: frozenset[int]) -> None:
+        font_codepoints[font] = codepoints
+        uncovered: set[str] = {c for c in res["chars"] if ord(c) not in codepoints and _needs_glyph(c)}
+        if uncovered:
+            res["uncovered"][font] = uncovered
+
+    # In check mode, compare the existing subsets with what would be generated, without subsetting
+    if check:
+        for font, outfile in outfiles.items():
+            record_coverage(font, font_codepoints[font] if font in font_codepoints else _read_codepoints(font))
+            res["plan"][outfile] = _plan_font(font, outfile, characters, font_codepoints[font])
+            _emit(progress, "font_checked", font=font, output=outfile, status=res["plan"][outfile]["status"])
+        res["fonts"].update(outfiles)
+        if verbose or print_stats:
+            _print_plan(res["plan"])
+        return res
+
+    # Each generated font is written (or handed to font_writer) as soon as it's ready, and its size
+    # recorded for the stats, so nothing needs reading back afterwards
+    file_stats: list[FontFileStats] = []
+    def finished(font: str, data: bytes, breakdown: FontFileBreakdown, codepoints: frozenset[int], seconds: float) -> None:
+        record_coverage(font, codepoints)
+        outfile: str = outfiles[font]
+        if font_writer is not None:
+            font_writer(outfile, data)
+        else:
+            with open(outfile, 'wb') as file:
+                file.write(data)
+        original_size: int = path.getsize(font)
+        file_stats.append({"original": font, "generated": outfile, "original_size": original_size, "generated_size": len(data),
+                           "quantized_glyphs": len(quantized & font_codepoints[font]),
+                           "uncovered_chars": len(res["uncovered"].get(font, ())), "breakdown": _add_table_sizes(breakdown, data)})
+        if verbose:
+            _logger.info(f"  Generated {outfile}")
+        _emit(progress, "font_finished", font=font, output=outfile, original_size=original_size,
+              generated_size=len(data), seconds=round(seconds, 3))
+
+    # With several workers, fonts are subset in separate processes, starting only as many at once
+    # as fit in the memory budget
+    if workers > 1 and len(outfiles) > 1:
+        with _profile_phase("subsetting"): # The workers are separate processes, so only their total time is recorded
+            _subset_font_files_in_parallel(outfiles, characters, workers, max_memory, verbose, finished, progress, pairs, features)
+    else:
+        from fontTools.ttLib import TTFont
+        for font, outfile in outfiles.items():
+            if verbose:
+                _logger.info(f"Processing {font}")
+            _emit(progress, "font_started", font=font, output=outfile)
+            start_time: float = time.perf_counter()
+
+            with _profile_phase(f"subset {font}"), _trace_span("font", "font", font=font):
+                with _trace_span("load font", "font", font=font):
+                    tt_font: TTFont = cache.open_font(font) if cache is not None else TTFont(font)
+                codepoints: frozenset[int] = font_codepoints[font] if font in font_codepoints else frozenset(tt_font.getBestCmap() or {})
+                breakdown: FontFileBreakdown = _subset_font(tt_font, _covered_characters(characters, codepoints), pairs, features)
+                finished(font, _save_woff2(tt_font), breakdown, codepoints, time.perf_counter() - start_time)
+    res["fonts"].update(outfiles)
+
+    return _finish_result(res, file_stats, verbose, print_stats, len(quantized))
+
+# Takes fonts that are already in memory, as bytes or binary file objects keyed by their file name, and
+# generates the subsets in memory too, without reading or writing any files
+@_reports_warnings
+@beartype
+def optimise_fonts_in_memory(text : str, fonts : Mapping[str, bytes | io.BufferedIOBase], subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True, font_writer : Callable[[str, bytes], None] | None = None, progress : ProgressCallback | None = None, quantize : bool | Collection[str] = False, prune_layout : bool | Collection[str] = False, layout_features : bool | Collection[str] | None = None) -> FontimizeResult:
+    """Subset fonts held in memory, returning the generated WOFF2 data in the result's "font_data".
+
+    Each font's name is used to name its subset in the same way as optimise_fonts, eg 'fonts/Arial.ttf'
+    produces 'fonts/Arial.FontimizeSubset.woff2', and the result's "fonts" maps one to the other. If
+    font_writer is given, it is called with each subset's name and data as soon as it's generated (eg
+    to upload it) instead, and the data isn't kept in "font_data".
+    """
+    from fontTools.ttLib import TTFont
+
+    res: FontimizeResult = _start_result(text, verbose)
+    characters: set[str] = res["chars"]
+    if quantize is not False:
+        characters = quantize_characters(characters, None if quantize is True else quantize)
+    quantized: set[int] = {ord(c) for c in characters - res["chars"]}
+    pairs: frozenset[str] | None = _layout_pairs(text, prune_layout)
+    features: Collection[str] | None = _resolve_layout_features(text, layout_features)
+
+    file_stats: list[FontFileStats] = []
+    for name, font in fonts.items():
+        font_path: pathlib.PurePosixPath = pathlib.PurePosixPath(name)
+        if font_path.suffix.lower() not in _SUPPORTED_FONT_EXTENSIONS:
+            _warn(f"Unrecognised font format '{font_path.suffix.lower()}' for {name}, "
+                  f"supported formats: {', '.join(sorted(_SUPPORTED_FONT_EXTENSIONS))}")
+        outfile: str = str(font_path.with_name(f"{font_path.stem}.{subsetname}.woff2"))
+
+        if verbose:
+            _logger.info(f"Processing {name}")
+        _emit(progress, "font_started", font=name, output=outfile)
+        start_time: float = time.perf_counter()
+
+        font_bytes: bytes = font if isinstance(font, bytes) else font.read()
+        tt_font: TTFont = TTFont(io.BytesIO(font_bytes))
+        codepoints: frozenset[int] = frozenset(tt_font.getBestCmap() or {})
+        uncovered: set[str] = {c for c in res["chars"] if ord(c) not in codepoints and _needs_glyph(c)}
+        if uncovered:
+            res["uncovered"][name] = uncovered
+        breakdown: FontFileBreakdown = _subset_font(tt_font, _covered_characters(characters, codepoints), pairs,
+                                                    features)
+        data: bytes = _save_woff2(tt_font)
+
+        if font_writer is not None:
+            font_writer(outfile, data)
+        else:
+            res["font_data"][outfile] = data
+        res["fonts"][name] = outfile
+        file_stats.append({"original": name, "generated": outfile, "original_size": len(font_bytes), "generated_size": len(data),
+                           "quantized_glyphs": len(quantized & codepoints), "uncovered_chars": len(uncovered),
+                           "breakdown": _add_table_sizes(breakdown, data)})
+
+        if verbose:
+            _logger.info(f"  Generated {outfile}")
+        _emit(progress, "font_finished", font=name, output=outfile, original_size=len(font_bytes),
+              generated_size=len(data), seconds=round(time.perf_counter() - start_time, 3))
+
+    return _finish_result(res, file_stats, verbose, print_stats, len(quantized))
+
+# Generates several subsets of one font, eg one per site section, or a main and a critical subset, parsing
+# the font only once rather than once per optimise_fonts call
 @beartype
-def optimise_fonts_for_multiple_text(texts : Collection[str] | str, fonts : Collection[str] | str, fontpath : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True) -> FontimizeResult:
-    text: str = texts if isinstance(texts, str) else "".join(texts)
-    return optimise_fonts(text, fonts, fontpath, verbose=verbose, print_stats=print_stats)
+def optimise_font_subsets(font : str, subsets : Mapping[str, str | Collection[str]], fontpath : str = "", verbose : bool = False, print_stats : bool = True, cache : FontimizeCache | None = None, progress : ProgressCallback | None = None, font_writer : Callable[[str, bytes], None] | None = None, quantize : bool | Collection[str] = False, prune_layout : bool | Collection[str] = False, layout_features : bool | Collection[str] | None = None, coverage_index : FontimizeCoverageIndex | None = None) -> dict[str, FontimizeResult]:
+    """Subset font once for each entry in subsets, which maps a subset name to the text (or characters)
+    it must render, and return each subset's result by its name.
+
+    Each subset is named like optimise_fonts' subsetname, eg {'Main': ..., 'Critical': ...} generates
+    Arial.Main.woff2 and Arial.Critical.woff2. The font is parsed once and cut down to the characters
+    of all the subsets together, and each subset is then made from that much smaller font, which
+    gives the same glyphs as subsetting the original but without parsing it again for each one.
+    """
+    from fontTools.ttLib import TTFont
+
+    if not subsets: # Nothing to generate, so the font isn't loaded
+        return {}
+
+    with _collecting_warnings() as collected:
+        with _trace_span("load font", "font", font=font):
+            tt_font: TTFont = cache.open_font(font) if cache is not None else TTFont(font)
+        # Without a coverage index, the code points are taken from the font just loaded
+        codepoints: frozenset[int]
+        if coverage_index is not None:
+            codepoints = coverage_index.codepoints(font)
+            coverage_index.save()
+        else:
+            codepoints = frozenset(tt_font.getBestCmap() or {}) # None if it has no Unicode cmap
+        assetdir: str = fontpath or path.dirname(font) or "."
+        basename: str = os.path.splitext(os.path.basename(font))[0]
+        original_size: int = path.getsize(font)
+
+        # Work out every subset's characters first, so the font can be cut down to all of them at once
+        results: dict[str, FontimizeResult] = {}
+        subset_chars: dict[str, set[str]] = {}
+        subset_pairs: dict[str, frozenset[str] | None] = {}
+        quantized: dict[str, set[int]] = {}
+        for name, text in subsets.items():
+            res: FontimizeResult = _start_result(text if isinstance(text, str) else "".join(text), verbose)
+            # A subset given as characters rather than text has no pairs to prune its layout to
+            subset_pairs[name] = None if prune_layout is True and not isinstance(text, str) else \
+                                 _layout_pairs(text if isinstance(text, str) else "", prune_layout)
+            characters: set[str] = res["chars"]
+            if quantize is not False:
+                characters = quantize_characters(characters, None if quantize is True else quantize)
+            quantized[name] = {ord(c) for c in characters - res["chars"]}
+            uncovered: set[str] = {c for c in res["chars"] if ord(c) not in codepoints and _needs_glyph(c)}
+            if uncovered:
+                res["uncovered"][font] = uncovered
+            subset_chars[name] = _covered_characters(characters, codepoints)
+            results[name] = res
+        features: Collection[str] | None = _resolve_layout_features("".join("".join(text) for text in subsets.values()), layout_features)
+
+        union_data: bytes = b""
+        if len(subsets) > 1:
+            union_pairs: frozenset[str] | None = None if None in subset_pairs.values() else \
+                frozenset().union(*(pairs for pairs in subset_pairs.values() if pairs is not None))
+            glyphs_before: int = _subset_font(tt_font, set().union(*subset_chars.values()), union_pairs, features)["glyphs_before"]
+            with _trace_span("save union", "font"):
+                tt_font.flavor = None # Kept uncompressed, since it's only read back here
+                buffer: io.BytesIO = io.BytesIO()
+                tt_font.save(buffer)
+                tt_font.close()
+            union_data = buffer.getvalue()
+
+        if font_writer is None:
+            os.makedirs(assetdir, exist_ok=True)
+        for name, res in results.items():
+            outfile: str = os.path.join(assetdir, f"{basename}.{name}.woff2")
+            if verbose:
+                _logger.info(f"Processing {font} for subset {name}")
+            _emit(progress, "font_started", font=font, output=outfile)
+            start_time: float = time.perf_counter()
+
+            with _trace_span("font", "font", font=font, subset=name):
+                variant: TTFont = TTFont(io.BytesIO(union_data)) if union_data else tt_font
+                breakdown: FontFileBreakdown = _subset_font(variant, subset_chars[name], subset_pairs[name], features)
+                data: bytes = _save_woff2(variant)
+            if union_data: # Count the original font's glyphs, not the cut down one's
+                breakdown["glyphs_before"] = glyphs_before
+            if font_writer is not None:
+                font_writer(outfile, data)
+            else:
+                if os.path.exists(outfile):
+                    _warn(f"Output font file already exists and will be overwritten: {outfile}")
+                with open(outfile, 'wb') as file:
+                    file.write(data)
+            res["fonts"][font] = outfile
+
+            if verbose:
+                _logger.info(f"  Generated {outfile}")
+            _emit(progress, "font_finished", font=font, output=outfile, original_size=original_size,
+                  generated_size=len(data), seconds=round(time.perf_counter() - start_time, 3))
+            file_stats: list[FontFileStats] = [{"original": font, "generated": outfile, "original_size": original_size,
+                                                "generated_size": len(data), "quantized_glyphs": len(quantized[name] & codepoints),
+                                                "uncovered_chars": len(res["uncovered"].get(font, ())),
+                                                "breakdown": _add_table_sizes(breakdown, data)}]
+            _finish_result(res, file_stats, verbose, print_stats, len(quantized[name]))
+
+    for res in results.values():
+        res["warnings"] = list(collected)
+    return results
+
+# Takes a list of strings, and otherwise does the same as optimise_fonts. texts can be any iterable,
+# such as a generator rendering pages one at a time: each string is discarded once its characters are
+# collected, so they never all need to be in memory at once
+@beartype
+def optimise_fonts_for_multiple_text(texts : Iterable[str] | str, fonts : Collection[str] | str, fontpath : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True, progress : ProgressCallback | None = None, font_writer : Callable[[str, bytes], None] | None = None, quantize : bool | Collection[str] = False, prune_layout : bool | Collection[str] = False, layout_features : bool | Collection[str] | None = None, coverage_index : FontimizeCoverageIndex | None = None) -> FontimizeResult:
+    if isinstance(texts, str):
+        texts = [texts]
+    characters: set[str] = set()
+    pairs: set[str] = set() # Kept for layout pruning, since the joined characters aren't the text
+    for text in texts:
+        characters.update(text)
+        if prune_layout is True:
+            pairs.update(_text_pairs(text))
+    return optimise_fonts("".join(characters), fonts, fontpath, verbose=verbose, print_stats=print_stats, progress=progress, font_writer=font_writer,
+                          quantize=quantize, prune_layout=pairs if prune_layout is True else prune_layout, layout_features=layout_features,
+                          coverage_index=coverage_index)
 
 # Takes a list of HTML strings, and parses those to get the used text (ie ignoring HTML tags);
-# then uses that to do the same as optimise_fonts
+# then uses that to do the same as optimise_fonts. Like optimise_fonts_for_multiple_text, html_contents
+# can be a generator, and each page is parsed and discarded in turn
 @beartype
-def optimise_fonts_for_html_contents(html_contents : Collection[str] | str, fonts : Collection[str] | str, fontpath : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True) -> FontimizeResult:
+def optimise_fonts_for_html_contents(html_contents : Iterable[str] | str, fonts : Collection[str] | str, fontpath : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True, progress : ProgressCallback | None = None, font_writer : Callable[[str, bytes], None] | None = None, quantize : bool | Collection[str] = False, prune_layout : bool | Collection[str] = False, layout_features : bool | Collection[str] | None = None, rendered_only : bool = False, text_attributes : bool | Collection[str] = False, coverage_index : FontimizeCoverageIndex | None = None) -> FontimizeResult:
+    from bs4 import BeautifulSoup
     if isinstance(html_contents, str):
         html_contents = [html_contents]
-    texts: list[str] = [BeautifulSoup(html, 'html.parser').get_text() for html in html_contents]
-    return optimise_fonts("".join(texts), fonts, fontpath, verbose=verbose, print_stats=print_stats)
+    characters: set[str] = set()
+    pairs: set[str] = set()
+    for html in html_contents:
+        text: str = _html_text(BeautifulSoup(html, 'html.parser'), rendered_only, text_attributes)
+        characters.update(text)
+        if prune_layout is True:
+            pairs.update(_text_pairs(text))
+    return optimise_fonts("".join(characters), fonts, fontpath, verbose=verbose, print_stats=print_stats, progress=progress, font_writer=font_writer,
+                          quantize=quantize, prune_layout=pairs if prune_layout is True else prune_layout, layout_features=layout_features,
+                          coverage_index=coverage_index)
 
 @beartype
+@_holds_cssutils_lock
 def _find_font_face_urls(css_contents: str) -> list[str]:
     """Extract all font file URLs from @font-face src declarations.
 
@@ -286,6 +1553,8 @@ def _find_font_face_urls(css_contents: str) -> list[str]:
     local() font names are skipped — they reference system-installed fonts by name,
     not file paths, so they can't be subset.
     """
+    _cssutils()
+    import cssutils # Already imported and set up by _cssutils(); this names it for the annotations below
     sheet: cssutils.css.CSSStyleSheet = cssutils.parseString(css_contents)
 
     urls: list[str] = []
@@ -295,7 +1564,7 @@ def _find_font_face_urls(css_contents: str) -> list[str]:
             # cssutils splits src into typed items: URIValue for url(), CSSFunction for local()/format()
             css_value: cssutils.css.value.PropertyValue | None = rule.style.getPropertyCSSValue('src')
             if css_value is None:
-                warnings.warn("@font-face rule has no parseable src property")
+                _warn("@font-face rule has no parseable src property")
                 continue
             for item in css_value:
                 # URIValue items have a .uri attribute; local() and format() do not
@@ -313,6 +1582,260 @@ def _get_path(known_file_path: str, relative_path: str) -> str:
 
     return path.normpath(full_path)
 
+@beartype
+def _matches_any(rel_path: str, patterns: Collection[str]) -> bool:
+    """True if a path, or just its final component, matches any of the fnmatch patterns."""
+    name: str = path.basename(rel_path)
+    return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+@beartype
+def _walk_files(root: str, include: Collection[str], exclude: Collection[str]) -> Iterator[str]:
+    """Yield files under root matching include and not exclude, walking with os.scandir.
+
+    scandir returns each entry's type along with its name, so unlike os.walk + os.stat no
+    extra system call is needed per file. Entries are sorted by name so the output order is
+    stable between runs. Excluded directories are not descended into.
+    """
+    pending: list[str] = [root]
+    while pending:
+        current: str = pending.pop()
+        with os.scandir(current) as it:
+            entries: list[os.DirEntry[str]] = sorted(it, key=lambda e: e.name)
+        subdirs: list[str] = []
+        for entry in entries:
+            rel_path: str = path.relpath(entry.path, root)
+            if exclude and _matches_any(rel_path, exclude):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file() and _matches_any(rel_path, include):
+                yield entry.path
+        pending.extend(reversed(subdirs))  # Pop in name order, depth-first
+
+# Takes files, directories and glob patterns, and yields the files to process one by one
+@beartype
+def discover_files(inputs : Iterable[str] | str, include : Collection[str] | None = None, exclude : Collection[str] = ()) -> Iterator[str]:
+    """Expand directories and glob patterns into input files, lazily.
+
+    Plain file paths are yielded as-is. Directories are walked recursively, yielding files
+    which match any of the include patterns (by default HTML files only, since a site folder
+    also contains images, scripts and so on). Glob patterns (eg 'site/**/*.html') are expanded
+    with recursive ** support; a pattern matching a directory walks it. Any path matching an
+    exclude pattern is skipped. Patterns are fnmatch-style and match either the file name or
+    the path relative to the directory being walked.
+
+    Paths are produced as a generator, so a large site can be streamed into
+    optimise_fonts_for_files, which reads each file in turn rather than all at once.
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    include_patterns: Collection[str] = include if include else _DEFAULT_INCLUDE_PATTERNS
+
+    for item in inputs:
+        if glob.has_magic(item):
+            for match in glob.iglob(item, recursive=True):
+                if exclude and _matches_any(match, exclude):
+                    continue
+                if path.isdir(match):
+                    yield from _walk_files(match, include_patterns, exclude)
+                else:
+                    yield match
+        elif path.isdir(item):
+            yield from _walk_files(item, include_patterns, exclude)
+        elif not (exclude and _matches_any(item, exclude)):
+            yield item
+
+
+@beartype
+def _is_remote(url: str) -> bool:
+    """True for http(s) URLs, including protocol-relative ones (//example.com/font.ttf)."""
+    return url.startswith(('http://', 'https://', '//'))
+
+@beartype
+def _resolve_path(known_file_path: str, relative_path: str) -> str:
+    """Like _get_path, but also resolves URLs: relative to a remote stylesheet, or absolute remote URLs."""
+    if _is_remote(known_file_path) or _is_remote(relative_path):
+        if relative_path.startswith('//') and not _is_remote(known_file_path):
+            return 'https:' + relative_path # Protocol-relative URL in a local file: assume https
+        return urljoin(known_file_path, relative_path)
+    return _get_path(known_file_path, relative_path)
+
+# Default location for downloaded remote stylesheets and fonts
+_DEFAULT_CACHE_DIR: str = path.join(path.expanduser('~'), '.cache', 'fontimize')
+
+@beartype
+class _RemoteFetcher:
+    """Downloads http(s) stylesheets and fonts into an on-disk cache.
+
+    Connections are kept alive and pooled per host, so fetching many fonts from the same
+    server reuses one TCP/TLS connection instead of opening a new one per font. At most
+    max_connections downloads run at once. Cached files are revalidated with a conditional
+    request (If-None-Match / If-Modified-Since), so an unchanged file costs a 304 and no
+    body. In offline mode, only the cache is used and nothing is requested.
+
+    Each URL is cached as <cache_dir>/<hash>/<original file name>, so the subset fonts
+    generated from it keep the original name, plus <cache_dir>/<hash>.json holding the
+    validators from the response headers.
+    """
+
+    _MAX_REDIRECTS: int = 5
+
+    def __init__(self, cache_dir: str = "", offline: bool = False, max_connections: int = 4, timeout: float = 30.0) -> None:
+        self.cache_dir: str = cache_dir or _DEFAULT_CACHE_DIR
+        self.offline: bool = offline
+        self.max_connections: int = max(1, max_connections)
+        self.timeout: float = timeout
+        self._idle: dict[tuple[str, str], list['http.client.HTTPConnection']] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def _cache_paths(self, url: str) -> tuple[str, str]:
+        from pathvalidate import sanitize_filename
+        key: str = hashlib.sha256(url.encode('utf-8')).hexdigest()[:24]
+        name: str = sanitize_filename(unquote(path.basename(urlsplit(url).path))) or 'index'
+        return (path.join(self.cache_dir, key, name), path.join(self.cache_dir, key + '.json'))
+
+    def _get_connection(self, scheme: str, netloc: str) -> 'http.client.HTTPConnection':
+        import http.client
+        with self._lock:
+            idle: list[http.client.HTTPConnection] = self._idle.get((scheme, netloc), [])
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release_connection(self, scheme: str, netloc: str, conn: 'http.client.HTTPConnection') -> None:
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def _request(self, url: str, headers: dict[str, str]) -> tuple[int, dict[str, str], bytes]:
+        """GET url over a pooled connection, retrying once if a kept-alive connection was closed by the server."""
+        import http.client
+        parts = urlsplit(url)
+        target: str = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        for attempt in range(2):
+            conn: http.client.HTTPConnection = self._get_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', target, headers=headers)
+                response: http.client.HTTPResponse = conn.getresponse()
+                body: bytes = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if attempt == 1:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(parts.scheme, parts.netloc, conn)
+            return (response.status, {k.lower(): v for k, v in response.getheaders()}, body)
+        raise http.client.HTTPException(f"Could not fetch {url}") # Not reached: the second attempt returns or raises
+
+    def fetch(self, url: str) -> str | None:
+        """Return the path of a local copy of url, downloading it if needed, or None if it's unavailable."""
+        import http.client
+        if url.startswith('//'):
+            url = 'https:' + url
+        body_path, meta_path = self._cache_paths(url)
+        meta: dict[str, str] | None = self._read_meta(meta_path) if path.isfile(body_path) else None
+        cached: bool = meta is not None
+
+        if self.offline:
+            if not cached:
+                _warn(f"Remote file is not cached and offline mode is on; skipping: {url}")
+                return None
+            return body_path
+
+        headers: dict[str, str] = {'User-Agent': 'Fontimize'}
+        if meta is not None:
+            if 'etag' in meta:
+                headers['If-None-Match'] = meta['etag']
+            if 'last-modified' in meta:
+                headers['If-Modified-Since'] = meta['last-modified']
+
+        request_url: str = url
+        try:
+            for _ in range(self._MAX_REDIRECTS + 1):
+                status, response_headers, body = self._request(request_url, headers)
+                if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                    request_url = urljoin(request_url, response_headers['location'])
+                    continue
+                break
+        except (OSError, http.client.HTTPException) as e:
+            if cached:
+                _warn(f"Could not fetch {url} ({e}); using cached copy")
+                return body_path
+            _warn(f"Could not fetch remote file; skipping: {url} ({e})")
+            return None
+
+        if status == 304 and cached:
+            return body_path
+        if status != 200:
+            if cached:
+                _warn(f"Fetching {url} returned HTTP {status}; using cached copy")
+                return body_path
+            _warn(f"Fetching remote file returned HTTP {status}; skipping: {url}")
+            return None
+
+        os.makedirs(path.dirname(body_path), exist_ok=True)
+        self._replace_file(body_path, body)
+        validators: dict[str, str] = {k: response_headers[k] for k in ('etag', 'last-modified') if k in response_headers}
+        self._replace_file(meta_path, json.dumps(validators).encode('utf-8'))
+        return body_path
+
+    @staticmethod
+    def _read_meta(meta_path: str) -> dict[str, str] | None:
+        """Return the validators cached for a URL, or None if there are none or they can't be read, eg if
+        the file was truncated, in which case the URL is downloaded again."""
+        try:
+            with open(meta_path, 'r') as file:
+                meta: Any = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            _warn(f"Ignoring unreadable cache metadata {meta_path}: {e}")
+            return None
+        if not isinstance(meta, dict) or not all(isinstance(v, str) for v in meta.values()):
+            _warn(f"Ignoring unreadable cache metadata {meta_path}: not a JSON object of strings")
+            return None
+        return meta
+
+    @staticmethod
+    def _replace_file(file_path: str, data: bytes) -> None:
+        """Write data to a temporary file then rename it over file_path, so a concurrent or interrupted
+        run never sees a partial file. The temporary name is unique, so concurrent writers don't mix."""
+        temp_path: str = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+
+    def fetch_all(self, urls: Collection[str]) -> dict[str, str | None]:
+        """Fetch several URLs concurrently, returning each URL's local path (or None)."""
+        unique_urls: list[str] = list(dict.fromkeys(urls))
+        if len(unique_urls) <= 1:
+            return {url: self.fetch(url) for url in unique_urls}
+        # Each download runs in a copy of this thread's context, so its warnings and trace spans
+        # are recorded for the call that asked for it
+        contexts: list[contextvars.Context] = [contextvars.copy_context() for _ in unique_urls]
+        with ThreadPoolExecutor(max_workers=min(self.max_connections, len(unique_urls))) as executor:
+            return dict(zip(unique_urls, executor.map(lambda context, url: context.run(self.fetch, url), contexts, unique_urls)))
+
+    def close(self) -> None:
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
 # Characters that counter()/counters() may generate, keyed by list-style-type.
 # When the style is known we include only the relevant characters; when unknown
 # we include all of them as a generous fallback.
@@ -402,6 +1925,7 @@ def _counter_style_from_css_text(css_text: str) -> str | None:
 
 
 @beartype
+@_holds_cssutils_lock
 def _extract_pseudo_elements_content(css_contents: str) -> list[str]:
     """Extract content characters from :before and :after pseudo-elements.
 
@@ -414,6 +1938,8 @@ def _extract_pseudo_elements_content(css_contents: str) -> list[str]:
     - attr(): emits a warning since the value depends on HTML attributes and
       cannot be determined from CSS alone
     """
+    _cssutils()
+    import cssutils # Already imported and set up by _cssutils(); this names it for the annotations below
     sheet: cssutils.css.CSSStyleSheet = cssutils.parseString(css_contents)
 
     contents: list[str] = []
@@ -435,7 +1961,7 @@ def _extract_pseudo_elements_content(css_contents: str) -> list[str]:
                             chars: str = _COUNTER_CHARS_BY_STYLE.get(style, _ALL_COUNTER_CHARS)
                             contents.append(chars)
                         elif css_text.startswith("attr("):
-                            warnings.warn(
+                            _warn(
                                 f"CSS content uses attr() in '{selector}' — the characters "
                                 f"it generates depend on HTML attribute values and cannot be "
                                 f"determined from CSS alone. You may need to include additional "
@@ -452,9 +1978,97 @@ def _extract_pseudo_elements_content(css_contents: str) -> list[str]:
     return contents
 
 
+# The OpenType features browsers apply without being asked: kerning, standard ligatures and contextual
+# alternates, mark positioning, localised forms, and the shaping features of each script. fontTools
+# keeps a few more by default, eg fractions and contextual swashes, which CSS has to turn on
+_BROWSER_LAYOUT_FEATURES: tuple[str, ...] = (
+    'abvf', 'abvm', 'abvs', 'akhn', 'blwf', 'blwm', 'blws', 'calt', 'ccmp', 'cfar', 'chws', 'cjct', 'clig', 'curs',
+    'dist', 'fin2', 'fin3', 'fina', 'half', 'haln', 'init', 'isol', 'kern', 'liga', 'ljmo', 'locl', 'ltra', 'ltrm',
+    'mark', 'med2', 'medi', 'mkmk', 'mset', 'nukt', 'pref', 'pres', 'pstf', 'psts', 'rand', 'rclt', 'rkrf', 'rlig',
+    'rphf', 'rtla', 'rtlm', 'rvrn', 'stch', 'tjmo', 'vatu', 'vchw', 'vert', 'vjmo', 'vkrn', 'vrt2')
+# Browsers format text around a fraction slash (U+2044) as a fraction themselves
+_FRACTION_FEATURES: tuple[str, ...] = ('frac', 'numr', 'dnom')
+
+# The OpenType features each keyword of the font-variant-* properties (and the font-variant shorthand) turns on
+_FONT_VARIANT_FEATURES: dict[str, tuple[str, ...]] = {
+    # font-variant-ligatures
+    'common-ligatures': ('liga', 'clig'), 'discretionary-ligatures': ('dlig',), 'historical-ligatures': ('hlig',),
+    'contextual': ('calt',),
+    # font-variant-caps
+    'small-caps': ('smcp',), 'all-small-caps': ('smcp', 'c2sc'), 'petite-caps': ('pcap',),
+    'all-petite-caps': ('pcap', 'c2pc'), 'unicase': ('unic',), 'titling-caps': ('titl',),
+    # font-variant-numeric
+    'lining-nums': ('lnum',), 'oldstyle-nums': ('onum',), 'proportional-nums': ('pnum',), 'tabular-nums': ('tnum',),
+    'diagonal-fractions': ('frac',), 'stacked-fractions': ('afrc',), 'ordinal': ('ordn',), 'slashed-zero': ('zero',),
+    # font-variant-east-asian
+    'jis78': ('jp78',), 'jis83': ('jp83',), 'jis90': ('jp90',), 'jis04': ('jp04',), 'simplified': ('smpl',),
+    'traditional': ('trad',), 'full-width': ('fwid',), 'proportional-width': ('pwid',), 'ruby': ('ruby',),
+    # font-variant-position
+    'sub': ('subs',), 'super': ('sups',),
+    # font-variant-alternates; the named values of styleset() and character-variant() are defined in
+    # @font-feature-values, so any of the stylistic sets or character variants may be meant
+    'historical-forms': ('hist',), 'stylistic': ('salt',), 'swash': ('swsh', 'cswh'), 'ornaments': ('ornm',),
+    'annotation': ('nalt',), 'styleset': tuple(f"ss{i:02}" for i in range(1, 21)),
+    'character-variant': tuple(f"cv{i:02}" for i in range(1, 100)),
+}
+
+_CSS_COMMENT_RE: re.Pattern[str] = re.compile(r'/\*.*?\*/', re.DOTALL)
+_FONT_PROPERTY_RE: re.Pattern[str] = re.compile(r'(?<![\w-])(font-feature-settings|font-variant(?:-[a-z]+)?|font)\s*:\s*([^;{}]*)',
+                                                re.IGNORECASE)
+_FEATURE_SETTING_RE: re.Pattern[str] = re.compile(r'''(["'])([\x20-\x7e]{4})\1(?:\s+(on|off|\d+))?''', re.IGNORECASE)
+
+@beartype
+def _find_font_features(css_contents: str) -> set[str]:
+    """Return the OpenType features that font-feature-settings and font-variant-* turn on anywhere in CSS, which can be
+    a stylesheet, the contents of a <style> element or a style attribute. Features only ever turned off are left out."""
+    features: set[str] = set()
+    for match in _FONT_PROPERTY_RE.finditer(_CSS_COMMENT_RE.sub('', css_contents)):
+        prop: str = match.group(1).lower()
+        value: str = match.group(2)
+        if prop == 'font-feature-settings':
+            for setting in _FEATURE_SETTING_RE.finditer(value):
+                if (setting.group(3) or 'on').lower() not in ('off', '0'):
+                    features.add(setting.group(2))
+        else:
+            keywords: list[str] = re.findall(r'[a-z0-9-]+', value.lower())
+            if prop == 'font': # The shorthand only allows small-caps of the font-variant values
+                keywords = [k for k in keywords if k == 'small-caps']
+            for keyword in keywords:
+                features.update(_FONT_VARIANT_FEATURES.get(keyword, ()))
+    return features
+
+@beartype
+def _css_layout_features(text: str, features: Collection[str]) -> list[str]:
+    """The layout features to keep in subsets for text styled with CSS that turns on features: the ones browsers
+    apply by default, and those."""
+    kept: set[str] = set(_BROWSER_LAYOUT_FEATURES) | set(features)
+    if '\u2044' in text:
+        kept.update(_FRACTION_FEATURES)
+    return sorted(kept)
+
+@beartype
+def _resolve_layout_features(text: str, layout_features: bool | Collection[str] | None,
+                             css_features: Collection[str] = ()) -> Collection[str] | None:
+    """Turn a layout_features argument into the features to keep: None (or False) keeps fontTools' defaults,
+    True the ones browsers apply by default plus css_features, and a collection just those."""
+    if layout_features is None or layout_features is False:
+        return None
+    if layout_features is True:
+        return _css_layout_features(text, css_features)
+    return layout_features
+
+@beartype
+def _parse_stylesheet(css_contents: str) -> tuple[str, list[str], frozenset[str]]:
+    """Return the text of a stylesheet's :before and :after pseudo-elements, its @font-face URLs, and the OpenType
+    features it turns on."""
+    return ("".join(_extract_pseudo_elements_content(css_contents)), _find_font_face_urls(css_contents),
+            frozenset(_find_font_features(css_contents)))
+
+
 @beartype
+@_holds_cssutils_lock
 def _rewrite_css(css_path: str, css_contents: str, font_mapping: dict[str, str],
-                 output_dir: str) -> tuple[str, str]:
+                 output_dir: str, font_display: FontDisplay | None = None, output_suffix: str = "") -> tuple[str, str]:
     """Rewrite @font-face src URLs in CSS to point to generated .woff2 fonts.
 
     This works in two phases:
@@ -466,8 +2080,16 @@ def _rewrite_css(css_path: str, css_contents: str, font_mapping: dict[str, str],
        byte-for-byte. We can't round-trip the whole file through cssutils because it
        may silently drop properties it considers invalid.
 
+    If font_display is given, rewritten @font-face rules also get (or have replaced)
+    a font-display descriptor, eg 'swap', so text renders while the font downloads.
+
+    output_suffix is inserted before the output file's extension (eg 'style.Subset-1.css'),
+    used when one CSS file is rewritten several times to point at different subsets.
+
     Returns (output_path, rewritten_css_content).
     """
+    _cssutils()
+    import cssutils # Already imported and set up by _cssutils(); this names it for the annotations below
     sheet: cssutils.css.CSSStyleSheet = cssutils.parseString(css_contents)
 
     # Phase 1: modify @font-face rules via cssutils DOM.
@@ -496,7 +2118,7 @@ def _rewrite_css(css_path: str, css_contents: str, font_mapping: dict[str, str],
         replaced_prev_url: bool = False
         for item in css_value:
             if hasattr(item, 'uri'):
-                resolved: str = _get_path(css_path, item.uri)
+                resolved: str = _resolve_path(css_path, item.uri)
                 if resolved in font_mapping:
                     new_font_path: str = font_mapping[resolved]
                     rel_path: str = os.path.relpath(new_font_path, output_dir)
@@ -520,10 +2142,17 @@ def _rewrite_css(css_path: str, css_contents: str, font_mapping: dict[str, str],
 
         if changed:
             rule.style.setProperty('src', ', '.join(new_src_parts))
+            if font_display is not None:
+                rule.style.setProperty('font-display', font_display)
             modified_indices.add(idx)
 
+    css_name: str = os.path.basename(urlsplit(css_path).path) if _is_remote(css_path) else os.path.basename(css_path)
+    if output_suffix:
+        stem, ext = os.path.splitext(css_name)
+        css_name = f"{stem}.{output_suffix}{ext}"
+    output_path: str = os.path.join(output_dir, css_name)
+
     if not modified_indices:
-        output_path: str = os.path.join(output_dir, os.path.basename(css_path))
         return (output_path, css_contents)
 
     # Phase 2: splice modified @font-face blocks into the original CSS string.
@@ -542,145 +2171,1401 @@ def _rewrite_css(css_path: str, css_contents: str, font_mapping: dict[str, str],
                 serialized = serialized.decode('utf-8')
             new_css = new_css[:match.start()] + serialized + new_css[match.end():]
 
-    output_path = os.path.join(output_dir, os.path.basename(css_path))
     return (output_path, new_css)
 
 
-# Takes a list of files on disk
-# HTML files are parsed; all others are treated as text
-# First, collect all strings from those files.
-# Then, also parse to get all the CSS files they use. From those CSS files, collect all the fonts they use in @font-face src,
-# plus look for any additional characters that will be reflected in rendered webpage output, such as :before and :after pseudo-elements.
 @beartype
-def optimise_fonts_for_files(files : list[str], font_output_dir : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True, fonts : Collection[str] | str | None = None, addtl_text : str = "", css_rewriter : Callable[[str, str], None] | None = None) -> FontimizeResult:
-    if fonts is None:
-        fonts = []
-    elif isinstance(fonts, str):
-        fonts = [fonts]
+def _inject_preloads(html_contents: str, font_hrefs: list[str]) -> str:
+    """Insert <link rel="preload"> hints for the given font URLs just before </head>.
+
+    Like _rewrite_css, the rest of the HTML is preserved byte-for-byte: the tags are
+    spliced into the original string rather than round-tripping through BeautifulSoup.
+    Fonts which the page already preloads are not added a second time. If the page
+    has no </head> there is nowhere safe to put the hints, so it is returned unchanged.
+    """
+    from bs4 import BeautifulSoup
+    existing: set[str] = set()
+    for link in BeautifulSoup(html_contents, 'html.parser').find_all('link', href=True):
+        rel_attr = link.get('rel')
+        if isinstance(rel_attr, list) and 'preload' in rel_attr:
+            href = link['href']
+            existing.add(href[0] if isinstance(href, list) else href)
+
+    new_hrefs: list[str] = [h for h in font_hrefs if h not in existing]
+    if not new_hrefs:
+        return html_contents
+
+    head_end: re.Match[str] | None = re.search(r'</head\s*>', html_contents, re.IGNORECASE)
+    if head_end is None:
+        _warn("HTML has no </head>; cannot add font preload hints")
+        return html_contents
+
+    tags: str = "".join(f'<link rel="preload" href="{h}" as="font" type="font/woff2" crossorigin>\n'
+                        for h in new_hrefs)
+    return html_contents[:head_end.start()] + tags + html_contents[head_end.start():]
+
+_LINK_TAG_RE: re.Pattern[str] = re.compile(r'<link\b[^>]*>', re.IGNORECASE)
+_HREF_ATTR_RE: re.Pattern[str] = re.compile(r'''(\bhref\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
 
-    if (len(files) == 0) and len(addtl_text) == 0: # If you specify any text, input files are optional -- note, not documented, used for cmd line app
-        print("Error: No input files. Exiting.")
-        return {
-            "css": set(),
-            "fonts": {},
-            "chars": set(),
-            "uranges": "",
-            "rewritten_css": {},
-            "stats": _empty_stats(),
-        }
+@beartype
+def _stylesheet_path(html_path: str, href: str) -> str:
+    """Resolve a stylesheet <link> href, relative to the HTML file that links it."""
+    href = href.split('#')[0] # Fragments are never sent to a server
+    resolved: str = _resolve_path(html_path, href)
+    if _is_remote(resolved):
+        return resolved # The query string is part of a URL, eg Google Fonts' css2?family=...
+    # but locally it isn't part of the file name
+    return _resolve_path(html_path, href.split('?')[0])
+
+@beartype
+def _relink_stylesheets(html_contents: str, html_path: str, css_hrefs: dict[str, str]) -> str:
+    """Point the page's stylesheet <link>s at other copies of the CSS.
+
+    css_hrefs maps each stylesheet (resolved as in _collect_files) to its new href. As with
+    _inject_preloads, only the href values are changed and the rest of the HTML is preserved.
+    """
+    import html
+
+    def relink(tag: re.Match[str]) -> str:
+        href_attr: re.Match[str] | None = _HREF_ATTR_RE.search(tag.group(0))
+        if href_attr is None:
+            return tag.group(0)
+        href: str = html.unescape(next(g for g in href_attr.groups()[1:] if g is not None))
+        new_href: str | None = css_hrefs.get(_stylesheet_path(html_path, href))
+        if new_href is None:
+            return tag.group(0)
+        return tag.group(0)[:href_attr.start()] + f'{href_attr.group(1)}"{html.escape(new_href)}"' + tag.group(0)[href_attr.end():]
+
+    return _LINK_TAG_RE.sub(relink, html_contents)
 
+
+@beartype
+def _script_signature(chars: set[str]) -> frozenset[str]:
+    """Return the writing systems used by the letters in chars, eg {'LATIN', 'CYRILLIC'}.
+
+    The script is taken from the first word of each letter's Unicode name, which is
+    the script name for almost all letters ('CYRILLIC SMALL LETTER A', 'HIRAGANA LETTER KA').
+    CJK ideographs are all named 'CJK ...'. Digits, punctuation and symbols are shared
+    between scripts, so they don't contribute.
+    """
+    scripts: set[str] = set()
+    for c in chars:
+        if unicodedata.category(c).startswith('L'):
+            name: str = unicodedata.name(c, '')
+            if name:
+                scripts.add(name.split(' ', 1)[0])
+    return frozenset(scripts)
+
+@_hot_path_beartype
+def _jaccard(a: set[str], b: set[str]) -> float:
+    union: int = len(a | b)
+    return len(a & b) / union if union else 1.0
+
+@beartype
+def _cluster_pages(page_chars: dict[str, set[str]], max_clusters: int) -> list[list[str]]:
+    """Group pages so that pages using similar characters share font subsets.
+
+    Pages are first grouped by the scripts they use, so eg English, Russian and Japanese
+    pages fall into separate groups and English readers don't download Cyrillic or kana.
+    If that gives more than max_clusters groups, the two groups with the most similar
+    character sets (by Jaccard similarity) are merged until there are max_clusters left.
+    Returns lists of pages, ordered deterministically.
+    """
+    groups: dict[frozenset[str], tuple[list[str], set[str]]] = {}
+    for page, chars in page_chars.items():
+        signature: frozenset[str] = _script_signature(chars)
+        pages, group_chars = groups.setdefault(signature, ([], set()))
+        pages.append(page)
+        group_chars |= chars
+
+    clusters: list[tuple[list[str], set[str]]] = [groups[sig] for sig in sorted(groups, key=lambda g: sorted(g))]
+    while len(clusters) > max(max_clusters, 1):
+        best: tuple[int, int] = (0, 1)
+        best_similarity: float = -1.0
+        for i in range(len(clusters)):
+            for j in range(i + 1, len(clusters)):
+                similarity: float = _jaccard(clusters[i][1], clusters[j][1])
+                if similarity > best_similarity:
+                    best_similarity = similarity
+                    best = (i, j)
+        i, j = best
+        merged: tuple[list[str], set[str]] = (clusters[i][0] + clusters[j][0], clusters[i][1] | clusters[j][1])
+        clusters = [c for k, c in enumerate(clusters) if k not in best]
+        clusters.insert(i, merged)
+
+    return [sorted(pages) for pages, _ in clusters]
+
+@beartype
+def _sum_stats(all_stats: list[FontimizeStats]) -> FontimizeStats:
+    """Combine the stats from several subsetting runs into one total."""
+    files: list[FontFileStats] = [fs for stats in all_stats for fs in stats["files"]]
+    sum_orig: int = sum(fs["original_size"] for fs in files)
+    sum_new: int = sum(fs["generated_size"] for fs in files)
+    savings: int = sum_orig - sum_new
+    return {
+        "fonts_processed": len(files),
+        "files": files,
+        "total_original_size": sum_orig,
+        "total_generated_size": sum_new,
+        "savings_bytes": savings,
+        "savings_percent": round((savings / sum_orig * 100) if sum_orig > 0 else 0.0, 1),
+        "quantized_chars": sum(stats["quantized_chars"] for stats in all_stats),
+        "quantized_glyphs": sum(fs["quantized_glyphs"] for fs in files),
+    }
+
+# Subsets the fonts for text, then rewrites the given CSS files to use them and adds preload hints
+# to the HTML files that use those CSS files. This is the second half of optimise_fonts_for_files,
+# run once for all pages or once per cluster of pages.
+@beartype
+def _subset_and_rewrite(text: str, font_files: set[str], css_files: set[str], html_css: dict[str, list[str]],
+                        css_fonts: dict[str, list[str]], font_output_dir: str, subsetname: str, verbose: bool,
+                        print_stats: bool, css_rewriter: Callable[[str, str], None] | None, preload_fonts: bool,
+                        font_display: FontDisplay | None, html_rewriter: Callable[[str, str], None] | None,
+                        css_suffix: str = "", local_copies: dict[str, str] | None = None,
+                        cache: FontimizeCache | None = None, workers: int = 1, max_memory: int = 0,
+                        progress: ProgressCallback | None = None,
+                        font_writer: Callable[[str, bytes], None] | None = None, check: bool = False,
+                        quantize: bool | Collection[str] = False,
+                        coverage_index: FontimizeCoverageIndex | None = None,
+                        prune_layout: bool | Collection[str] = False, css_features: Collection[str] = (),
+                        layout_features: bool | Collection[str] | None = None) -> FontimizeResult:
+    # local_copies maps remote stylesheet and font URLs to their downloaded copies
+    if local_copies is None:
+        local_copies = {}
+    # With layout_features=True, the subsets keep the layout features browsers apply by default, and the
+    # ones the CSS (css_features) turns on; the alternate glyphs of any others aren't needed
+    layout_features = _resolve_layout_features(text, layout_features, css_features)
+    remote_urls: dict[str, str] = {local_path: url for url, local_path in local_copies.items()}
+
+    # Report remote fonts by their URL rather than the cache location they were read from
+    font_progress: ProgressCallback | None = progress
+    if progress is not None and remote_urls:
+        def font_progress(event: dict[str, Any]) -> None:
+            progress({**event, "font": remote_urls.get(event["font"], event["font"])})
+
+    res: FontimizeResult = optimise_fonts(text, font_files, fontpath=font_output_dir, subsetname=subsetname, verbose=verbose, print_stats=print_stats, cache=cache,
+                                           workers=workers, max_memory=max_memory, progress=font_progress,
+                                           font_writer=font_writer, check=check, quantize=quantize,
+                                           prune_layout=prune_layout, layout_features=layout_features,
+                                           coverage_index=coverage_index)
+    res["css"] = css_files
+    if check: # Nothing was generated, so there's nothing to point the CSS or HTML at
+        return res
+
+    # Remote fonts were subset from their downloaded copies; CSS refers to them by URL
+    font_mapping: dict[str, str] = dict(res["fonts"])
+    for url, local_path in local_copies.items():
+        if local_path in res["fonts"]:
+            font_mapping[url] = res["fonts"][local_path]
+
+    with _profile_phase("rewrite"):
+        # Rewrite CSS files to reference the generated .woff2 fonts
+        if font_output_dir and css_files:
+            for css_file in css_files:
+                with _trace_span("rewrite css", "css", css=css_file):
+                    with open(local_copies.get(css_file, css_file), 'r') as file:
+                        css = file.read()
+                    output_path, rewritten = _rewrite_css(css_file, css, font_mapping, font_output_dir, font_display, css_suffix)
+
+                if css_rewriter is not None:
+                    css_rewriter(output_path, rewritten)
+                else:
+                    with open(output_path, 'w') as file:
+                        file.write(rewritten)
+
+                res["rewritten_css"][css_file] = output_path
+                _emit(progress, "css_rewritten", css=css_file, output=output_path)
+
+        # Add preload hints to each HTML file for the generated fonts its stylesheets use, so the
+        # browser starts downloading them straight away instead of after the CSS has been parsed.
+        # Only done alongside CSS rewriting: otherwise the CSS still points at the original fonts,
+        # and preloading the subsets would download a font the page never uses.
+        if preload_fonts and font_output_dir:
+            for html_file, page_css in html_css.items():
+                page_fonts: list[str] = []
+                for css_file in page_css:
+                    for font in css_fonts.get(css_file, []):
+                        generated: str | None = font_mapping.get(font)
+                        if generated is not None and generated not in page_fonts:
+                            page_fonts.append(generated)
+
+                # Preload URLs are relative to the page, since that's what the browser resolves them against
+                html_dir: str = path.dirname(html_file) or "."
+                font_hrefs: list[str] = [os.path.relpath(font, html_dir) for font in page_fonts]
+                # The rewritten CSS is a copy in font_output_dir (renamed, for a cluster), so the page has to link
+                # it instead of the original, or the browser would download the original fonts as well as the
+                # preloaded subsets
+                css_hrefs: dict[str, str] = {css_file: os.path.relpath(res["rewritten_css"][css_file], html_dir)
+                                             for css_file in page_css if css_file in res["rewritten_css"]
+                                             and path.abspath(res["rewritten_css"][css_file]) != path.abspath(css_file)}
+                if not page_fonts and not css_hrefs:
+                    continue
+
+                with open(html_file, 'r') as file:
+                    html = file.read()
+                new_html: str = _relink_stylesheets(html, html_file, css_hrefs) if css_hrefs else html
+                new_html = _inject_preloads(new_html, font_hrefs) if font_hrefs else new_html
+                if new_html == html:
+                    continue
+
+                if html_rewriter is not None:
+                    html_rewriter(html_file, new_html)
+                else:
+                    with open(html_file, 'w') as file:
+                        file.write(new_html)
+
+                if page_fonts:
+                    res["preloads"][html_file] = page_fonts
+                    _emit(progress, "preloads_added", html=html_file, fonts=page_fonts)
+
+    res["fonts"] = {remote_urls.get(font, font): generated for font, generated in res["fonts"].items()}
+    for fs in res["stats"]["files"]:
+        fs["original"] = remote_urls.get(fs["original"], fs["original"])
+
+    return res
+
+
+class _CollectedFiles(TypedDict):
+    """Everything read from the input files and the CSS files they link, before any fonts are subset."""
+    text: str
+    css_files: set[str]
+    font_files: set[str]
+    html_css: dict[str, list[str]]
+    css_fonts: dict[str, list[str]]
+    css_pseudo_text: dict[str, str]
+    page_chars: dict[str, set[str]]
+    local_copies: dict[str, str]
+    features: set[str] # OpenType features the CSS turns on
+
+# Reads the input files and the CSS they use, finding the text, fonts and stylesheets. This is the first half
+# of optimise_fonts_for_files, and on its own the collect stage of a sharded build (see collect_summary)
+@beartype
+def _collect_files(files: list[str] | Iterator[str], fonts: Collection[str], addtl_text: str, verbose: bool,
+                   clustering: bool, fetch_remote: bool, cache_dir: str, offline: bool, cache: FontimizeCache | None,
+                   progress: ProgressCallback | None, rendered_only: bool = False,
+                   text_attributes: bool | Collection[str] = False) -> _CollectedFiles | None:
     text: str = addtl_text
     css_files: set[str] = set()
     font_files: set[str] = set()
     for f in fonts: # user-specified input font files
         font_files.add(f)
 
-    for f in files:
-        file_ext: str = pathlib.Path(f).suffix.lower()
-        with open(f, 'r') as file:
+    # Which CSS files each HTML file links, and which fonts each CSS file uses; used to
+    # work out which fonts each page needs preloaded
+    html_css: dict[str, list[str]] = {}
+    css_fonts: dict[str, list[str]] = {}
+    # When clustering, the characters used by each individual page
+    page_chars: dict[str, set[str]] = {}
+    # OpenType features turned on by the stylesheets, <style> elements and style attributes
+    features: set[str] = set()
+
+    from bs4 import BeautifulSoup
+
+    # files may be a generator (eg from discover_files), whose paths are read one at a time. Only when
+    # reporting progress are the paths listed up front, so it can show the total before any work starts
+    with _profile_phase("extraction"):
+        if progress is not None:
+            files = list(files)
+            _emit(progress, "files_discovered", count=len(files))
+        num_files: int = 0
+        for f in files:
+            num_files += 1
+            file_ext: str = pathlib.Path(f).suffix.lower()
+            with _trace_span("read", "io", file=f), open(f, 'r') as file:
+                contents: str = file.read()
             if file_ext == '.html' or file_ext == '.htm':
-                html = file.read()
-                soup = BeautifulSoup(html, 'html.parser')
-
-                # Extract used text
-                text += soup.get_text()
-
-                # Extract CSS files the HTML references
-                for link in soup.find_all('link', href=True):
-                    href = link['href']
-                    if isinstance(href, list):  # BS4 can return a list for multi-valued attributes
-                        href = href[0]
-                    # Strip query strings and fragments before checking extension
-                    clean_href: str = href.split('?')[0].split('#')[0]
-                    rel_attr = link.get('rel')  # BS4 returns a list for rel
-                    rel: list[str] = list(rel_attr) if isinstance(rel_attr, list) else []
-                    if clean_href.endswith('.css') or 'stylesheet' in rel:
-                        adjusted_css_path = _get_path(f, clean_href) # It'll be relative, so relative to the HTML file
-                        css_files.add(adjusted_css_path)
+                with _trace_span("extract html", "html", file=f):
+                    soup = BeautifulSoup(contents, 'html.parser')
+
+                    # Extract used text
+                    page_text: str = _html_text(soup, rendered_only, text_attributes)
+
+                    # OpenType features turned on in the page itself, rather than its stylesheets
+                    for style in soup.find_all('style'):
+                        features.update(_find_font_features(style.get_text()))
+                    for element in soup.find_all(style=True):
+                        features.update(_find_font_features(str(element['style'])))
+
+                    # Extract CSS files the HTML references
+                    page_css: list[str] = []
+                    for link in soup.find_all('link', href=True):
+                        href = link['href']
+                        if isinstance(href, list):  # BS4 can return a list for multi-valued attributes
+                            href = href[0]
+                        # Strip query strings and fragments before checking extension
+                        clean_href: str = href.split('?')[0].split('#')[0]
+                        rel_attr = link.get('rel')  # BS4 returns a list for rel
+                        rel: list[str] = list(rel_attr) if isinstance(rel_attr, list) else []
+                        if clean_href.endswith('.css') or 'stylesheet' in rel:
+                            adjusted_css_path = _stylesheet_path(f, href) # It'll be relative, so relative to the HTML file
+                            if _is_remote(adjusted_css_path) and not fetch_remote:
+                                _warn(f"Stylesheet is remote; skipping (use fetch_remote to download it): {adjusted_css_path}")
+                                continue
+                            css_files.add(adjusted_css_path)
+                            page_css.append(adjusted_css_path)
+                    html_css[f] = page_css
             else: # not HTML, treat as text
-                text += file.read()
+                page_text = contents
+            text += page_text
+            if clustering:
+                page_chars[f] = set(page_text)
+            _emit(progress, "file_extracted", file=f, chars=len(set(page_text)), css=html_css.get(f, []))
+
+    if num_files == 0 and len(addtl_text) == 0: # If you specify any text, input files are optional -- note, not documented, used for cmd line app
+        _logger.error("No input files. Exiting.")
+        return None
 
     # Sanity check that there is any text to process
     if len(text) == 0:
-        print("Error: No text found in the input files or additional text. Exiting.")
-        return {
-            "css": set(),
-            "fonts": {},
-            "chars": set(),
-            "uranges": "",
-            "rewritten_css": {},
-            "stats": _empty_stats(),
-        }
-
-    # Extract fonts from CSS files
+        _logger.error("No text found in the input files or additional text. Exiting.")
+        return None
+
+    with _profile_phase("css"):
+        # Remote stylesheets and fonts are downloaded, and then read from their local copies
+        fetcher: _RemoteFetcher | None = _RemoteFetcher(cache_dir, offline) if fetch_remote else None
+        local_copies: dict[str, str] = {}
+        if fetcher is not None:
+            for url, local_path in fetcher.fetch_all([c for c in css_files if _is_remote(c)]).items():
+                if local_path is None:
+                    css_files.discard(url)
+                else:
+                    local_copies[url] = local_path
+
+        # Extract fonts from CSS files
+        css_pseudo_text: dict[str, str] = {}
+        remote_font_urls: list[tuple[str, str]] = [] # (CSS file, font URL), fetched together once all CSS is parsed
+        for css_file in css_files:
+            # Extract the contents of all :before and :after CSS pseudo-elements, to add to the text,
+            # and the list of all fonts from @font-face src url: statements
+            local_css: str = local_copies.get(css_file, css_file)
+            with _trace_span("parse css", "css", css=css_file):
+                if cache is not None:
+                    pseudo_text, font_urls, css_features = cache.stylesheet(local_css)
+                else:
+                    with open(local_css, 'r') as file:
+                        pseudo_text, font_urls, css_features = _parse_stylesheet(file.read())
+            css_pseudo_text[css_file] = pseudo_text
+            features.update(css_features)
+            text += pseudo_text
+
+            css_fonts[css_file] = []
+            for font_url in font_urls:
+                adjusted_font_path = _resolve_path(css_file, font_url) # Relative to the CSS file
+                if _is_remote(adjusted_font_path):
+                    if fetcher is not None:
+                        remote_font_urls.append((css_file, adjusted_font_path))
+                    else:
+                        _warn(f"Font file is remote; skipping (use fetch_remote to download it): {font_url} (resolved to {adjusted_font_path})")
+                elif path.isfile(adjusted_font_path):
+                    font_files.add(adjusted_font_path)
+                    css_fonts[css_file].append(adjusted_font_path)
+                else:
+                    _warn(f"Font file not found (may be remote not local?); skipping: {font_url} (resolved to {adjusted_font_path})")
+
+        if fetcher is not None:
+            fetched_fonts: dict[str, str | None] = fetcher.fetch_all([url for _, url in remote_font_urls])
+            fetcher.close()
+            for css_file, url in remote_font_urls:
+                local_font: str | None = fetched_fonts[url]
+                if local_font is not None:
+                    local_copies[url] = local_font
+                    font_files.add(local_font)
+                    css_fonts[css_file].append(local_font)
+
+    # Remote fonts are reported by URL, as the CSS file refers to them
+    remote_urls: dict[str, str] = {local_path: url for url, local_path in local_copies.items()}
     for css_file in css_files:
-        with open(css_file, 'r') as file:
-            css = file.read()
-
-        # Extract the contents of all :before and :after CSS pseudo-elements; add these to the text
-        pseudo_elements = _extract_pseudo_elements_content(css)
-        for pe in pseudo_elements:
-            text += pe
-
-        # List of all fonts from @font-face src url: statements. This assumes they're all local files
-        font_urls = _find_font_face_urls(css)
-        for font_url in font_urls:
-            # Only handle local files -- this does not support remote files
-            adjusted_font_path = _get_path(css_file, font_url) # Relative to the CSS file
-            if path.isfile(adjusted_font_path):
-                font_files.add(adjusted_font_path)
-            else:
-                warnings.warn(f"Font file not found (may be remote not local?); skipping: {font_url} (resolved to {adjusted_font_path})")
+        _emit(progress, "css_parsed", css=css_file, fonts=[remote_urls.get(font, font) for font in css_fonts[css_file]],
+              pseudo_chars=len(set(css_pseudo_text[css_file])))
 
     if verbose:
-        print("Found the following CSS files:")
+        _logger.info("Found the following CSS files:")
         for css_file in css_files:
-            print("  " + css_file)
+            _logger.info("  " + css_file)
 
-        print("Found the following fonts:")
+        _logger.info("Found the following fonts:")
         for font_file in font_files:
-            print("  " + font_file)
+            _logger.info("  " + font_file)
+
+        if features:
+            _logger.info("Found these OpenType features turned on in the CSS: " + ", ".join(sorted(features)))
 
     # print("Found the following text:")
     # print(text)
-    
+
+    return {"text": text, "css_files": css_files, "font_files": font_files, "html_css": html_css, "css_fonts": css_fonts,
+            "css_pseudo_text": css_pseudo_text, "page_chars": page_chars, "local_copies": local_copies, "features": features}
+
+# Takes a list of files on disk
+# HTML files are parsed; all others are treated as text
+# First, collect all strings from those files.
+# Then, also parse to get all the CSS files they use. From those CSS files, collect all the fonts they use in @font-face src,
+# plus look for any additional characters that will be reflected in rendered webpage output, such as :before and :after pseudo-elements.
+@_reports_warnings
+@_profiled
+@beartype
+def optimise_fonts_for_files(files : list[str] | Iterator[str], font_output_dir : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True, fonts : Collection[str] | str | None = None, addtl_text : str = "", css_rewriter : Callable[[str, str], None] | None = None, preload_fonts : bool = False, font_display : FontDisplay | None = None, html_rewriter : Callable[[str, str], None] | None = None, max_clusters : int = 1, fetch_remote : bool = False, cache_dir : str = "", offline : bool = False, cache : FontimizeCache | None = None, workers : int = 1, max_memory : int = 0, progress : ProgressCallback | None = None, font_writer : Callable[[str, bytes], None] | None = None, check : bool = False, profile_cpu : str = "", profile_memory : bool = False, trace : str = "", quantize : bool | Collection[str] = False, prune_layout : bool | Collection[str] = False, layout_features : bool | Collection[str] | None = None, rendered_only : bool = False, text_attributes : bool | Collection[str] = False, coverage_index : FontimizeCoverageIndex | None = None, include : Collection[str] | None = None, exclude : Collection[str] = ()) -> FontimizeResult:
+    if fonts is None:
+        fonts = []
+    elif isinstance(fonts, str):
+        fonts = [fonts]
+    # Directories and glob patterns are expanded as they're read
+    files = discover_files(files, include=include, exclude=exclude)
+
+    clustering: bool = max_clusters > 1
+    collected: _CollectedFiles | None = _collect_files(files, fonts, addtl_text, verbose, clustering, fetch_remote,
+                                                       cache_dir, offline, cache, progress, rendered_only, text_attributes)
+    if collected is None:
+        return _empty_result()
+
+    text: str = collected["text"]
+    css_files: set[str] = collected["css_files"]
+    font_files: set[str] = collected["font_files"]
+    html_css: dict[str, list[str]] = collected["html_css"]
+    css_fonts: dict[str, list[str]] = collected["css_fonts"]
+    css_pseudo_text: dict[str, str] = collected["css_pseudo_text"]
+    page_chars: dict[str, set[str]] = collected["page_chars"]
+    local_copies: dict[str, str] = collected["local_copies"]
+    features: set[str] = collected["features"]
+
     if len(font_files) == 0:
-        print("Error: No fonts found in the input files. Exiting.")
-        return {
-            "css": css_files,
-            "fonts": {},
-            "chars": set(),
-            "uranges": "",
-            "rewritten_css": {},
-            "stats": _empty_stats(),
-        }
-
-    res: FontimizeResult = optimise_fonts(text, font_files, fontpath=font_output_dir, subsetname=subsetname, verbose=verbose, print_stats=print_stats)
-    res["css"] = css_files
+        _logger.error("No fonts found in the input files. Exiting.")
+        return _empty_result(css_files)
+
+    if not clustering or len(page_chars) < 2:
+        return _subset_and_rewrite(text, font_files, css_files, html_css, css_fonts, font_output_dir, subsetname,
+                                   verbose, print_stats, css_rewriter, preload_fonts, font_display, html_rewriter,
+                                   local_copies=local_copies, cache=cache, workers=workers, max_memory=max_memory,
+                                   progress=progress, font_writer=font_writer, check=check, quantize=quantize,
+                                   coverage_index=coverage_index, prune_layout=prune_layout, css_features=features,
+                                   layout_features=layout_features)
+
+    # Clustered: each group of similar pages gets its own subsets, containing only the characters
+    # those pages (and the CSS they link) use, plus its own copy of each rewritten CSS file. A font
+    # has several subsets and a CSS file several copies, so they're only listed per cluster, and the
+    # top-level fonts and rewritten_css are left empty; stats lists every subset
+    res: FontimizeResult = _empty_result(css_files)
+    all_chars: set[str] = set()
+    # The cluster texts below are only their pages' characters, so layout is pruned to the pairs in the whole text
+    cluster_prune_layout: bool | Collection[str] = _text_pairs(text) if prune_layout is True else prune_layout
+    for index, pages in enumerate(_cluster_pages(page_chars, max_clusters), start=1):
+        cluster_name: str = f"{subsetname}-{index}"
+        cluster_html_css: dict[str, list[str]] = {p: html_css[p] for p in pages if p in html_css}
+        cluster_css: set[str] = {css for page_css in cluster_html_css.values() for css in page_css} & css_files
+        cluster_fonts: set[str] = set(fonts) | {font for css in cluster_css for font in css_fonts[css]}
+        cluster_text: str = addtl_text + "".join("".join(page_chars[p]) for p in pages) \
+            + "".join(css_pseudo_text[css] for css in cluster_css)
+        if not cluster_fonts:
+            continue
 
-    # Rewrite CSS files to reference the generated .woff2 fonts
-    if font_output_dir and css_files:
-        for css_file in css_files:
-            with open(css_file, 'r') as file:
-                css = file.read()
+        if verbose:
+            _logger.info(f"Cluster {cluster_name}: {len(pages)} pages")
+        cluster_res: FontimizeResult = _subset_and_rewrite(cluster_text, cluster_fonts, cluster_css, cluster_html_css,
+                                                           css_fonts, font_output_dir, cluster_name, verbose, print_stats,
+                                                           css_rewriter, preload_fonts, font_display, html_rewriter,
+                                                           css_suffix=cluster_name, local_copies=local_copies,
+                                                           cache=cache, workers=workers, max_memory=max_memory,
+                                                           progress=progress, font_writer=font_writer, check=check,
+                                                           quantize=quantize, coverage_index=coverage_index,
+                                                           prune_layout=cluster_prune_layout, css_features=features,
+                                                           layout_features=layout_features)
+        res["clusters"].append({
+            "name": cluster_name,
+            "pages": pages,
+            "chars": cluster_res["chars"],
+            "uranges": cluster_res["uranges"],
+            "fonts": cluster_res["fonts"],
+            "rewritten_css": cluster_res["rewritten_css"],
+            "stats": cluster_res["stats"],
+        })
+        res["preloads"].update(cluster_res["preloads"])
+        res["plan"].update(cluster_res["plan"])
+        for font, uncovered in cluster_res["uncovered"].items():
+            res["uncovered"].setdefault(font, set()).update(uncovered)
+        all_chars |= cluster_res["chars"]
+
+    res["chars"] = all_chars
+    res["uranges"] = ', '.join(r.get_range() for r in _get_char_ranges(list(all_chars)))
+    res["stats"] = _sum_stats([c["stats"] for c in res["clusters"]])
+    return res
+
+
+
+class FontimizeSummary(TypedDict):
+    """The characters, fonts and stylesheets some input files need, from collect_summary. Summaries for
+    different parts of a site are combined with merge_summaries, then subset with optimise_fonts_for_summary."""
+    chars: set[str]
+    fonts: list[str]
+    css_fonts: dict[str, list[str]]
+    html_css: dict[str, list[str]]
+    features: set[str] # OpenType features the CSS turns on
 
-            output_path, rewritten = _rewrite_css(css_file, css, res["fonts"], font_output_dir)
+# Version of the summary file format written by save_summary
+_SUMMARY_VERSION: int = 2
 
-            if css_rewriter is not None:
-                css_rewriter(output_path, rewritten)
+# The collect stage of a sharded build: reads the input files and the CSS they use, like
+# optimise_fonts_for_files, but only records what they need instead of subsetting any fonts
+@beartype
+def collect_summary(files : list[str] | Iterator[str], fonts : Collection[str] | str | None = None, addtl_text : str = "", verbose : bool = False, fetch_remote : bool = False, cache_dir : str = "", offline : bool = False, cache : FontimizeCache | None = None, progress : ProgressCallback | None = None, rendered_only : bool = False, text_attributes : bool | Collection[str] = False, include : Collection[str] | None = None, exclude : Collection[str] = ()) -> FontimizeSummary:
+    if fonts is None:
+        fonts = []
+    elif isinstance(fonts, str):
+        fonts = [fonts]
+    files = discover_files(files, include=include, exclude=exclude)
+
+    collected: _CollectedFiles | None = _collect_files(files, fonts, addtl_text, verbose, False, fetch_remote,
+                                                       cache_dir, offline, cache, progress, rendered_only, text_attributes)
+    if collected is None:
+        return {"chars": set(), "fonts": [], "css_fonts": {}, "html_css": {}, "features": set()}
+
+    # Remote files are recorded by URL, since the downloaded copies are only on this machine
+    remote_urls: dict[str, str] = {local_path: url for url, local_path in collected["local_copies"].items()}
+    return {
+        "chars": set(collected["text"]),
+        "fonts": sorted(remote_urls.get(font, font) for font in collected["font_files"]),
+        "css_fonts": {css: [remote_urls.get(font, font) for font in css_fonts]
+                      for css, css_fonts in sorted(collected["css_fonts"].items())},
+        "html_css": dict(sorted(collected["html_css"].items())),
+        "features": collected["features"],
+    }
+
+# The merge stage of a sharded build: combines the summaries of each shard into one
+@beartype
+def merge_summaries(summaries : Iterable[FontimizeSummary]) -> FontimizeSummary:
+    merged: FontimizeSummary = {"chars": set(), "fonts": [], "css_fonts": {}, "html_css": {}, "features": set()}
+    fonts: set[str] = set()
+    for summary in summaries:
+        merged["chars"] |= summary["chars"]
+        fonts.update(summary["fonts"])
+        for css, css_fonts in summary["css_fonts"].items():
+            merged_fonts: list[str] = merged["css_fonts"].setdefault(css, [])
+            merged_fonts.extend(font for font in css_fonts if font not in merged_fonts)
+        merged["html_css"].update(summary["html_css"])
+        merged["features"] |= summary["features"]
+    merged["fonts"] = sorted(fonts)
+    merged["css_fonts"] = dict(sorted(merged["css_fonts"].items()))
+    merged["html_css"] = dict(sorted(merged["html_css"].items()))
+    return merged
+
+@beartype
+def save_summary(summary : FontimizeSummary, summary_file : str) -> None:
+    """Write a summary to a JSON file, for merge_summaries or optimise_fonts_for_summary to use elsewhere."""
+    with open(summary_file, 'w', encoding='utf-8') as file:
+        json.dump({"version": _SUMMARY_VERSION, "chars": "".join(sorted(summary["chars"])), "fonts": summary["fonts"],
+                   "css_fonts": summary["css_fonts"], "html_css": summary["html_css"], "features": sorted(summary["features"])},
+                  file, ensure_ascii=False, indent=1)
+
+@beartype
+def load_summary(summary_file : str) -> FontimizeSummary:
+    """Read a summary written by save_summary."""
+    with open(summary_file, 'r', encoding='utf-8') as file:
+        contents: Any = json.load(file)
+    if not isinstance(contents, dict) or contents.get("version") != _SUMMARY_VERSION:
+        raise ValueError(f"'{summary_file}' is not a Fontimize summary file (version {_SUMMARY_VERSION})")
+    return {"chars": set(contents["chars"]), "fonts": list(contents["fonts"]),
+            "css_fonts": dict(contents["css_fonts"]), "html_css": dict(contents["html_css"]), "features": set(contents["features"])}
+
+# The subset stage of a sharded build: generates the fonts, and rewrites the CSS, for a (usually merged)
+# summary. This is the second half of optimise_fonts_for_files, and takes the same options
+@_reports_warnings
+@_profiled
+@beartype
+def optimise_fonts_for_summary(summary : FontimizeSummary, font_output_dir : str = "", subsetname : str = "FontimizeSubset", verbose : bool = False, print_stats : bool = True, css_rewriter : Callable[[str, str], None] | None = None, preload_fonts : bool = False, font_display : FontDisplay | None = None, html_rewriter : Callable[[str, str], None] | None = None, fetch_remote : bool = False, cache_dir : str = "", offline : bool = False, cache : FontimizeCache | None = None, workers : int = 1, max_memory : int = 0, progress : ProgressCallback | None = None, font_writer : Callable[[str, bytes], None] | None = None, check : bool = False, profile_cpu : str = "", profile_memory : bool = False, trace : str = "", quantize : bool | Collection[str] = False, layout_features : bool | Collection[str] | None = None, coverage_index : FontimizeCoverageIndex | None = None) -> FontimizeResult:
+    css_files: set[str] = set(summary["css_fonts"])
+
+    # Remote stylesheets and fonts are downloaded again here (or found in the cache), since the
+    # shard that collected them may have been a different machine
+    remote: list[str] = sorted(url for url in css_files | set(summary["fonts"]) if _is_remote(url))
+    local_copies: dict[str, str] = {}
+    if remote and fetch_remote:
+        fetcher: _RemoteFetcher = _RemoteFetcher(cache_dir, offline)
+        local_copies = {url: local_path for url, local_path in fetcher.fetch_all(remote).items() if local_path is not None}
+        fetcher.close()
+    for url in remote:
+        if url not in local_copies:
+            if not fetch_remote:
+                _warn(f"File is remote; skipping (use fetch_remote to download it): {url}")
+            css_files.discard(url)
+
+    def local(fonts: list[str]) -> list[str]:
+        return [local_copies.get(font, font) for font in fonts if not _is_remote(font) or font in local_copies]
+    font_files: set[str] = set(local(summary["fonts"]))
+    css_fonts: dict[str, list[str]] = {css: local(fonts) for css, fonts in summary["css_fonts"].items() if css in css_files}
+
+    # Preload hints are added to the pages this machine has; a shard's pages may only be on that shard
+    html_css: dict[str, list[str]] = {}
+    if preload_fonts:
+        for html_file, page_css in summary["html_css"].items():
+            if path.isfile(html_file):
+                html_css[html_file] = [css for css in page_css if css in css_files]
             else:
-                with open(output_path, 'w') as file:
-                    file.write(rewritten)
+                _warn(f"HTML file not found, so no preload hints were added to it: {html_file}")
+
+    if len(font_files) == 0:
+        _logger.error("No fonts found in the summary. Exiting.")
+        return _empty_result(css_files)
+
+    return _subset_and_rewrite("".join(sorted(summary["chars"])), font_files, css_files, html_css, css_fonts,
+                               font_output_dir, subsetname, verbose, print_stats, css_rewriter, preload_fonts,
+                               font_display, html_rewriter, local_copies=local_copies, cache=cache, workers=workers,
+                               max_memory=max_memory, progress=progress, font_writer=font_writer, check=check,
+                               quantize=quantize, coverage_index=coverage_index, css_features=summary["features"],
+                               layout_features=layout_features)
+
+class FontimizeBatchResult(TypedDict):
+    """Result dictionary returned by optimise_fonts_batch."""
+    results: dict[str, FontimizeResult]
+    skipped: list[str]
+    failed: dict[str, str]
+
+# Keys a batch job may contain: the optimise_fonts_for_files parameters, plus a name
+_BATCH_JOB_KEYS: set[str] = {'name', 'files', 'include', 'exclude', 'font_output_dir', 'subsetname', 'fonts',
+                             'addtl_text', 'preload_fonts', 'font_display', 'max_clusters', 'fetch_remote',
+                             'cache_dir', 'offline', 'quantize', 'prune_layout', 'layout_features', 'rendered_only',
+                             'text_attributes'}
+
+@beartype
+def _batch_job_hash(job: dict[str, Any]) -> str:
+    """Identify a job's settings, so a checkpoint is only trusted for a job that hasn't changed."""
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+
+@beartype
+def _write_checkpoint(checkpoint: str, completed: dict[str, str]) -> None:
+    # Written to a temporary file and renamed, so an interrupted run never leaves a half-written checkpoint
+    temp_path: str = checkpoint + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump({"completed": completed}, file, indent=2)
+    os.replace(temp_path, checkpoint)
+
+@beartype
+def _run_batch_job(job: dict[str, Any], verbose: bool, print_stats: bool, cache: FontimizeCache, progress: ProgressCallback | None,
+                   coverage_index: FontimizeCoverageIndex) -> FontimizeResult:
+    options: dict[str, Any] = {k: v for k, v in job.items() if k not in ('name', 'files')}
+    return optimise_fonts_for_files(job.get('files', []),
+                                    verbose=verbose, print_stats=print_stats, cache=cache, progress=progress,
+                                    coverage_index=coverage_index, **options)
+
+# Reads a JSON or TOML batch job file into a list of jobs for optimise_fonts_batch
+@beartype
+def load_batch_jobs(job_file : str) -> list[dict[str, Any]]:
+    """Load the jobs from a batch job file.
+
+    The file contains a list of jobs, and optionally defaults applied to every job, eg in JSON:
+    {"defaults": {"fonts": ["brand.ttf"]}, "jobs": [{"name": "shop", "files": ["shop/"], "font_output_dir": "shop/fonts"}]}
+    A TOML file (.toml, which needs Python 3.11 or the tomli package) has a [defaults] table and [[jobs]] entries.
+    A JSON file may also be just the list of jobs.
+    """
+    if job_file.lower().endswith('.toml'):
+        try:
+            if sys.version_info >= (3, 11):
+                import tomllib as toml_module
+            else:
+                import tomli as toml_module # type: ignore[import-not-found]
+        except ImportError:
+            raise ValueError("Reading TOML job files needs Python 3.11 or later, or the tomli package")
+        with open(job_file, 'rb') as file:
+            contents: Any = toml_module.load(file)
+    else:
+        with open(job_file, 'r') as file:
+            contents = json.load(file)
+
+    if isinstance(contents, list):
+        contents = {"jobs": contents}
+    if not isinstance(contents, dict) or not isinstance(contents.get("jobs"), list):
+        raise ValueError(f"Job file '{job_file}' must contain a list of jobs")
+    defaults = contents.get("defaults", {})
+    if not isinstance(defaults, dict):
+        raise ValueError(f"Job file '{job_file}': defaults must be a table of job settings")
+
+    jobs: list[dict[str, Any]] = []
+    for job in contents["jobs"]:
+        if not isinstance(job, dict):
+            raise ValueError(f"Job file '{job_file}': each job must be a table of job settings")
+        jobs.append({**defaults, **job})
+    return jobs
+
+# Runs many optimise_fonts_for_files jobs in one process, sharing cached fonts and stylesheets between
+# them, and optionally records each completed job so an interrupted batch can carry on where it left off
+@beartype
+def optimise_fonts_batch(jobs : list[dict[str, Any]], checkpoint : str = "", restart : bool = False, workers : int = 1, verbose : bool = False, print_stats : bool = True, cache : FontimizeCache | None = None, progress : ProgressCallback | None = None, coverage_index : FontimizeCoverageIndex | None = None) -> FontimizeBatchResult:
+    """Run each job, a dict of optimise_fonts_for_files arguments, and return their results by job name.
+
+    Jobs are named by their 'name' key, or 'job-1', 'job-2' etc by position. If checkpoint is a file path,
+    each job is recorded there once it completes; running the same batch again skips those jobs (unless
+    their settings changed, or restart is True). The checkpoint is deleted once every job has succeeded.
+    A job that raises an exception is reported in 'failed' and the other jobs still run.
+    Up to workers jobs run at once. Progress events from each job have a 'job' key with its name.
+    """
+    if cache is None:
+        cache = FontimizeCache()
+    if coverage_index is None:
+        coverage_index = FontimizeCoverageIndex()
+
+    named_jobs: dict[str, dict[str, Any]] = {}
+    for index, job in enumerate(jobs, start=1):
+        unknown: set[str] = set(job) - _BATCH_JOB_KEYS
+        if unknown:
+            raise ValueError(f"Unknown settings in batch job {index}: {', '.join(sorted(unknown))}")
+        name: str = str(job.get('name', f"job-{index}"))
+        if name in named_jobs:
+            raise ValueError(f"Two batch jobs are named '{name}'")
+        named_jobs[name] = job
+
+    completed: dict[str, str] = {} # job name -> job hash
+    if checkpoint and not restart and path.isfile(checkpoint):
+        try:
+            with open(checkpoint, 'r') as file:
+                completed = dict(json.load(file).get("completed", {}))
+        except (OSError, ValueError, AttributeError) as e:
+            _warn(f"Could not read batch checkpoint; running all jobs: {checkpoint} ({e})")
+
+    res: FontimizeBatchResult = {"results": {}, "skipped": [], "failed": {}}
+    pending: list[str] = []
+    for name, job in named_jobs.items():
+        if completed.get(name) == _batch_job_hash(job):
+            res["skipped"].append(name)
+            if verbose:
+                _logger.info(f"Skipping job {name}: already completed")
+            _emit(progress, "job_skipped", job=name)
+        else:
+            pending.append(name)
+    # Forget jobs that are no longer in the batch, or whose settings changed
+    completed = {name: completed[name] for name in res["skipped"]}
+
+    lock: threading.Lock = threading.Lock()
+
+    def run(name: str) -> None:
+        if verbose:
+            _logger.info(f"Running job {name}")
+        job_progress: ProgressCallback | None = None
+        if progress is not None:
+            def job_progress(event: dict[str, Any]) -> None:
+                progress({**event, "job": name})
+        try:
+            result: FontimizeResult = _run_batch_job(named_jobs[name], verbose, print_stats, cache, job_progress, coverage_index)
+        except Exception as e:
+            _logger.error(f"Batch job '{name}' failed: {e}")
+            with lock:
+                res["failed"][name] = str(e)
+            _emit(progress, "job_failed", job=name, error=str(e))
+            return
+        with lock:
+            res["results"][name] = result
+            completed[name] = _batch_job_hash(named_jobs[name])
+            if checkpoint:
+                _write_checkpoint(checkpoint, completed)
+        _emit(progress, "job_finished", job=name)
+
+    if workers > 1 and len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run, pending))
+    else:
+        for name in pending:
+            run(name)
+
+    if checkpoint and not res["failed"] and path.isfile(checkpoint):
+        os.remove(checkpoint)
 
-            res["rewritten_css"][css_file] = output_path
+    if verbose or print_stats:
+        _logger.info(f"Batch: {len(res['results'])} jobs run, {len(res['skipped'])} skipped as already completed, {len(res['failed'])} failed")
 
     return res
 
 
+@_hot_path_beartype
+def _parse_uranges(uranges: str) -> set[str]:
+    """Parse a Unicode ranges string like 'U+0041-005A, U+0061' (as in FontimizeResult's uranges) into characters.
+
+    The '+' may also be a space, as it is when a URL query string containing 'U+' is decoded.
+    """
+    chars: set[str] = set()
+    for part in uranges.split(','):
+        part = re.sub(r'^U[+ ]?', '', part.strip().upper())
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        chars.update(chr(cp) for cp in range(int(first, 16), int(last or first, 16) + 1))
+    return chars
+
+class _SubsetService:
+    """The state behind the subsetting server: the fonts it serves, its caches, and its metrics."""
+
+    _LATENCY_SAMPLES: int = 1000
+
+    def __init__(self, fonts: dict[str, str], max_fonts: int, max_responses: int) -> None:
+        self.fonts: dict[str, str] = fonts # font identifier -> font file
+        self.font_cache: FontimizeCache = FontimizeCache(max_fonts)
+        self.max_responses: int = max(1, max_responses)
+        self._responses: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self.requests: int = 0
+        self.errors: int = 0
+        self.response_hits: int = 0
+        self._latencies: list[float] = []
+
+    def subset(self, font_id: str, characters: set[str]) -> tuple[bytes, str, bool]:
+        """Return (WOFF2 data, ETag, whether it came from the response cache) for a subset of a font."""
+        chars_hash: str = hashlib.sha256("".join(sorted(characters)).encode('utf-8', 'surrogatepass')).hexdigest()
+        key: tuple[str, str] = (font_id, chars_hash)
+        with self._lock:
+            data: bytes | None = self._responses.get(key)
+            if data is not None:
+                self._responses.move_to_end(key)
+                self.response_hits += 1
+                return (data, chars_hash[:32], True)
+
+        tt_font: TTFont = self.font_cache.open_font(self.fonts[font_id])
+        _subset_font(tt_font, characters)
+        data = _save_woff2(tt_font)
+
+        with self._lock:
+            self._responses[key] = data
+            while len(self._responses) > self.max_responses:
+                self._responses.popitem(last=False)
+        return (data, chars_hash[:32], False)
+
+    def record(self, seconds: float, error: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self._latencies.append(seconds)
+            if len(self._latencies) > self._LATENCY_SAMPLES:
+                del self._latencies[0]
+
+    def metrics(self) -> dict[str, object]:
+        with self._lock:
+            latencies: list[float] = sorted(self._latencies)
+            subset_requests: int = self.requests - self.errors
+
+            def percentile(p: float) -> float:
+                return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2) if latencies else 0.0
+
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "response_cache_hits": self.response_hits,
+                "response_cache_hit_rate": round(self.response_hits / subset_requests, 3) if subset_requests else 0.0,
+                "response_cache_entries": len(self._responses),
+                "font_cache_hits": self.font_cache.hits,
+                "font_cache_misses": self.font_cache.misses,
+                "latency_ms": {
+                    "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+                    "p50": percentile(0.5),
+                    "p95": percentile(0.95),
+                    "max": percentile(1.0),
+                },
+            }
+
+# The server's classes derive from http.server's, which is only imported once a server is made
+@functools.cache
+def _server_class() -> type:
+    import socket
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class _SubsetRequestHandler(BaseHTTPRequestHandler):
+        """Handles requests to the subsetting server:
+
+            GET  /subset?font=<id>&text=<text>        subset containing the characters in text
+            GET  /subset?font=<id>&chars=U+0041-005A  subset containing the characters in the Unicode ranges
+            POST /subset?font=<id>                    subset containing the characters in the UTF-8 request body
+            GET  /fonts                               JSON list of the font identifiers served
+            GET  /metrics                             JSON request, cache and latency metrics
+        """
+
+        server: "FontimizeServer"
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self) -> None:
+            # A kept-alive connection holds a worker while it's open, so an idle one is closed after
+            # keep_alive_timeout seconds and the worker can serve other clients
+            super().setup()
+            self.connection.settimeout(self.server.keep_alive_timeout)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass # Metrics are available from /metrics instead of a log line per request
+
+        def _send(self, status: int, content_type: str, body: bytes, headers: dict[str, str] | None = None) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status: int, value: object) -> None:
+            self._send(status, 'application/json', json.dumps(value).encode('utf-8'))
+
+        def _handle_subset(self, body_text: str | None) -> None:
+            service: _SubsetService = self.server.service
+            started: float = time.perf_counter()
+            params: dict[str, list[str]] = parse_qs(urlsplit(self.path).query)
+            font_id: str = params.get('font', [''])[0]
+            text: str = body_text if body_text is not None else params.get('text', [''])[0]
+
+            # Metrics are recorded before the response is sent, so a client sees its own request in /metrics
+            if font_id not in service.fonts:
+                service.record(time.perf_counter() - started, error=True)
+                self._send_json(404, {"error": f"Unknown font '{font_id}'", "fonts": sorted(service.fonts)})
+                return
+            try:
+                characters: set[str] = get_used_characters_in_str(text) | _parse_uranges(params.get('chars', [''])[0])
+            except ValueError:
+                service.record(time.perf_counter() - started, error=True)
+                self._send_json(400, {"error": "chars must be Unicode ranges, eg U+0041-005A,U+0061"})
+                return
+            try:
+                data, etag, hit = service.subset(font_id, characters)
+            except Exception as e:
+                service.record(time.perf_counter() - started, error=True)
+                self._send_json(500, {"error": f"Could not subset font '{font_id}': {e}"})
+                return
+            service.record(time.perf_counter() - started, error=False)
+            self._send(200, 'font/woff2', data, {'ETag': f'"{etag}"', 'X-Fontimize-Cache': 'hit' if hit else 'miss',
+                                                  'Access-Control-Allow-Origin': '*'})
+
+        def do_GET(self) -> None:
+            route: str = urlsplit(self.path).path
+            if route == '/subset':
+                self._handle_subset(None)
+            elif route == '/fonts':
+                self._send_json(200, sorted(self.server.service.fonts))
+            elif route == '/metrics':
+                self._send_json(200, self.server.service.metrics())
+            else:
+                self._send_json(404, {"error": "Not found"})
+
+        def do_POST(self) -> None:
+            if urlsplit(self.path).path != '/subset':
+                self._send_json(404, {"error": "Not found"})
+                return
+            try:
+                length: int = int(self.headers.get('Content-Length') or 0)
+                body_text: str = self.rfile.read(length).decode('utf-8')
+            except (ValueError, UnicodeDecodeError):
+                self.server.service.record(0.0, error=True)
+                self.close_connection = True # The rest of the body may still be unread
+                self._send_json(400, {"error": "The request body must be UTF-8 text, with a Content-Length"})
+                return
+            self._handle_subset(body_text)
+
+    class FontimizeServer(HTTPServer):
+        """HTTP server that returns WOFF2 subsets of fonts on demand; see make_subset_server."""
+
+        def __init__(self, address: tuple[str, int], service: _SubsetService, workers: int, keep_alive_timeout: float) -> None:
+            super().__init__(address, _SubsetRequestHandler)
+            self.service: _SubsetService = service
+            self.keep_alive_timeout: float = keep_alive_timeout
+            self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max(1, workers))
+            self._connections: dict[socket.socket, Future[None]] = {} # Open connections, so closing the server can close them
+            self._connections_lock: threading.Lock = threading.Lock()
+
+        # Connections are handled by a fixed pool of worker threads, rather than socketserver's
+        # default of one at a time (or ThreadingMixIn's unbounded thread per connection)
+        def process_request(self, request: socket.socket | tuple[bytes, socket.socket], client_address: Any) -> None:
+            assert isinstance(request, socket.socket) # A stream server's requests are connected sockets
+            with self._connections_lock:
+                self._connections[request] = self._executor.submit(self._process_request_in_worker, request, client_address)
+
+        def _process_request_in_worker(self, request: socket.socket, client_address: Any) -> None:
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._connections_lock:
+                    self._connections.pop(request, None)
+                self.shutdown_request(request)
+
+        def server_close(self) -> None:
+            super().server_close()
+            # Don't wait for idle kept-alive connections: shutting their sockets down ends the
+            # workers' reads straight away, and connections still queued for a worker are closed
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            with self._connections_lock:
+                connections: list[tuple[socket.socket, Future[None]]] = list(self._connections.items())
+            for connection, future in connections:
+                if future.cancelled():
+                    connection.close()
+                else:
+                    with contextlib.suppress(OSError):
+                        connection.shutdown(socket.SHUT_RDWR)
+
+    return FontimizeServer
+
+# Creates a local HTTP server that subsets fonts on demand
+@beartype
+def make_subset_server(fonts : Collection[str] | str, host : str = "127.0.0.1", port : int = 8000, workers : int = 4, max_fonts : int = 16, max_responses : int = 256, keep_alive_timeout : float = 5.0) -> 'http.server.HTTPServer':
+    """Create a server returning WOFF2 subsets of the given fonts; call serve_forever() on it to run it.
+
+    Each font is identified by its file name without the extension, eg 'Arial' for 'fonts/Arial.ttf'.
+    Fonts are kept in memory between requests (up to max_fonts of them), and the most recent
+    max_responses subsets are cached by font and character set, so repeat requests cost nothing.
+    Up to workers connections are served at once; a kept-alive connection that is idle for
+    keep_alive_timeout seconds is closed, freeing its worker. Use port 0 to pick any free port.
+    """
+    if isinstance(fonts, str):
+        fonts = [fonts]
+    font_ids: dict[str, str] = {}
+    for font in fonts:
+        font_id: str = os.path.splitext(os.path.basename(font))[0]
+        if font_id in font_ids:
+            raise ValueError(f"Two fonts have the same name '{font_id}': {font_ids[font_id]} and {font}")
+        font_ids[font_id] = font
+    server: 'http.server.HTTPServer' = _server_class()((host, port), _SubsetService(font_ids, max_fonts, max_responses), workers, keep_alive_timeout)
+    return server
+
+
+# Command line for 'fontimize.py serve ...'
+def _serve_main(argv: list[str]) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="fontimize.py serve",
+        description="Run a local HTTP server that returns WOFF2 font subsets on demand",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Requests:
+    GET  /subset?font=Arial&text=Hello          Subset containing the characters in text
+    GET  /subset?font=Arial&chars=U+0041-005A   Subset containing the characters in the Unicode ranges
+    POST /subset?font=Arial                     Subset containing the characters in the UTF-8 request body
+    GET  /fonts                                 Font identifiers (file names without extension)
+    GET  /metrics                               Request counts, cache hit rates and latency
+
+Example:
+    fontimize.py serve --port 8000 --fonts fonts/Arial.ttf fonts/Garamond.ttf
+                """)
+    parser.add_argument('-f', '--fonts', nargs='+', required=True, help='Font files to serve subsets of')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default 8000)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of requests processed at once (default 4)')
+    parser.add_argument('--max-fonts', type=int, default=16, dest='max_fonts', help='Number of fonts kept in memory (default 16)')
+    parser.add_argument('--max-responses', type=int, default=256, dest='max_responses', help='Number of subsets cached (default 256)')
+    args = parser.parse_args(argv)
+
+    for file in args.fonts:
+        if not os.path.exists(file):
+            print(f"Error: Font file '{file}' does not exist.")
+            sys.exit(1)
+
+    try:
+        server: 'http.server.HTTPServer' = make_subset_server(args.fonts, args.host, args.port, args.workers, args.max_fonts, args.max_responses)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    print(f"Serving font subsets on http://{args.host}:{server.server_address[1]}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Parses a memory size such as 512M or 2G (or a plain number of bytes) for --max-memory
+def _parse_memory_size(value: str) -> int:
+    import argparse
+
+    match: re.Match[str] | None = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*', value, re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a memory size, eg 512M or 2G")
+    multiplier: int = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}[match.group(2).upper()]
+    return int(float(match.group(1)) * multiplier)
+
+class _CliLogFormatter(logging.Formatter):
+    """Formats the library's log messages for the command line, marking errors as such."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message: str = record.getMessage()
+        return f"Error: {message}" if record.levelno >= logging.ERROR else message
+
+# The command line prints what the library logs, ie the progress and stats asked for with verbose and print_stats
+def _log_to_stdout() -> None:
+    handler: logging.StreamHandler = logging.StreamHandler(sys.stdout) # type: ignore
+    handler.setFormatter(_CliLogFormatter())
+    _logger.addHandler(handler)
+    _logger.setLevel(logging.INFO)
+
+# Converts the --quantize argument: absent means off, given without blocks means the default blocks
+def _quantize_arg(parser: Any, blocks: list[str] | None) -> bool | list[str]:
+    if blocks is None:
+        return False
+    if not blocks:
+        return True
+    try:
+        quantize_characters(set(), blocks)
+    except ValueError as e:
+        parser.error(str(e))
+    return blocks
+
+# Converts the --layout-features argument: absent means fontTools' defaults, given without tags means the ones the CSS needs
+def _layout_features_arg(features: list[str] | None) -> bool | list[str] | None:
+    if features is None:
+        return None
+    return features or True
+
+# Converts the --text-attributes argument in the same way: absent means none, given without names means the default ones
+def _text_attributes_arg(attributes: list[str] | None) -> bool | list[str]:
+    if attributes is None:
+        return False
+    return attributes or True
+
+
+# Converts a FontimizeResult into values json.dumps() accepts, for --json output
+def _json_result(res: FontimizeResult) -> dict[str, object]:
+    return {
+        "css": sorted(res["css"]),
+        "fonts": res["fonts"],
+        "chars": sorted(res["chars"]),
+        "uranges": res["uranges"],
+        "rewritten_css": res["rewritten_css"],
+        "preloads": res["preloads"],
+        "stats": res["stats"],
+        "clusters": [{**c, "chars": sorted(c["chars"])} for c in res["clusters"]],
+        "plan": res["plan"],
+        "profile": res["profile"],
+        "uncovered": {font: sorted(chars) for font, chars in res["uncovered"].items()},
+        "warnings": res["warnings"],
+    }
+
+
+# Command line for 'fontimize.py batch ...'
+def _batch_main(argv: list[str]) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="fontimize.py batch",
+        description="Run many Fontimize jobs listed in a JSON or TOML job file, in one process",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Each job takes the same settings as optimise_fonts_for_files(): files (files, directories or glob
+patterns), include, exclude, fonts, addtl_text, font_output_dir, subsetname, preload_fonts,
+font_display, max_clusters, fetch_remote, cache_dir and offline, plus an optional name. Settings
+in a 'defaults' table apply to every job. For example, jobs.json:
+
+    {"defaults": {"fonts": ["brand/Brand.ttf"]},
+     "jobs": [{"name": "shop", "files": ["sites/shop"], "font_output_dir": "sites/shop/fonts"},
+              {"name": "blog", "files": ["sites/blog"], "font_output_dir": "sites/blog/fonts"}]}
+
+Completed jobs are recorded in a checkpoint file, so if the batch is interrupted, running it again
+carries on from where it stopped. The checkpoint is deleted when every job has succeeded.
+
+Examples:
+    fontimize.py batch jobs.json
+    fontimize.py batch --workers 4 --checkpoint nightly.checkpoint jobs.toml
+                """)
+    parser.add_argument('jobfile', help='JSON or TOML (.toml) file listing the jobs')
+    parser.add_argument('--checkpoint', default=None, help='File recording completed jobs (default: the job file name plus .checkpoint)')
+    parser.add_argument('--restart', action='store_true', help='Run every job, ignoring jobs recorded as completed by an earlier run')
+    parser.add_argument('--workers', type=int, default=1, help='Number of jobs run at once (default 1)')
+    parser.add_argument('--coverage-index', type=str, default="", dest='coverage_index', metavar='FILE', help='Keep the characters each font has glyphs for in this file, so fonts are only indexed once across runs')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Output significant / diagnostic info for each job')
+    parser.add_argument('-n', '--nostats', action='store_true', help='Do not output info about the sizes of the original and generated fonts')
+    parser.add_argument('--json', action='store_true', dest='json_output', help='Print the results of each job as JSON to stdout; suppresses all other output')
+    args = parser.parse_args(argv)
+
+    # --json suppresses human-readable output, and warnings, which are in each job's result instead
+    if args.json_output:
+        args.nostats = True
+        args.verbose = False
+        warnings.simplefilter('ignore')
+
+    if not os.path.exists(args.jobfile):
+        print(f"Error: Job file '{args.jobfile}' does not exist.")
+        sys.exit(1)
+
+    try:
+        jobs: list[dict[str, Any]] = load_batch_jobs(args.jobfile)
+        res: FontimizeBatchResult = optimise_fonts_batch(
+            jobs,
+            checkpoint=args.checkpoint if args.checkpoint is not None else args.jobfile + '.checkpoint',
+            restart=args.restart,
+            workers=args.workers,
+            verbose=args.verbose,
+            print_stats=not args.nostats,
+            coverage_index=FontimizeCoverageIndex(args.coverage_index),
+        )
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    if args.json_output:
+        print(json.dumps({
+            "results": {name: _json_result(r) for name, r in res["results"].items()},
+            "skipped": res["skipped"],
+            "failed": res["failed"],
+        }, indent=2))
+
+    if res["failed"]:
+        sys.exit(1)
+
+
+
+# Command line for 'fontimize.py collect ...', the first stage of a sharded build
+def _collect_main(argv: list[str]) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="fontimize.py collect",
+        description="Find the characters, fonts and CSS that some input files use, and write them to a summary file instead of subsetting",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+A sharded build runs 'collect' on each shard's pages, 'merge' on the summary files, and then
+'subset' once on the merged summary, so fonts are subset for the characters of every page.
+
+Examples:
+    fontimize.py collect -o shard1.json site/en
+    fontimize.py merge -o site.json shard1.json shard2.json
+    fontimize.py subset --outputdir site/fonts site.json
+                """)
+    parser.add_argument('inputfiles', default=[], nargs='*', help='Input files, directories or glob patterns, as for a normal run')
+    parser.add_argument('-o', '--output', required=True, help='Summary file to write')
+    parser.add_argument('--include', default=[], nargs='*', metavar='PATTERN', help='Which files to use from input directories (default: *.html *.htm)')
+    parser.add_argument('--exclude', default=[], nargs='*', metavar='PATTERN', help='Skip files and directories matching these patterns')
+    parser.add_argument('-t', '--text', type=str, default="", help='Additional text to include')
+    parser.add_argument('-f', '--fonts', default=[], nargs='*', help='Additional font files')
+    parser.add_argument('--rendered-only', action='store_true', dest='rendered_only', help='Leave out the text of HTML elements that are never rendered, eg noscript')
+    parser.add_argument('--text-attributes', default=None, nargs='*', dest='text_attributes', metavar='ATTRIBUTE',
+                        help='Include the values of these HTML attributes, eg alt (default alt, title, placeholder and aria-label if none given)')
+    parser.add_argument('--fetch-remote', action='store_true', dest='fetch_remote', help='Download remote stylesheets to find the fonts they use')
+    parser.add_argument('--cache-dir', type=str, default="", dest='cache_dir', help='Directory in which to cache downloaded files (default ~/.cache/fontimize)')
+    parser.add_argument('--offline', action='store_true', help='Only use previously downloaded files from the cache')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Output the CSS files and fonts found')
+    args = parser.parse_args(argv)
+
+    if not args.text and not args.inputfiles:
+        print("Error: Either --text or input files must be specified.")
+        sys.exit(1)
+    for file in args.inputfiles:
+        if not glob.has_magic(file) and not os.path.exists(file):
+            print(f"Error: Input file '{file}' does not exist.")
+            sys.exit(1)
+
+    summary: FontimizeSummary = collect_summary(
+        discover_files(args.inputfiles, include=args.include, exclude=args.exclude),
+        fonts=args.fonts,
+        addtl_text=args.text,
+        verbose=args.verbose,
+        fetch_remote=args.fetch_remote or args.offline,
+        cache_dir=args.cache_dir,
+        offline=args.offline,
+        rendered_only=args.rendered_only,
+        text_attributes=_text_attributes_arg(args.text_attributes),
+    )
+    save_summary(summary, args.output)
+    if args.verbose:
+        print(f"Wrote {args.output}: {len(summary['chars'])} characters, {len(summary['fonts'])} fonts")
+
+
+# Command line for 'fontimize.py merge ...', which combines the summaries written by 'collect'
+def _merge_main(argv: list[str]) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="fontimize.py merge",
+        description="Combine summary files written by 'fontimize.py collect' into one")
+    parser.add_argument('summaries', nargs='+', help='Summary files to combine')
+    parser.add_argument('-o', '--output', required=True, help='Merged summary file to write')
+    args = parser.parse_args(argv)
+
+    try:
+        summary: FontimizeSummary = merge_summaries(load_summary(file) for file in args.summaries)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    save_summary(summary, args.output)
+
+
+# Command line for 'fontimize.py subset ...', the last stage of a sharded build
+def _subset_main(argv: list[str]) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="fontimize.py subset",
+        description="Generate font subsets, and rewrite CSS, for a summary file written by 'fontimize.py collect' or 'merge'")
+    parser.add_argument('summary', help='Summary file')
+    parser.add_argument('-o', '--outputdir', type=str, default="", help='Directory in which to place the generated font files and rewritten CSS (default is the same directory as the original font files)')
+    parser.add_argument('-s', '--subsetname', type=str, default="FontimizeSubset", help="Phrase used in the output font filenames, eg 'Arial.SubsetName.woff2'")
+    parser.add_argument('--preload', action='store_true', help='Add <link rel="preload"> hints to the HTML files in the summary that are present here (requires --outputdir)')
+    parser.add_argument('--font-display', type=str, choices=['auto', 'block', 'swap', 'fallback', 'optional'], default=None, dest='font_display',
+                        help='Add this font-display value to the rewritten @font-face rules (requires --outputdir)')
+    parser.add_argument('--fetch-remote', action='store_true', dest='fetch_remote', help='Download remote stylesheets and fonts in the summary')
+    parser.add_argument('--cache-dir', type=str, default="", dest='cache_dir', help='Directory in which to cache downloaded files (default ~/.cache/fontimize)')
+    parser.add_argument('--offline', action='store_true', help='Only use previously downloaded files from the cache')
+    parser.add_argument('--workers', type=int, default=1, metavar='N', help='Subset up to N fonts at once, each in its own process (default 1)')
+    parser.add_argument('--max-memory', type=_parse_memory_size, default=0, dest='max_memory', metavar='SIZE',
+                        help='With --workers, only start fonts while their estimated total memory use fits in SIZE (default no limit)')
+    parser.add_argument('--coverage-index', type=str, default="", dest='coverage_index', metavar='FILE', help='Keep the characters each font has glyphs for in this file, so fonts are only indexed once across runs')
+    parser.add_argument('--quantize', default=None, nargs='*', metavar='BLOCK', help='Include whole Unicode blocks for any characters used (default blocks if none given)')
+    parser.add_argument('--layout-features', default=None, nargs='*', dest='layout_features', metavar='TAG',
+                        help="Keep only these OpenType features, eg 'kern liga', or '*' for all; with no tags, those browsers apply and the CSS turns on")
+    parser.add_argument('--check', '--plan', action='store_true', dest='check', help='Report the subset fonts that would change, without generating anything; exits with status 1 if any would')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Output significant / diagnostic info')
+    parser.add_argument('-n', '--nostats', action='store_true', help='Do not output info about the sizes of the original and generated fonts')
+    parser.add_argument('--json', action='store_true', dest='json_output', help='Print results as JSON to stdout, including any warnings; suppresses all other output')
+    args = parser.parse_args(argv)
+
+    if args.json_output: # Warnings are in the result instead
+        args.nostats = True
+        args.verbose = False
+        warnings.simplefilter('ignore')
+
+    if args.outputdir and not os.path.exists(args.outputdir):
+        print(f"Error: Output directory '{args.outputdir}' does not exist.")
+        sys.exit(1)
+    if (args.preload or args.font_display) and not args.outputdir:
+        print("Error: --preload and --font-display require --outputdir, since they apply to the rewritten CSS.")
+        sys.exit(1)
+
+    try:
+        summary: FontimizeSummary = load_summary(args.summary)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    res: FontimizeResult = optimise_fonts_for_summary(
+        summary,
+        font_output_dir=args.outputdir,
+        subsetname=args.subsetname,
+        verbose=args.verbose,
+        print_stats=not args.nostats,
+        preload_fonts=args.preload,
+        font_display=args.font_display,
+        fetch_remote=args.fetch_remote or args.offline,
+        cache_dir=args.cache_dir,
+        offline=args.offline,
+        workers=args.workers,
+        max_memory=args.max_memory,
+        check=args.check,
+        quantize=_quantize_arg(parser, args.quantize),
+        layout_features=_layout_features_arg(args.layout_features),
+        coverage_index=FontimizeCoverageIndex(args.coverage_index),
+    )
+
+    if args.json_output:
+        print(json.dumps(_json_result(res), indent=2))
+
+    if args.check and plan_is_stale(res):
+        sys.exit(1)
+
 # Note that unit tests for this file are in tests.py; run that file to run the tests
 if __name__ == '__main__':
     import argparse
-    import json
+
+    _log_to_stdout()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        _serve_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        _batch_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'collect':
+        _collect_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        _merge_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'subset':
+        _subset_main(sys.argv[2:])
+        sys.exit(0)
 
     parser = argparse.ArgumentParser(description="Optimize fonts to only the specific glyphs needed for your text or HTML files",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -690,11 +3575,21 @@ Examples:
     fontimize.py --outputdir output --subsetname MySubset --verbose 1.html 2.txt
     fontimize.py --text "The fonts will contain only the glyphs in this string" --fonts "Arial.ttf" "Times New Roman.ttf"
     fontimize.py --json --outputdir output 1.html 2.txt
+    fontimize.py --outputdir output --exclude drafts site/
+    fontimize.py serve --fonts "Arial.ttf"   (see fontimize.py serve --help)
+    fontimize.py batch jobs.json             (see fontimize.py batch --help)
+    fontimize.py collect -o shard.json site/ (see fontimize.py collect --help; also merge and subset)
                 """)
 
-    parser.add_argument('inputfiles', default=[], nargs='*', help='Input files to parse: .htm and .html are parsed as HTML to extract used text, all other files are treated as text')
+    parser.add_argument('inputfiles', default=[], nargs='*', help='Input files, directories or glob patterns to parse: .htm and .html are parsed as HTML to extract used text, all other files are treated as text. Directories are searched recursively')
+    parser.add_argument('--include', default=[], nargs='*', metavar='PATTERN', help='Which files to use from input directories (default: *.html *.htm)')
+    parser.add_argument('--exclude', default=[], nargs='*', metavar='PATTERN', help='Skip files and directories matching these patterns, eg drafts or *.min.html')
     parser.add_argument('-t', '--text', type=str, help='Input text to parse, specified directly on the command line')
     parser.add_argument('-f', '--fonts', default=[], nargs='*', help='Input font files')
+    parser.add_argument('--rendered-only', action='store_true', dest='rendered_only',
+                        help='Leave out the text of HTML elements that are never rendered with the page fonts: noscript fallbacks, the document title, and fallback content of iframes and media (scripts, styles, templates and comments are always left out)')
+    parser.add_argument('--text-attributes', default=None, nargs='*', dest='text_attributes', metavar='ATTRIBUTE',
+                        help='Include the values of these HTML attributes, eg alt (default alt, title, placeholder and aria-label if none given)')
 
     group_output = parser.add_argument_group('Output', 'Specify font output directory and font subset phrase in the generated filenames')
     group_output.add_argument("-o", "--outputdir", type=str,
@@ -703,6 +3598,47 @@ Examples:
     group_output.add_argument("-s", "--subsetname", type=str,
                         help="Phrase used in the output font filenames, eg 'Arial.SubsetName.woff2'",
                         default="FontimizeSubset")
+    group_output.add_argument("--preload", help="Add <link rel=\"preload\"> hints for the generated fonts to each input HTML file that uses them (HTML files are modified in place; requires --outputdir)",
+                        action="store_true")
+    group_output.add_argument("--font-display", type=str, choices=['auto', 'block', 'swap', 'fallback', 'optional'],
+                        help="Add this font-display value to the rewritten @font-face rules (requires --outputdir)",
+                        default=None, dest="font_display")
+    group_output.add_argument("--clusters", type=int, default=1, metavar="N",
+                        help="Group the input pages into at most N clusters by the scripts and characters they use, and generate separate subsets and CSS for each cluster (default 1, a single subset per font). With --json, they are listed under clusters")
+    group_output.add_argument("--quantize", default=None, nargs="*", metavar="BLOCK",
+                        help="Include whole Unicode blocks (eg 'Basic Latin', or a range such as U+0400-04FF) for any characters used, so the subsets only change when a new block is used (default blocks if none given)")
+    group_output.add_argument("--prune-layout", action="store_true", dest="prune_layout",
+                        help="Remove kerning pairs and ligatures for characters that are never next to each other in the text, so the subsets are smaller; text added later, eg by JavaScript, may render without them")
+    group_output.add_argument("--layout-features", default=None, nargs="*", dest="layout_features", metavar="TAG",
+                        help="Keep only these OpenType features in the subsets, eg 'kern liga onum', or '*' for all of them. With no tags, keeps the features browsers apply by default, plus any the CSS turns on with font-feature-settings or font-variant (default fontTools' default features)")
+
+    group_remote = parser.add_argument_group('Remote files', 'Download and subset stylesheets and fonts referenced by http(s) URLs')
+    group_remote.add_argument("--fetch-remote", help="Download remote stylesheets and fonts, instead of skipping them",
+                        action="store_true", dest="fetch_remote")
+    group_remote.add_argument("--cache-dir", type=str, default="", dest="cache_dir",
+                        help="Directory in which to cache downloaded files (default ~/.cache/fontimize)")
+    group_remote.add_argument("--offline", help="Only use previously downloaded files from the cache; make no network requests",
+                        action="store_true")
+
+    group_perf = parser.add_argument_group('Performance', 'Subset several fonts at once')
+    group_perf.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="Subset up to N fonts at once, each in its own process (default 1)")
+    group_perf.add_argument("--max-memory", type=_parse_memory_size, default=0, dest="max_memory", metavar="SIZE",
+                        help="With --workers, only start fonts while their estimated total memory use fits in SIZE, eg 512M or 2G (default no limit)")
+    group_perf.add_argument("--coverage-index", type=str, default="", dest="coverage_index", metavar="FILE",
+                        help="Keep the characters each font has glyphs for in this file, so fonts are only indexed once across runs, eg .fontimize-coverage.json")
+
+    group_prof = parser.add_argument_group('Profiling', 'Find out where a run spends its time and memory')
+    group_prof.add_argument("--profile-cpu", type=str, default="", dest="profile_cpu", metavar="FILE",
+                        help="Profile the run with cProfile and write the stats to FILE, for pstats or a viewer such as snakeviz; also prints the time taken by each phase")
+    group_prof.add_argument("--profile-memory", help="Trace memory allocations, and print the peak memory and the largest allocation sites for each phase (makes the run several times slower)",
+                        action="store_true", dest="profile_memory")
+    group_prof.add_argument("--trace", type=str, default="", metavar="FILE",
+                        help="Record when each file read, HTML extraction, CSS parse, font load, subset, WOFF2 save and CSS rewrite ran, in each process, and write them to FILE in Chrome trace format, for Perfetto or chrome://tracing")
+
+    group_check = parser.add_argument_group('Checking', 'Find out whether existing subset fonts are up to date, eg in CI')
+    group_check.add_argument("--check", "--plan", help="Compare the characters in each existing subset font with the ones it would contain now, and report the fonts that would change, without generating anything. Exits with status 1 if any are missing or out of date",
+                        action="store_true", dest="check")
 
     group_verb = parser.add_argument_group('Verbosity', 'Control how much Fontimize prints to the console')
     group_verb.add_argument("-v", "--verbose", help="Output significant / diagnostic info about discovered files and fonts, and generated fonts and their glyphs",
@@ -711,18 +3647,31 @@ Examples:
                     action="store_true")
     group_verb.add_argument("--json", help="Print results as JSON to stdout, including any warnings; suppresses all other output",
                     action="store_true", dest="json_output")
+    group_verb.add_argument("--json-stream", help="Print progress events as they happen, one JSON object per line, ending with the results; suppresses all other output",
+                    action="store_true", dest="json_stream")
 
     args = parser.parse_args()
 
-    # --json captures warnings into the result and suppresses human-readable output
-    _captured_warnings: list[str] = []
+    if args.json_output and args.json_stream:
+        print("Error: --json and --json-stream cannot be specified at the same time.")
+        sys.exit(1)
+
+    # --json suppresses human-readable output, and warnings, which are in the result instead
     if args.json_output:
         args.nostats = True
         args.verbose = False
-        # Capture warnings into a list instead of printing to stderr
-        def _warning_handler(message : Warning | str, category : type[Warning], filename : str, lineno : int, file : object = None, line : str | None = None) -> None:
-            _captured_warnings.append(str(message))
-        warnings.showwarning = _warning_handler
+        warnings.simplefilter('ignore')
+
+    # --json-stream prints each progress event as a line of JSON as soon as it happens. Warnings are
+    # printed from the result, before it
+    _progress: ProgressCallback | None = None
+    if args.json_stream:
+        args.nostats = True
+        args.verbose = False
+        warnings.simplefilter('ignore')
+        def _print_event(event : dict[str, Any]) -> None:
+            print(json.dumps(event), flush=True)
+        _progress = _print_event
 
     # If both --text and inputfiles are specified, give an error
     if args.text and args.inputfiles:
@@ -738,14 +3687,15 @@ Examples:
     if args.text:
         _addtl_text = args.text
 
-    # If inputfiles are specified, test they exist
-    _inputfiles: list[str] = []
+    # If inputfiles are specified, test they exist. Only the paths given on the command line are
+    # checked: directories and glob patterns are expanded lazily while the files are processed
+    _inputfiles: Iterator[str] = iter([])
     if args.inputfiles:
         for file in args.inputfiles:
-            if not os.path.exists(file):
+            if not glob.has_magic(file) and not os.path.exists(file):
                 print(f"Error: Input file '{file}' does not exist.")
                 sys.exit(1)
-        _inputfiles = args.inputfiles
+        _inputfiles = discover_files(args.inputfiles, include=args.include, exclude=args.exclude)
 
     # If fonts are specified, test they exist
     _fonts: list[str] = []
@@ -764,9 +3714,14 @@ Examples:
             sys.exit(1)
         _outputdir = args.outputdir
 
+    if (args.preload or args.font_display) and not _outputdir:
+        print("Error: --preload and --font-display require --outputdir, since they apply to the rewritten CSS.")
+        sys.exit(1)
+
     # If subsetname is specified, test it's valid
     _subsetname: str = ""
     if args.subsetname:
+        from pathvalidate import ValidationError, validate_filename
         try:
             validate_filename(args.subsetname)
         except ValidationError as e:
@@ -790,20 +3745,41 @@ Examples:
         print_stats=_printstats,
         fonts=_fonts,
         addtl_text=_addtl_text,
+        rendered_only=args.rendered_only,
+        text_attributes=_text_attributes_arg(args.text_attributes),
         css_rewriter=None,  # CSS rewriting uses the default file-writing behaviour, not a callback
+        preload_fonts=args.preload,
+        font_display=args.font_display,
+        max_clusters=args.clusters,
+        fetch_remote=args.fetch_remote or args.offline,
+        cache_dir=args.cache_dir,
+        offline=args.offline,
+        workers=args.workers,
+        max_memory=args.max_memory,
+        progress=_progress,
+        check=args.check,
+        quantize=_quantize_arg(parser, args.quantize),
+        prune_layout=args.prune_layout,
+        layout_features=_layout_features_arg(args.layout_features),
+        coverage_index=FontimizeCoverageIndex(args.coverage_index),
+        profile_cpu=args.profile_cpu,
+        profile_memory=args.profile_memory,
+        trace=args.trace,
     )
 
+    if res["profile"] and not args.json_output and _progress is None:
+        _print_profile(res["profile"])
+
     if args.json_output:
-        json_result: dict[str, object] = {
-            "css": sorted(res["css"]),
-            "fonts": res["fonts"],
-            "chars": sorted(res["chars"]),
-            "uranges": res["uranges"],
-            "rewritten_css": res["rewritten_css"],
-            "stats": res["stats"],
-            "warnings": _captured_warnings,
-        }
-        print(json.dumps(json_result, indent=2))
+        print(json.dumps(_json_result(res), indent=2))
+    elif _progress is not None:
+        for message in res["warnings"]:
+            _progress({"event": "warning", "message": message})
+        _progress({"event": "result", **_json_result(res)})
 
     if _verbose:
         print("Done.")
+
+    # In check mode, stale or missing subsets fail the run, eg to fail a CI build
+    if args.check and plan_is_stale(res):
+        sys.exit(1)
@@ -1,12 +1,18 @@
+import io
 import os
 import subprocess
 import tempfile
 import unittest
 from unittest.mock import patch
+from typing import Any, Iterator
 import sys
 from fontimize import (get_used_characters_in_html, get_used_characters_in_str, charPair, _get_char_ranges,
-    optimise_fonts, optimise_fonts_for_files, _find_font_face_urls, _extract_pseudo_elements_content, _get_path,
-    _rewrite_css)
+    optimise_fonts, optimise_fonts_for_files, optimise_fonts_for_multiple_text, optimise_fonts_for_html_contents, _find_font_face_urls, _extract_pseudo_elements_content, _get_path,
+    _rewrite_css, _inject_preloads, _cluster_pages, _script_signature, discover_files, _RemoteFetcher, _resolve_path,
+    FontimizeCache, make_subset_server, _parse_uranges, optimise_fonts_batch, load_batch_jobs,
+    _estimate_font_memory, _schedule_by_memory, optimise_fonts_in_memory,
+    plan_is_stale, collect_summary, merge_summaries, save_summary, load_summary, optimise_fonts_for_summary,
+    quantize_characters, FontimizeCoverageIndex, optimise_font_subsets, _text_pairs, _find_font_features)
 from fontTools.ttLib import woff2, TTFont
 
 class TestGetUsedCharactersInHtml(unittest.TestCase):
@@ -200,6 +206,17 @@ class TestOptimiseFonts(unittest.TestCase):
         #   > ['.notdef', 'space']
         self.assertEqual(2, _count_glyphs_in_font(foundfonts['tests/Spirax-Regular.ttf']))
 
+    def test_multiple_text_from_generator(self) -> None:
+        pages = (page for page in [" ,.@QT", "_abcdefghijklm", "nopqrstuvwxyz"])
+        result = optimise_fonts_for_multiple_text(pages, ['tests/Spirax-Regular.ttf'], fontpath=self._test_output_dir, print_stats=False)
+        self.assertEqual(result["chars"], set(self.test_string))
+        self.assertEqual(len(self.test_string) + 1, _count_glyphs_in_font(result["fonts"]['tests/Spirax-Regular.ttf']))
+
+    def test_html_contents_from_generator(self) -> None:
+        pages = (f"<html><body><p>{text}</p></body></html>" for text in ["Hello", "World"])
+        result = optimise_fonts_for_html_contents(pages, 'tests/Spirax-Regular.ttf', fontpath=self._test_output_dir, print_stats=False)
+        self.assertEqual(result["chars"], set("Hello World"))
+
 
 class TestOptimiseFontsStats(unittest.TestCase):
     """Test that stats are populated and that print_stats/verbose exercise the printing code."""
@@ -217,6 +234,28 @@ class TestOptimiseFontsStats(unittest.TestCase):
         self.assertGreater(stats["savings_bytes"], 0)
         self.assertGreater(stats["savings_percent"], 0)
 
+    def test_breakdown(self) -> None:
+        """Each file's stats should break down its glyphs and tables, the same with and without workers."""
+        fonts: list[str] = ['tests/EBGaramond-VariableFont_wght.ttf', 'tests/Spirax-Regular.ttf']
+        for workers in (1, 2):
+            result = optimise_fonts("office", fonts, fontpath=self._test_output_dir, print_stats=False, workers=workers)
+            stats = {fs["original"]: fs for fs in result["stats"]["files"]}
+            breakdown = stats['tests/EBGaramond-VariableFont_wght.ttf']["breakdown"]
+            generated: TTFont = TTFont(stats['tests/EBGaramond-VariableFont_wght.ttf']["generated"])
+            self.assertEqual(breakdown["glyphs_before"], len(TTFont(fonts[0]).getGlyphOrder()))
+            self.assertEqual(breakdown["glyphs_after"], len(generated.getGlyphOrder()))
+            self.assertEqual(breakdown["cmap_glyphs"], 6) # o f i c e and space
+            self.assertGreater(breakdown["layout_glyphs"], 0) # The ffi ligature, among others
+            self.assertEqual(breakdown["cmap_glyphs"] + breakdown["layout_glyphs"] + breakdown["other_glyphs"], breakdown["glyphs_after"])
+            self.assertEqual(set(breakdown["table_sizes"]), set(generated.keys()) - {'GlyphOrder'})
+            self.assertGreater(breakdown["table_sizes"]["gvar"], 0)
+
+    def test_breakdown_printed_with_stats(self) -> None:
+        with self.assertLogs('fontimize', level='INFO') as logs:
+            optimise_fonts("Hello", ['tests/Whisper-Regular.ttf'], fontpath=self._test_output_dir, print_stats=True)
+        self.assertTrue(any('Glyphs:' in line for line in logs.output))
+        self.assertTrue(any('Tables:' in line for line in logs.output))
+
     @patch('sys.stdout', new_callable=lambda: open(os.devnull, 'w'))
     def test_print_stats_runs_without_error(self, mock_stdout: object) -> None:
         """print_stats=True should print without crashing."""
@@ -773,6 +812,1283 @@ class TestRewriteCss(unittest.TestCase):
                 self.assertIsInstance(content, str)
 
 
+class TestPreloadAndFontDisplay(unittest.TestCase):
+
+    def test_inject_preloads_before_head_end(self) -> None:
+        html: str = "<html><head><title>T</title></head><body>Hi</body></html>"
+        result: str = _inject_preloads(html, ['fonts/a.woff2'])
+        self.assertIn('<link rel="preload" href="fonts/a.woff2" as="font" type="font/woff2" crossorigin>', result)
+        self.assertLess(result.index('rel="preload"'), result.index('</head>'))
+        # Everything else is preserved byte-for-byte
+        self.assertEqual(result.replace(result[result.index('<link'):result.index('</head>')], ''), html)
+
+    def test_inject_preloads_skips_existing(self) -> None:
+        """A font the page already preloads should not be added twice."""
+        html: str = '<html><head><link rel="preload" href="a.woff2" as="font"></head><body></body></html>'
+        self.assertEqual(_inject_preloads(html, ['a.woff2']), html)
+
+    def test_inject_preloads_no_head_warns(self) -> None:
+        import warnings as w
+        html: str = "<p>No head here</p>"
+        with w.catch_warnings(record=True) as caught:
+            w.simplefilter('always')
+            result: str = _inject_preloads(html, ['a.woff2'])
+        self.assertEqual(result, html)
+        self.assertEqual(len(caught), 1)
+        self.assertIn('</head>', str(caught[0].message))
+
+    def test_rewrite_css_adds_font_display(self) -> None:
+        css: str = "@font-face { font-family: 'text'; src: url('font.ttf') format('truetype'); }"
+        _, rewritten = _rewrite_css('/a/style.css', css, {'/a/font.ttf': '/output/font.woff2'}, '/output', 'swap')
+        self.assertIn('font-display: swap', rewritten)
+
+    def test_rewrite_css_font_display_not_added_to_unmapped(self) -> None:
+        css: str = "@font-face { font-family: 'text'; src: url('font.ttf') format('truetype'); }"
+        _, rewritten = _rewrite_css('/a/style.css', css, {}, '/output', 'swap')
+        self.assertNotIn('font-display', rewritten)
+
+    def test_preloads_for_linked_css_fonts(self) -> None:
+        """Each page gets preloads for the generated fonts of the CSS files it links, relative to the page."""
+        import warnings as w
+        captured: dict[str, str] = {}
+        def capture(path: str, content: str) -> None:
+            captured[path] = content
+
+        with w.catch_warnings(record=True):
+            w.simplefilter('always')
+            result = optimise_fonts_for_files(['tests/test2.html'], font_output_dir=self._test_output_dir,
+                                             print_stats=False, preload_fonts=True, html_rewriter=capture)
+        # test2.html links only css_test.css, which uses EB Garamond and Spirax (DOESNOTEXIST.ttf is skipped)
+        self.assertEqual(set(result['preloads']['tests/test2.html']), {
+            os.path.join(self._test_output_dir, 'EBGaramond-VariableFont_wght.FontimizeSubset.woff2'),
+            os.path.join(self._test_output_dir, 'Spirax-Regular.FontimizeSubset.woff2'),
+        })
+        html: str = captured['tests/test2.html']
+        expected_href: str = os.path.relpath(os.path.join(self._test_output_dir, 'Spirax-Regular.FontimizeSubset.woff2'), 'tests')
+        self.assertIn(f'href="{expected_href}"', html)
+        self.assertNotIn('SortsMillGoudy', html)
+        # The page links the rewritten CSS, which uses the subsets, rather than the original
+        css_href: str = os.path.relpath(os.path.join(self._test_output_dir, 'css_test.css'), 'tests')
+        self.assertIn(f'<link rel="stylesheet" href="{css_href}">', html)
+        self.assertNotIn('href="css_test.css"', html)
+
+    def test_preloads_written_in_place(self) -> None:
+        """Without an html_rewriter, the HTML file itself is updated."""
+        import warnings as w
+        f = tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False, dir='tests')
+        f.write('<html><head><link rel="stylesheet" href="css_shared_font.css"></head><body>Hello</body></html>')
+        f.close()
+        try:
+            with w.catch_warnings(record=True):
+                w.simplefilter('always')
+                optimise_fonts_for_files([f.name], font_output_dir=self._test_output_dir,
+                                         print_stats=False, preload_fonts=True, font_display='swap')
+            with open(f.name, 'r') as html_file:
+                html: str = html_file.read()
+            self.assertIn('Spirax-Regular.FontimizeSubset.woff2', html)
+            self.assertIn(f'href="{os.path.relpath(os.path.join(self._test_output_dir, "css_shared_font.css"), "tests")}"', html)
+            with open(os.path.join(self._test_output_dir, 'css_shared_font.css'), 'r') as css_file:
+                self.assertIn('font-display: swap', css_file.read())
+        finally:
+            os.unlink(f.name)
+
+
+class TestClusterPages(unittest.TestCase):
+
+    def test_script_signature_ignores_punctuation_and_digits(self) -> None:
+        self.assertEqual(_script_signature(set("Hello, world! 123")), frozenset({'LATIN'}))
+        self.assertEqual(_script_signature(set("Привет")), frozenset({'CYRILLIC'}))
+        self.assertEqual(_script_signature(set("漢字")), frozenset({'CJK'}))
+
+    def test_pages_grouped_by_script(self) -> None:
+        clusters = _cluster_pages({'en1': set("hello"), 'ru': set("привет"), 'en2': set("world")}, 5)
+        self.assertEqual(sorted(clusters), [['en1', 'en2'], ['ru']])
+
+    def test_most_similar_groups_merged(self) -> None:
+        """With more scripts than clusters allowed, the groups sharing the most characters merge."""
+        page_chars: dict[str, set[str]] = {
+            'en': set("abcdef"),
+            'ru': set("абвгд"),
+            'mixed': set("абвгдa"),  # Cyrillic plus one Latin letter: its own script group
+        }
+        clusters = _cluster_pages(page_chars, 2)
+        self.assertEqual(len(clusters), 2)
+        self.assertIn(['mixed', 'ru'], clusters)
+        self.assertIn(['en'], clusters)
+
+    def test_single_cluster(self) -> None:
+        clusters = _cluster_pages({'a': set("abc"), 'b': set("абв"), 'c': set("αβγ")}, 1)
+        self.assertEqual(clusters, [['a', 'b', 'c']])
+
+    def test_clustered_subsets_and_css(self) -> None:
+        """Each cluster gets its own subset per font and its own rewritten CSS."""
+        site_dir: str = os.path.join(self._test_output_dir, 'site')
+        out_dir: str = os.path.join(self._test_output_dir, 'out')
+        os.makedirs(site_dir)
+        os.makedirs(out_dir)
+        font: str = os.path.abspath('tests/NotoSans-VariableFont_wdth,wght.ttf')
+        with open(os.path.join(site_dir, 'style.css'), 'w') as f:
+            f.write(f"@font-face {{ font-family: 'noto'; src: url('{font}') format('truetype'); }}")
+        pages: dict[str, str] = {'en.html': 'Hello world', 'en2.html': 'Good morning', 'ru.html': 'Привет мир'}
+        for name, body in pages.items():
+            with open(os.path.join(site_dir, name), 'w') as f:
+                f.write(f'<html><head><link rel="stylesheet" href="style.css"></head><body>{body}</body></html>')
+
+        files: list[str] = [os.path.join(site_dir, name) for name in pages]
+        result = optimise_fonts_for_files(files, font_output_dir=out_dir, print_stats=False, max_clusters=2)
+
+        self.assertEqual(len(result['clusters']), 2)
+        by_page = {page: c for c in result['clusters'] for page in c['pages']}
+        english, russian = by_page[files[0]], by_page[files[2]]
+        self.assertIs(english, by_page[files[1]])
+        self.assertNotIn('П', english['chars'])
+        self.assertIn('П', russian['chars'])
+        self.assertIn('П', result['chars'])
+
+        # Separate subset and CSS files, and the English subset has no Cyrillic
+        self.assertNotEqual(english['fonts'][font], russian['fonts'][font])
+        self.assertNotIn(ord('П'), TTFont(english['fonts'][font]).getBestCmap())
+        self.assertIn(ord('П'), TTFont(russian['fonts'][font]).getBestCmap())
+        for cluster in (english, russian):
+            rewritten: str = cluster['rewritten_css'][os.path.join(site_dir, 'style.css')]
+            self.assertTrue(rewritten.endswith(f"style.{cluster['name']}.css"))
+            with open(rewritten, 'r') as f:
+                self.assertIn(os.path.basename(cluster['fonts'][font]), f.read())
+        self.assertEqual(result['stats']['fonts_processed'], 2)
+        # Each font has a subset per cluster, so they're only listed by cluster, and every one is in the stats
+        self.assertEqual(result['fonts'], {})
+        self.assertEqual(result['rewritten_css'], {})
+        self.assertEqual({fs['generated'] for fs in result['stats']['files']}, {english['fonts'][font], russian['fonts'][font]})
+
+    def test_clustered_preloads_relink_css(self) -> None:
+        """With preloads, each page links its cluster's CSS rather than the original, so only the subsets are downloaded."""
+        site_dir: str = os.path.join(self._test_output_dir, 'site')
+        out_dir: str = os.path.join(self._test_output_dir, 'out')
+        os.makedirs(site_dir)
+        os.makedirs(out_dir)
+        font: str = os.path.abspath('tests/NotoSans-VariableFont_wdth,wght.ttf')
+        with open(os.path.join(site_dir, 'style.css'), 'w') as f:
+            f.write(f"@font-face {{ font-family: 'noto'; src: url('{font}') format('truetype'); }}")
+        pages: dict[str, str] = {'en.html': 'Hello world', 'ru.html': 'Привет мир'}
+        for name, body in pages.items():
+            with open(os.path.join(site_dir, name), 'w') as f:
+                f.write(f'<html><head><link rel="stylesheet" href="style.css?v=2"></head><body>{body}</body></html>')
+
+        files: list[str] = [os.path.join(site_dir, name) for name in pages]
+        result = optimise_fonts_for_files(files, font_output_dir=out_dir, print_stats=False, max_clusters=2, preload_fonts=True)
+
+        self.assertEqual(len(result['clusters']), 2)
+        for cluster in result['clusters']:
+            for page in cluster['pages']:
+                with open(page, 'r') as f:
+                    html: str = f.read()
+                css_href: str = os.path.relpath(cluster['rewritten_css'][os.path.join(site_dir, 'style.css')], site_dir)
+                self.assertIn(f'<link rel="stylesheet" href="{css_href}">', html)
+                self.assertNotIn('href="style.css', html)
+                self.assertIn(os.path.relpath(cluster['fonts'][font], site_dir), html)
+
+
+class TestDiscoverFiles(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # site/index.html, site/about.htm, site/style.css, site/blog/post.html, site/drafts/wip.html
+        self.site: str = os.path.join(self._test_output_dir, 'site')
+        for rel in ['index.html', 'about.htm', 'style.css', 'blog/post.html', 'drafts/wip.html']:
+            full: str = os.path.join(self.site, rel)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with open(full, 'w') as f:
+                f.write('<html><body>Hello</body></html>')
+
+    def _rel(self, paths: list[str]) -> list[str]:
+        return [os.path.relpath(p, self.site) for p in paths]
+
+    def test_directory_walked_recursively_for_html(self) -> None:
+        found: list[str] = self._rel(list(discover_files([self.site])))
+        self.assertEqual(found, ['about.htm', 'index.html', os.path.join('blog', 'post.html'), os.path.join('drafts', 'wip.html')])
+
+    def test_include_patterns(self) -> None:
+        found: list[str] = self._rel(list(discover_files(self.site, include=['*.css'])))
+        self.assertEqual(found, ['style.css'])
+
+    def test_exclude_directory(self) -> None:
+        found: list[str] = self._rel(list(discover_files(self.site, exclude=['drafts'])))
+        self.assertNotIn(os.path.join('drafts', 'wip.html'), found)
+        self.assertIn(os.path.join('blog', 'post.html'), found)
+
+    def test_glob_pattern(self) -> None:
+        found: list[str] = self._rel(list(discover_files([os.path.join(self.site, '**', '*.html')])))
+        self.assertEqual(sorted(found), sorted(['index.html', os.path.join('blog', 'post.html'), os.path.join('drafts', 'wip.html')]))
+
+    def test_plain_files_passed_through(self) -> None:
+        """Explicit files are yielded as given, even if they don't match the include patterns."""
+        self.assertEqual(list(discover_files(['tests/test.txt'])), ['tests/test.txt'])
+
+    def test_is_lazy(self) -> None:
+        import types
+        self.assertIsInstance(discover_files([self.site]), types.GeneratorType)
+
+    def test_generator_input_to_optimise_fonts_for_files(self) -> None:
+        result = optimise_fonts_for_files(discover_files(self.site), font_output_dir=self._test_output_dir,
+                                         fonts=['tests/Whisper-Regular.ttf'], print_stats=False)
+        self.assertIn('tests/Whisper-Regular.ttf', result['fonts'])
+        self.assertTrue({'H', 'e', 'l', 'o'} <= result['chars'])
+
+    def test_directory_and_glob_input_to_optimise_fonts_for_files(self) -> None:
+        with open(os.path.join(self.site, 'blog', 'post.html'), 'w') as f:
+            f.write('<html><body>Blog</body></html>')
+        with open(os.path.join(self.site, 'notes.txt'), 'w') as f:
+            f.write('Zebra')
+        options: dict[str, object] = {"font_output_dir": self._test_output_dir, "fonts": ['tests/Whisper-Regular.ttf'], "print_stats": False}
+
+        result = optimise_fonts_for_files([self.site], **options)
+        self.assertTrue(set('HeloBg') <= result['chars'])
+        self.assertNotIn('Z', result['chars']) # Only HTML files, by default
+        result = optimise_fonts_for_files([self.site], include=['*.txt'], **options)
+        self.assertEqual(result['chars'], set('Zebra '))
+
+        result = optimise_fonts_for_files([os.path.join(self.site, '**', 'post.html')], **options)
+        self.assertEqual(result['chars'], set('Blog '))
+        result = optimise_fonts_for_files([os.path.join(self.site, '**', '*.html')], exclude=['index.html', 'wip.html'], **options)
+        self.assertEqual(result['chars'], set('Blog '))
+
+    @patch('sys.stdout', new_callable=lambda: open(os.devnull, 'w'))
+    def test_empty_generator_is_no_input(self, mock_stdout: object) -> None:
+        result = optimise_fonts_for_files(iter([]), print_stats=False)
+        self.assertEqual(result['fonts'], {})
+
+
+class TestRemoteFetch(unittest.TestCase):
+    """Remote stylesheets and fonts, fetched from a local HTTP server serving the tests folder."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        import functools
+        import threading
+        from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+        requests: list[tuple[str, int, tuple[str, int]]] = []
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keep-alive
+            def log_request(self, code: int | str = '-', size: int | str = '-') -> None:
+                requests.append((self.path, int(code), self.client_address))
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        cls.requests = requests
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory='tests'))
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}/'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self) -> None:
+        self.requests.clear()
+        self.cache_dir: str = os.path.join(self._test_output_dir, 'cache')
+        self.out_dir: str = os.path.join(self._test_output_dir, 'out')
+        os.makedirs(self.out_dir)
+        self.html: str = os.path.join(self._test_output_dir, 'page.html')
+        with open(self.html, 'w') as f:
+            f.write(f'<html><head><link rel="stylesheet" href="{self.base_url}css_test-index.css"></head>'
+                    f'<body>Hello remote world</body></html>')
+
+    def _optimise(self, **kwargs: object) -> dict:
+        import warnings as w
+        with w.catch_warnings(record=True) as caught:
+            w.simplefilter('always')
+            result = optimise_fonts_for_files([self.html], font_output_dir=self.out_dir, print_stats=False,
+                                             cache_dir=self.cache_dir, **kwargs)  # type: ignore[arg-type]
+        self.warnings: list[str] = [str(x.message) for x in caught]
+        return result
+
+    def test_resolve_path_urls(self) -> None:
+        self.assertEqual(_resolve_path('https://a.com/css/s.css', '../f.ttf'), 'https://a.com/f.ttf')
+        self.assertEqual(_resolve_path('site/s.css', 'https://b.com/f.ttf'), 'https://b.com/f.ttf')
+        self.assertEqual(_resolve_path('site/s.css', '//b.com/f.ttf'), 'https://b.com/f.ttf')
+        self.assertEqual(_resolve_path('site/s.css', 'f.ttf'), os.path.join('site', 'f.ttf'))
+
+    def test_remote_css_and_fonts_subset(self) -> None:
+        result = self._optimise(fetch_remote=True)
+        css_url: str = self.base_url + 'css_test-index.css'
+        font_url: str = self.base_url + 'SortsMillGoudy-Regular.ttf'
+        self.assertIn(css_url, result['css'])
+        # Fonts are reported by URL, and subset into the output directory
+        self.assertEqual(result['fonts'][font_url], os.path.join(self.out_dir, 'SortsMillGoudy-Regular.FontimizeSubset.woff2'))
+        self.assertIn(self.base_url + 'SortsMillGoudy-Italic.ttf', result['fonts'])
+        self.assertTrue(os.path.exists(result['fonts'][font_url]))
+        # The remote CSS is rewritten to use the subsets
+        with open(result['rewritten_css'][css_url], 'r') as f:
+            rewritten: str = f.read()
+        self.assertIn('SortsMillGoudy-Regular.FontimizeSubset.woff2', rewritten)
+        self.assertNotIn('SortsMillGoudy-Regular.ttf', rewritten)
+
+    def test_query_string_sent(self) -> None:
+        """A remote stylesheet's query string is part of its URL, eg for Google Fonts, so it's sent to the server."""
+        with open(self.html, 'w') as f:
+            f.write(f'<html><head><link rel="stylesheet" href="{self.base_url}css_test-index.css?family=Sorts&amp;v=2#x"></head>'
+                    f'<body>Hello remote world</body></html>')
+        result = self._optimise(fetch_remote=True)
+        css_url: str = self.base_url + 'css_test-index.css?family=Sorts&v=2'
+        self.assertIn(('/css_test-index.css?family=Sorts&v=2', 200), [(p, code) for p, code, _ in self.requests])
+        self.assertIn(css_url, result['css'])
+        self.assertIn(self.base_url + 'SortsMillGoudy-Regular.ttf', result['fonts'])
+        self.assertTrue(os.path.exists(result['rewritten_css'][css_url]))
+
+    def test_cached_files_revalidated(self) -> None:
+        """A second run sends conditional requests, and unchanged files come back as 304 Not Modified."""
+        self._optimise(fetch_remote=True)
+        self.assertTrue(all(code == 200 for _, code, _ in self.requests))
+        self.requests.clear()
+        result = self._optimise(fetch_remote=True)
+        self.assertEqual(len(result['fonts']), 2)
+        self.assertEqual(len(self.requests), 3)
+        self.assertTrue(all(code == 304 for _, code, _ in self.requests))
+
+    def test_offline_uses_cache_only(self) -> None:
+        self._optimise(fetch_remote=True)
+        self.requests.clear()
+        result = self._optimise(fetch_remote=True, offline=True)
+        self.assertEqual(len(result['fonts']), 2)
+        self.assertEqual(self.requests, [])
+
+    @patch('sys.stdout', new_callable=lambda: open(os.devnull, 'w'))
+    def test_offline_without_cache_skips(self, mock_stdout: object) -> None:
+        result = self._optimise(fetch_remote=True, offline=True)
+        self.assertEqual(result['fonts'], {})
+        self.assertTrue(any('offline' in w for w in self.warnings))
+        self.assertEqual(self.requests, [])
+
+    @patch('sys.stdout', new_callable=lambda: open(os.devnull, 'w'))
+    def test_remote_skipped_by_default(self, mock_stdout: object) -> None:
+        result = self._optimise()
+        self.assertEqual(result['css'], set())
+        self.assertTrue(any('remote' in w for w in self.warnings))
+        self.assertEqual(self.requests, [])
+
+    def test_connections_kept_alive(self) -> None:
+        """Sequential fetches from one host reuse a single pooled connection."""
+        fetcher = _RemoteFetcher(self.cache_dir)
+        for name in ['Spirax-Regular.ttf', 'Whisper-Regular.ttf', 'css_test.css']:
+            self.assertIsNotNone(fetcher.fetch(self.base_url + name))
+        fetcher.close()
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(len({client for _, _, client in self.requests}), 1)
+
+    def test_corrupt_metadata_is_cache_miss(self) -> None:
+        """Cached validators that can't be read, eg a truncated file, mean the URL is downloaded again."""
+        import json
+        import warnings as w
+        url: str = self.base_url + 'Spirax-Regular.ttf'
+        fetcher = _RemoteFetcher(self.cache_dir)
+        body_path: str | None = fetcher.fetch(url)
+        meta_path: str = fetcher._cache_paths(url)[1]
+        with open(meta_path, 'w') as f:
+            f.write('{"etag": "')
+        self.requests.clear()
+        with w.catch_warnings(record=True) as caught:
+            w.simplefilter('always')
+            self.assertEqual(fetcher.fetch(url), body_path)
+        fetcher.close()
+        self.assertEqual([code for _, code, _ in self.requests], [200])
+        self.assertIn('unreadable cache metadata', str(caught[0].message))
+        with open(meta_path, 'r') as f:
+            self.assertIn('last-modified', json.load(f)) # Rewritten
+        self.assertEqual([name for name in os.listdir(self.cache_dir) if name.endswith('.tmp')], [])
+
+    def test_missing_remote_file_warns(self) -> None:
+        import warnings as w
+        fetcher = _RemoteFetcher(self.cache_dir)
+        with w.catch_warnings(record=True) as caught:
+            w.simplefilter('always')
+            self.assertIsNone(fetcher.fetch(self.base_url + 'DOESNOTEXIST.ttf'))
+        fetcher.close()
+        self.assertIn('404', str(caught[0].message))
+
+
+class TestFontimizeCache(unittest.TestCase):
+
+    def test_font_read_once(self) -> None:
+        cache = FontimizeCache()
+        first = cache.open_font('tests/Spirax-Regular.ttf')
+        second = cache.open_font('tests/Spirax-Regular.ttf')
+        self.assertIsNot(first, second) # Each caller gets its own TTFont to subset
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+
+    def test_least_recently_used_evicted(self) -> None:
+        cache = FontimizeCache(max_fonts=1)
+        cache.font_data('tests/Spirax-Regular.ttf')
+        cache.font_data('tests/Whisper-Regular.ttf')
+        cache.font_data('tests/Spirax-Regular.ttf')
+        self.assertEqual((cache.misses, cache.hits), (3, 0))
+
+    def test_changed_file_reread(self) -> None:
+        import shutil
+        font: str = os.path.join(self._test_output_dir, 'font.ttf')
+        shutil.copy('tests/Spirax-Regular.ttf', font)
+        cache = FontimizeCache()
+        cache.font_data(font)
+        shutil.copy('tests/Whisper-Regular.ttf', font)
+        with open('tests/Whisper-Regular.ttf', 'rb') as f:
+            self.assertEqual(cache.font_data(font), f.read())
+
+    def test_optimise_fonts_with_cache(self) -> None:
+        cache = FontimizeCache()
+        for subsetname in ['One', 'Two']:
+            result = optimise_fonts("Hello", ['tests/Whisper-Regular.ttf'], fontpath=self._test_output_dir,
+                                    subsetname=subsetname, print_stats=False, cache=cache)
+            self.assertTrue(os.path.exists(result['fonts']['tests/Whisper-Regular.ttf']))
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+
+
+class TestSubsetServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        import threading
+        cls.server = make_subset_server(['tests/Spirax-Regular.ttf', 'tests/Whisper-Regular.ttf'], port=0, workers=2)
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _get(self, url: str, data: bytes | None = None) -> tuple[int, dict[str, str], bytes]:
+        import urllib.request
+        import urllib.error
+        request = urllib.request.Request(self.base_url + url, data=data)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return (response.status, dict(response.headers), response.read())
+        except urllib.error.HTTPError as e:
+            return (e.code, dict(e.headers), e.read())
+
+    def _cmap_chars(self, woff2_data: bytes) -> set[str]:
+        import io
+        return {chr(cp) for cp in TTFont(io.BytesIO(woff2_data)).getBestCmap()}
+
+    def test_parse_uranges(self) -> None:
+        self.assertEqual(_parse_uranges('U+0041-0043, U+0061'), set('ABCa'))
+        self.assertEqual(_parse_uranges(''), set())
+
+    def test_subset_from_text(self) -> None:
+        status, headers, body = self._get('/subset?font=Spirax-Regular&text=Hello')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'font/woff2')
+        self.assertEqual(self._cmap_chars(body), set('Helo '))
+
+    def test_subset_from_chars_and_post(self) -> None:
+        status, _, body = self._get('/subset?font=Whisper-Regular&chars=U+0041-0043')
+        self.assertEqual(status, 200)
+        self.assertEqual(self._cmap_chars(body), set('ABC '))
+        status, _, body = self._get('/subset?font=Whisper-Regular', data='xyz'.encode('utf-8'))
+        self.assertEqual(status, 200)
+        self.assertEqual(self._cmap_chars(body), set('xyz '))
+
+    def test_repeat_request_cached(self) -> None:
+        _, first_headers, first = self._get('/subset?font=Spirax-Regular&text=cached')
+        _, second_headers, second = self._get('/subset?font=Spirax-Regular&text=dechac') # Same characters
+        self.assertEqual(first_headers['X-Fontimize-Cache'], 'miss')
+        self.assertEqual(second_headers['X-Fontimize-Cache'], 'hit')
+        self.assertEqual(first, second)
+        self.assertEqual(first_headers['ETag'], second_headers['ETag'])
+
+    def test_errors(self) -> None:
+        self.assertEqual(self._get('/subset?font=Unknown&text=x')[0], 404)
+        self.assertEqual(self._get('/subset?font=Spirax-Regular&chars=U+ZZZZ')[0], 400)
+        self.assertEqual(self._get('/nothing')[0], 404)
+
+    def test_fonts_and_metrics(self) -> None:
+        import json
+        _, _, body = self._get('/fonts')
+        self.assertEqual(json.loads(body), ['Spirax-Regular', 'Whisper-Regular'])
+        self._get('/subset?font=Whisper-Regular&text=metrics')
+        self._get('/subset?font=Whisper-Regular&text=metrics')
+        _, _, body = self._get('/metrics')
+        metrics = json.loads(body)
+        self.assertGreaterEqual(metrics['requests'], 2)
+        self.assertGreaterEqual(metrics['response_cache_hits'], 1)
+        self.assertGreater(metrics['response_cache_hit_rate'], 0)
+        self.assertGreater(metrics['latency_ms']['max'], 0)
+
+    def test_concurrent_requests(self) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        texts: list[str] = [f'text {i}' for i in range(8)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda t: self._get(f'/subset?font=Spirax-Regular&text={t.replace(" ", "+")}'), texts))
+        for text, (status, _, body) in zip(texts, results):
+            self.assertEqual(status, 200)
+            self.assertEqual(self._cmap_chars(body), set(text))
+
+    def test_bad_body_and_subset_failure(self) -> None:
+        self.assertEqual(self._get('/subset?font=Spirax-Regular', data=b'\xff\xfe\xfa')[0], 400)
+        import threading
+        server = make_subset_server(['tests/test.txt'], port=0, workers=1) # Not a font
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            import urllib.request
+            import urllib.error
+            with self.assertRaises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/subset?font=test&text=x')
+            self.assertEqual(e.exception.code, 500)
+            self.assertIn('error', e.exception.read().decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_idle_connections(self) -> None:
+        """Idle kept-alive connections don't stop other clients being served, or the server closing."""
+        import socket
+        import threading
+        import time
+        import urllib.request
+        server = make_subset_server(['tests/Spirax-Regular.ttf'], port=0, workers=2, keep_alive_timeout=0.5)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        address: tuple[str, int] = ('127.0.0.1', server.server_address[1])
+        idle: list[socket.socket] = [socket.create_connection(address) for _ in range(4)] # More than the workers
+        try:
+            with urllib.request.urlopen(f'http://{address[0]}:{address[1]}/fonts', timeout=10) as response:
+                self.assertEqual(response.status, 200)
+
+            server.keep_alive_timeout = 60.0
+            idle += [socket.create_connection(address) for _ in range(4)]
+            time.sleep(0.2) # Let the workers pick up the new connections
+            started: float = time.perf_counter()
+            server.shutdown()
+            server.server_close()
+            self.assertLess(time.perf_counter() - started, 5)
+        finally:
+            for connection in idle:
+                connection.close()
+
+    def test_duplicate_font_names_rejected(self) -> None:
+        with self.assertRaises(ValueError):
+            make_subset_server(['tests/Spirax-Regular.ttf', 'tests/output/Spirax-Regular.ttf'], port=0)
+
+
+class TestBatch(unittest.TestCase):
+
+    def _job(self, name: str, **settings: object) -> dict[str, object]:
+        return {"name": name, "files": ["tests/test1-index-css.html"], "subsetname": name,
+                "font_output_dir": os.path.join(self._test_output_dir, name), **settings}
+
+    def test_jobs_share_fonts_and_stylesheets(self) -> None:
+        cache = FontimizeCache()
+        res = optimise_fonts_batch([self._job("one"), self._job("two")], print_stats=False, cache=cache)
+        self.assertEqual(sorted(res["results"]), ["one", "two"])
+        self.assertEqual(res["results"]["one"]["fonts"].keys(), res["results"]["two"]["fonts"].keys())
+        for generated in res["results"]["two"]["fonts"].values():
+            self.assertIn(".two.woff2", generated)
+        # Each font is read, and each stylesheet parsed, only by the first job
+        num_fonts: int = len(res["results"]["one"]["fonts"])
+        self.assertEqual((cache.misses, cache.hits), (num_fonts, num_fonts))
+        self.assertEqual(len(cache._stylesheets), 2)
+
+    def test_resume_from_checkpoint(self) -> None:
+        checkpoint: str = os.path.join(self._test_output_dir, 'batch.checkpoint')
+        broken = self._job("two", files=["tests/does-not-exist.html"])
+        res = optimise_fonts_batch([self._job("one"), broken], checkpoint=checkpoint, print_stats=False)
+        self.assertEqual(list(res["results"]), ["one"])
+        self.assertEqual(list(res["failed"]), ["two"])
+        self.assertTrue(os.path.exists(checkpoint)) # Kept, since not every job succeeded
+
+        # Running again only runs the job that didn't complete, and removes the checkpoint when done
+        res = optimise_fonts_batch([self._job("one"), self._job("two")], checkpoint=checkpoint, print_stats=False)
+        self.assertEqual(res["skipped"], ["one"])
+        self.assertEqual(list(res["results"]), ["two"])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_changed_job_rerun(self) -> None:
+        checkpoint: str = os.path.join(self._test_output_dir, 'batch.checkpoint')
+        optimise_fonts_batch([self._job("one"), self._job("two", files=["tests/missing.html"])], checkpoint=checkpoint, print_stats=False)
+        res = optimise_fonts_batch([self._job("one", addtl_text="xyz"), self._job("two")], checkpoint=checkpoint, print_stats=False)
+        self.assertEqual(res["skipped"], [])
+        self.assertEqual(sorted(res["results"]), ["one", "two"])
+
+    def test_restart_ignores_checkpoint(self) -> None:
+        checkpoint: str = os.path.join(self._test_output_dir, 'batch.checkpoint')
+        optimise_fonts_batch([self._job("one"), self._job("two", files=["tests/missing.html"])], checkpoint=checkpoint, print_stats=False)
+        res = optimise_fonts_batch([self._job("one"), self._job("two")], checkpoint=checkpoint, restart=True, print_stats=False)
+        self.assertEqual(sorted(res["results"]), ["one", "two"])
+
+    def test_workers(self) -> None:
+        jobs = [self._job(name) for name in ["one", "two", "three"]]
+        res = optimise_fonts_batch(jobs, workers=3, print_stats=False)
+        self.assertEqual(sorted(res["results"]), ["one", "three", "two"])
+        self.assertEqual(res["failed"], {})
+
+    def test_invalid_jobs(self) -> None:
+        with self.assertRaises(ValueError):
+            optimise_fonts_batch([{"files": ["tests/test2.html"], "outputdir": "x"}])
+        with self.assertRaises(ValueError):
+            optimise_fonts_batch([self._job("one"), self._job("one")])
+
+    def test_load_toml_with_defaults(self) -> None:
+        job_file: str = os.path.join(self._test_output_dir, 'jobs.toml')
+        with open(job_file, 'w') as f:
+            f.write('[defaults]\nfonts = ["tests/Whisper-Regular.ttf"]\nsubsetname = "Nightly"\n\n'
+                    '[[jobs]]\nname = "a"\nfiles = ["tests/test2.html"]\n\n'
+                    '[[jobs]]\nname = "b"\nfiles = ["tests/test.txt"]\nsubsetname = "Other"\n')
+        jobs = load_batch_jobs(job_file)
+        self.assertEqual([j["name"] for j in jobs], ["a", "b"])
+        self.assertEqual(jobs[0]["fonts"], ["tests/Whisper-Regular.ttf"])
+        self.assertEqual([j["subsetname"] for j in jobs], ["Nightly", "Other"])
+
+
+class TestMemoryScheduler(unittest.TestCase):
+
+    def test_estimate_follows_layout_tables(self) -> None:
+        # EBGaramond's large GPOS table makes it far more expensive to subset than its file size suggests
+        garamond: int = _estimate_font_memory('tests/EBGaramond-VariableFont_wght.ttf')
+        spirax: int = _estimate_font_memory('tests/Spirax-Regular.ttf')
+        self.assertGreater(garamond, 5 * spirax)
+
+    def test_estimate_uses_uncompressed_woff_tables(self) -> None:
+        woff: str = os.path.join(self._test_output_dir, 'Whisper-Regular.woff')
+        font = TTFont('tests/Whisper-Regular.ttf')
+        font.flavor = 'woff'
+        font.save(woff)
+        self.assertEqual(_estimate_font_memory(woff), _estimate_font_memory('tests/Whisper-Regular.ttf'))
+
+    def test_largest_fitting_font_first(self) -> None:
+        estimates = {'big': 60, 'medium': 30, 'small': 10}
+        self.assertEqual(_schedule_by_memory(estimates, {}, 4, 100), 'big')
+        self.assertEqual(_schedule_by_memory(estimates, {'big': 60}, 4, 100), 'medium')
+        # Only the small font fits alongside the big one
+        self.assertEqual(_schedule_by_memory(estimates, {'big': 60, 'other': 35}, 4, 100), None)
+        self.assertEqual(_schedule_by_memory({'medium': 30, 'small': 10}, {'big': 80}, 4, 100), 'small')
+
+    def test_worker_limit(self) -> None:
+        self.assertEqual(_schedule_by_memory({'a': 1}, {'b': 1, 'c': 1}, 2, 0), None)
+        self.assertEqual(_schedule_by_memory({'a': 1}, {'b': 1}, 2, 0), 'a')
+
+    def test_oversized_font_runs_alone(self) -> None:
+        self.assertEqual(_schedule_by_memory({'huge': 500}, {'small': 10}, 4, 100), None)
+        self.assertEqual(_schedule_by_memory({'huge': 500}, {}, 4, 100), 'huge')
+
+    def test_parallel_matches_sequential(self) -> None:
+        fonts: list[str] = ['tests/Spirax-Regular.ttf', 'tests/Whisper-Regular.ttf', 'tests/SortsMillGoudy-Regular.ttf']
+        sequential = optimise_fonts("Hello", fonts, fontpath=self._test_output_dir, subsetname="One", print_stats=False)
+        import warnings
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            parallel = optimise_fonts("Hello", fonts, fontpath=self._test_output_dir, subsetname="Two", print_stats=False,
+                                      workers=3, max_memory=4 * 1024 * 1024)
+        # SortsMillGoudy is estimated at more than 4MB, so it's processed on its own
+        self.assertTrue(any("SortsMillGoudy-Regular.ttf" in str(w.message) for w in caught))
+        self.assertEqual(parallel["fonts"].keys(), sequential["fonts"].keys())
+        for font in fonts:
+            self.assertEqual(TTFont(parallel["fonts"][font]).getBestCmap(), TTFont(sequential["fonts"][font]).getBestCmap())
+        self.assertEqual(parallel["stats"]["fonts_processed"], 3)
+
+
+    @unittest.skipUnless(sys.version_info >= (3, 11), "Python 3.10 can't replace worker processes")
+    def test_new_process_per_font_with_budget(self) -> None:
+        """A worker keeps its peak memory, so with a budget each font is subset in a new process."""
+        import concurrent.futures
+        pools: list[dict[str, object]] = []
+        class RecordingPool(concurrent.futures.ProcessPoolExecutor):
+            def __init__(self, *args: Any, **kwargs: Any) -> None:
+                pools.append(kwargs)
+                super().__init__(*args, **kwargs)
+        fonts: list[str] = ['tests/Spirax-Regular.ttf', 'tests/Whisper-Regular.ttf']
+        with patch('concurrent.futures.ProcessPoolExecutor', RecordingPool):
+            optimise_fonts("Hello", fonts, fontpath=self._test_output_dir, print_stats=False, workers=2)
+            optimise_fonts("Hello", fonts, fontpath=self._test_output_dir, print_stats=False, workers=2, max_memory=1024 ** 3)
+        self.assertNotIn('max_tasks_per_child', pools[0])
+        self.assertEqual(pools[1]['max_tasks_per_child'], 1)
+
+
+class TestProgressEvents(unittest.TestCase):
+
+    def test_files_events_in_order(self) -> None:
+        events: list[dict] = []
+        res = optimise_fonts_for_files(['tests/test1-index-css.html'], font_output_dir=self._test_output_dir,
+                                       print_stats=False, progress=events.append)
+        names: list[str] = [e["event"] for e in events]
+        self.assertEqual(names[:2], ["files_discovered", "file_extracted"])
+        self.assertEqual(events[0]["count"], 1)
+        self.assertEqual(names.count("css_parsed"), len(res["css"]))
+        self.assertEqual(names.count("css_rewritten"), len(res["rewritten_css"]))
+        self.assertLess(names.index("css_parsed"), names.index("font_started"))
+        self.assertLess(max(i for i, n in enumerate(names) if n == "font_finished"), names.index("css_rewritten"))
+
+        # Each font's finished event has the same sizes as the final stats, so consumers can act on it straight away
+        finished = {e["font"]: e for e in events if e["event"] == "font_finished"}
+        self.assertEqual(finished.keys(), res["fonts"].keys())
+        for fs in res["stats"]["files"]:
+            self.assertEqual(finished[fs["original"]]["generated_size"], fs["generated_size"])
+            self.assertEqual(finished[fs["original"]]["output"], fs["generated"])
+            self.assertGreaterEqual(finished[fs["original"]]["seconds"], 0)
+
+    def test_files_read_lazily_without_progress(self) -> None:
+        """Without a progress callback, each file is read before the next path is generated."""
+        def pages() -> Iterator[str]:
+            for text in ["Hello", "world"]:
+                page: str = os.path.join(self._test_output_dir, f'{text}.txt')
+                with open(page, 'w') as f:
+                    f.write(text)
+                yield page
+                os.unlink(page) # Only possible if the page has already been read
+
+        res = optimise_fonts_for_files(pages(), font_output_dir=self._test_output_dir, print_stats=False,
+                                       fonts=['tests/Spirax-Regular.ttf'])
+        self.assertTrue(set('Helloworld') <= res["chars"])
+
+    def test_parallel_font_events(self) -> None:
+        events: list[dict] = []
+        fonts: list[str] = ['tests/Spirax-Regular.ttf', 'tests/Whisper-Regular.ttf']
+        optimise_fonts("Hello", fonts, fontpath=self._test_output_dir, print_stats=False, workers=2, progress=events.append)
+        self.assertEqual(sorted(e["font"] for e in events if e["event"] == "font_started"), fonts)
+        self.assertEqual(sorted(e["font"] for e in events if e["event"] == "font_finished"), fonts)
+
+    def test_batch_events_name_job(self) -> None:
+        events: list[dict] = []
+        optimise_fonts_batch([{"name": "one", "files": ["tests/test.txt"], "fonts": ["tests/Whisper-Regular.ttf"],
+                               "font_output_dir": self._test_output_dir}], print_stats=False, progress=events.append)
+        self.assertEqual(events[-1], {"event": "job_finished", "job": "one"})
+        self.assertTrue(all(e["job"] == "one" for e in events))
+        self.assertIn("font_finished", [e["event"] for e in events])
+
+
+class TestInMemoryFonts(unittest.TestCase):
+
+    def test_bytes_in_bytes_out(self) -> None:
+        with open('tests/Spirax-Regular.ttf', 'rb') as f:
+            data: bytes = f.read()
+        res = optimise_fonts_in_memory("Hello", {'fonts/Spirax-Regular.ttf': data}, print_stats=False)
+        self.assertEqual(res["fonts"], {'fonts/Spirax-Regular.ttf': 'fonts/Spirax-Regular.FontimizeSubset.woff2'})
+        generated: bytes = res["font_data"]['fonts/Spirax-Regular.FontimizeSubset.woff2']
+        self.assertEqual(generated[:4], b'wOF2')
+        cmap: dict[int, str] = TTFont(io.BytesIO(generated)).getBestCmap()
+        self.assertIn(ord('H'), cmap)
+        self.assertNotIn(ord('Z'), cmap)
+        self.assertEqual(res["stats"]["files"][0]["original_size"], len(data))
+        self.assertEqual(res["stats"]["files"][0]["generated_size"], len(generated))
+        self.assertFalse(os.path.exists('fonts'))
+
+    def test_file_object_and_font_writer(self) -> None:
+        written: dict[str, bytes] = {}
+        def store(name: str, data: bytes) -> None:
+            written[name] = data
+        with open('tests/Whisper-Regular.ttf', 'rb') as f:
+            res = optimise_fonts_in_memory("Hi", {'Whisper-Regular.ttf': f}, subsetname="Blob", print_stats=False, font_writer=store)
+        self.assertEqual(list(written), ['Whisper-Regular.Blob.woff2'])
+        self.assertEqual(res["font_data"], {})
+        self.assertEqual(res["stats"]["total_generated_size"], len(written['Whisper-Regular.Blob.woff2']))
+
+    def test_font_writer_replaces_file_output(self) -> None:
+        written: dict[str, bytes] = {}
+        def store(name: str, data: bytes) -> None:
+            written[name] = data
+        res = optimise_fonts("Hello", ['tests/Spirax-Regular.ttf', 'tests/Whisper-Regular.ttf'], fontpath=self._test_output_dir,
+                             print_stats=False, workers=2, font_writer=store)
+        self.assertEqual(set(written), set(res["fonts"].values()))
+        self.assertEqual(os.listdir(self._test_output_dir), [])
+        for fs in res["stats"]["files"]:
+            self.assertEqual(fs["generated_size"], len(written[fs["generated"]]))
+
+
+class TestCheckMode(unittest.TestCase):
+
+    def test_missing_then_current_then_stale(self) -> None:
+        font: str = 'tests/Spirax-Regular.ttf'
+        res = optimise_fonts("Hello", font, fontpath=self._test_output_dir, print_stats=False, check=True)
+        outfile: str = res["fonts"][font]
+        self.assertFalse(os.path.exists(outfile))
+        self.assertEqual(res["plan"][outfile]["status"], "missing")
+        self.assertIn("H", res["plan"][outfile]["added"])
+        self.assertTrue(plan_is_stale(res))
+
+        optimise_fonts("Hello", font, fontpath=self._test_output_dir, print_stats=False)
+        res = optimise_fonts("olleH", font, fontpath=self._test_output_dir, print_stats=False, check=True)
+        self.assertEqual(res["plan"][outfile], {"font": font, "status": "current", "added": [], "removed": []})
+        self.assertFalse(plan_is_stale(res))
+
+        res = optimise_fonts("Help", font, fontpath=self._test_output_dir, print_stats=False, check=True)
+        self.assertEqual(res["plan"][outfile]["status"], "stale")
+        self.assertEqual(res["plan"][outfile]["added"], ["p"])
+        self.assertEqual(res["plan"][outfile]["removed"], ["o"])
+
+    def test_subset_without_unicode_cmap(self) -> None:
+        font: str = 'tests/Spirax-Regular.ttf'
+        res = optimise_fonts("Hi", font, fontpath=self._test_output_dir, print_stats=False)
+        outfile: str = res["fonts"][font]
+        generated: TTFont = TTFont(outfile)
+        generated['cmap'].tables = []
+        generated.save(outfile)
+        res = optimise_fonts("Hi", font, fontpath=self._test_output_dir, print_stats=False, check=True)
+        self.assertEqual(res["plan"][outfile]["status"], "stale")
+        self.assertEqual(res["plan"][outfile]["added"], [" ", "H", "i"])
+        self.assertEqual(res["warnings"], []) # Read as having no characters, rather than as unreadable
+
+    def test_files_check_writes_nothing(self) -> None:
+        events: list[dict] = []
+        res = optimise_fonts_for_files(['tests/test1-index-css.html'], font_output_dir=self._test_output_dir,
+                                       print_stats=False, check=True, progress=events.append)
+        self.assertEqual(os.listdir(self._test_output_dir), [])
+        self.assertEqual(res["rewritten_css"], {})
+        self.assertEqual(set(res["plan"]), set(res["fonts"].values()))
+        self.assertEqual(len([e for e in events if e["event"] == "font_checked"]), len(res["plan"]))
+
+
+class TestShardedBuild(unittest.TestCase):
+
+    def test_merged_shards_match_single_run(self) -> None:
+        pages: list[str] = ['tests/test1-index-css.html', 'tests/test2.html']
+        shard_files: list[str] = []
+        for index, page in enumerate(pages):
+            shard_file: str = os.path.join(self._test_output_dir, f'shard{index}.json')
+            save_summary(collect_summary([page]), shard_file)
+            shard_files.append(shard_file)
+        merged = merge_summaries(load_summary(f) for f in shard_files)
+        self.assertEqual(merged["html_css"].keys(), set(pages))
+
+        sharded_dir: str = os.path.join(self._test_output_dir, 'sharded')
+        single_dir: str = os.path.join(self._test_output_dir, 'single')
+        sharded = optimise_fonts_for_summary(merged, font_output_dir=sharded_dir, print_stats=False)
+        single = optimise_fonts_for_files(pages, font_output_dir=single_dir, print_stats=False)
+        self.assertEqual(sharded["chars"], single["chars"])
+        self.assertEqual(sharded["fonts"].keys(), single["fonts"].keys())
+        self.assertEqual(sharded["rewritten_css"].keys(), single["rewritten_css"].keys())
+        for font in single["fonts"]:
+            self.assertEqual(TTFont(sharded["fonts"][font]).getBestCmap(), TTFont(single["fonts"][font]).getBestCmap())
+
+    def test_merge_unions_characters_and_fonts(self) -> None:
+        a = collect_summary(iter([]), fonts='tests/Spirax-Regular.ttf', addtl_text="abc")
+        b = collect_summary(iter([]), fonts='tests/Whisper-Regular.ttf', addtl_text="cde")
+        merged = merge_summaries([a, b])
+        self.assertEqual(merged["chars"], set("abcde"))
+        self.assertEqual(merged["fonts"], ['tests/Spirax-Regular.ttf', 'tests/Whisper-Regular.ttf'])
+
+    def test_load_rejects_other_json(self) -> None:
+        other: str = os.path.join(self._test_output_dir, 'other.json')
+        with open(other, 'w') as f:
+            f.write('{"jobs": []}')
+        with self.assertRaises(ValueError):
+            load_summary(other)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_phases_recorded_with_memory(self) -> None:
+        res = optimise_fonts_for_files(['tests/test2.html'], font_output_dir=self._test_output_dir, fonts='tests/Whisper-Regular.ttf',
+                                       print_stats=False, profile_memory=True)
+        self.assertIn("extraction", res["profile"])
+        self.assertIn("css", res["profile"])
+        self.assertIn("rewrite", res["profile"])
+        phase = res["profile"]["subset tests/Whisper-Regular.ttf"]
+        self.assertGreater(phase["seconds"], 0)
+        self.assertGreater(phase["peak_memory"], 0)
+        self.assertLessEqual(len(phase["top_allocations"]), 10)
+
+    def test_cpu_profile_written(self) -> None:
+        import pstats
+        stats_file: str = os.path.join(self._test_output_dir, 'cpu.prof')
+        res = optimise_fonts("Hello", 'tests/Spirax-Regular.ttf', fontpath=self._test_output_dir, print_stats=False, profile_cpu=stats_file)
+        self.assertEqual(res["profile"]["subset tests/Spirax-Regular.ttf"]["peak_memory"], 0)
+        self.assertGreater(pstats.Stats(stats_file).total_calls, 0)
+
+    def test_trace_spans(self) -> None:
+        import json
+        trace_file: str = os.path.join(self._test_output_dir, 'trace.json')
+        res = optimise_fonts_for_files(['tests/test2.html'], font_output_dir=self._test_output_dir, print_stats=False, trace=trace_file)
+        self.assertEqual(res["profile"], {}) # Tracing alone doesn't profile
+        with open(trace_file) as f:
+            events = json.load(f)["traceEvents"]
+        spans = [e for e in events if e["ph"] == "X"]
+        names = {e["name"] for e in spans}
+        for name in ["optimise_fonts_for_files", "read", "extract html", "parse css", "load font", "subset", "save woff2", "rewrite css"]:
+            self.assertIn(name, names)
+        self.assertTrue(all(e["dur"] >= 0 for e in spans))
+
+    def test_trace_parallel_workers(self) -> None:
+        import json
+        trace_file: str = os.path.join(self._test_output_dir, 'trace.json')
+        optimise_fonts("Hello", ['tests/Spirax-Regular.ttf', 'tests/Whisper-Regular.ttf'], fontpath=self._test_output_dir,
+                       print_stats=False, workers=2, trace=trace_file)
+        with open(trace_file) as f:
+            events = json.load(f)["traceEvents"]
+        subset_pids = {e["pid"] for e in events if e["name"] == "subset"}
+        self.assertEqual(len([e for e in events if e["name"] == "subset"]), 2)
+        self.assertNotIn(os.getpid(), subset_pids) # Recorded in the worker processes
+        self.assertIn("fontimize worker", [e["args"]["name"] for e in events if e["ph"] == "M"])
+
+    def test_no_profile_by_default(self) -> None:
+        res = optimise_fonts("Hello", 'tests/Spirax-Regular.ttf', fontpath=self._test_output_dir, print_stats=False)
+        self.assertEqual(res["profile"], {})
+
+
+class TestQuantization(unittest.TestCase):
+
+    def test_rounds_up_to_blocks(self) -> None:
+        quantized: set[str] = quantize_characters({'a', 'é'})
+        self.assertTrue({chr(cp) for cp in range(0x20, 0x7F)} <= quantized)
+        self.assertTrue({chr(cp) for cp in range(0xA0, 0x100)} <= quantized)
+        self.assertNotIn('Ж', quantized) # Cyrillic isn't used
+
+    def test_named_and_range_blocks(self) -> None:
+        self.assertEqual(quantize_characters({'a', 'é'}, ['Latin-1 Supplement']), {'a'} | {chr(cp) for cp in range(0xA0, 0x100)})
+        self.assertEqual(quantize_characters({'Ж'}, 'U+0410-042F'), {chr(cp) for cp in range(0x410, 0x430)})
+        self.assertEqual(quantize_characters({'漢'}), {'漢'}) # Not in any block, so kept as is
+        with self.assertRaises(ValueError):
+            quantize_characters({'a'}, ['Klingon'])
+
+    def test_subset_is_stable_within_a_block(self) -> None:
+        font: str = 'tests/Spirax-Regular.ttf'
+        res = optimise_fonts("Hello", font, fontpath=self._test_output_dir, print_stats=False, quantize=['Basic Latin'])
+        first: TTFont = TTFont(res["fonts"][font])
+        first_glyphs, first_cmap = first.getGlyphOrder(), first.getBestCmap()
+        self.assertNotIn('Z', res["chars"]) # The characters found, not the quantized ones
+        self.assertGreater(res["stats"]["quantized_chars"], 80)
+        self.assertEqual(res["stats"]["files"][0]["quantized_glyphs"], res["stats"]["quantized_glyphs"])
+        self.assertGreater(res["stats"]["quantized_glyphs"], 0)
+
+        res = optimise_fonts("Hello, world!", font, fontpath=self._test_output_dir, print_stats=False, quantize=['Basic Latin'])
+        second: TTFont = TTFont(res["fonts"][font])
+        self.assertEqual(second.getGlyphOrder(), first_glyphs)
+        self.assertEqual(second.getBestCmap(), first_cmap)
+
+    def test_off_by_default(self) -> None:
+        res = optimise_fonts("Hello", 'tests/Spirax-Regular.ttf', fontpath=self._test_output_dir, print_stats=False)
+        self.assertEqual(res["stats"]["quantized_chars"], 0)
+        self.assertEqual(res["stats"]["quantized_glyphs"], 0)
+
+
+class TestCoverageIndex(unittest.TestCase):
+
+    def test_uncovered_characters_reported(self) -> None:
+        res = optimise_fonts("Hello Жизнь", 'tests/Spirax-Regular.ttf', fontpath=self._test_output_dir, print_stats=False)
+        self.assertEqual(res["uncovered"], {'tests/Spirax-Regular.ttf': set("Жизнь")})
+        self.assertEqual(res["stats"]["files"][0]["uncovered_chars"], 5)
+        self.assertIn('Ж', res["chars"]) # Still reported as used
+
+    def test_cmap_not_read_separately_without_index(self) -> None:
+        """Without a coverage index, the cmap is taken from the font loaded for subsetting, not read separately."""
+        font: str = 'tests/Spirax-Regular.ttf'
+        for workers in (1, 2):
+            with patch('fontimize._read_codepoints') as read_codepoints:
+                res = optimise_fonts("Hello Жизнь", [font, 'tests/Whisper-Regular.ttf'], fontpath=self._test_output_dir,
+                                     print_stats=False, workers=workers)
+            read_codepoints.assert_not_called()
+            self.assertEqual(res["uncovered"][font], set("Жизнь"))
+            self.assertEqual(res["stats"]["files"][0]["uncovered_chars"] + res["stats"]["files"][1]["uncovered_chars"],
+                             sum(len(chars) for chars in res["uncovered"].values()))
+
+    def test_missing_query(self) -> None:
+        index = FontimizeCoverageIndex()
+        self.assertEqual(index.missing('tests/Spirax-Regular.ttf', "Hi Ж\n"), {'Ж'}) # Control characters don't need glyphs
+        self.assertIn(ord('H'), index.codepoints('tests/Spirax-Regular.ttf'))
+        self.assertEqual((index.hits, index.misses), (1, 1))
+
+    def test_font_without_unicode_cmap(self) -> None:
+        font: str = os.path.join(self._test_output_dir, 'NoCmap.ttf')
+        tt_font: TTFont = TTFont('tests/Spirax-Regular.ttf')
+        tt_font['cmap'].tables = []
+        tt_font.save(font)
+        self.assertEqual(FontimizeCoverageIndex().codepoints(font), frozenset())
+        res = optimise_fonts("Hi", font, fontpath=self._test_output_dir, print_stats=False)
+        self.assertEqual(res["uncovered"], {font: set("Hi ")})
+        with open(font, 'rb') as f:
+            res = optimise_fonts_in_memory("Hi", {'NoCmap': f.read()}, print_stats=False)
+        self.assertEqual(res["uncovered"], {'NoCmap': set("Hi ")})
+
+    def test_persisted_across_runs(self) -> None:
+        index_file: str = os.path.join(self._test_output_dir, 'coverage.json')
+        optimise_fonts("Hello", 'tests/Spirax-Regular.ttf', fontpath=self._test_output_dir, print_stats=False,
+                       coverage_index=FontimizeCoverageIndex(index_file))
+        self.assertTrue(os.path.isfile(index_file))
+
+        index = FontimizeCoverageIndex(index_file)
+        with patch('fontTools.ttLib.TTFont') as tt_font:
+            self.assertIn(ord('H'), index.codepoints('tests/Spirax-Regular.ttf'))
+            # A copy of the font is recognised by its hash, so its cmap isn't read either
+            copy: str = os.path.join(self._test_output_dir, 'copy.ttf')
+            with open('tests/Spirax-Regular.ttf', 'rb') as src, open(copy, 'wb') as dst:
+                dst.write(src.read())
+            self.assertEqual(index.codepoints(copy), index.codepoints('tests/Spirax-Regular.ttf'))
+            tt_font.assert_not_called()
+
+    def test_unreadable_index_ignored(self) -> None:
+        index_file: str = os.path.join(self._test_output_dir, 'coverage.json')
+        with open(index_file, 'w') as f:
+            f.write("not json")
+        with self.assertWarns(UserWarning):
+            index = FontimizeCoverageIndex(index_file)
+        self.assertIn(ord('H'), index.codepoints('tests/Spirax-Regular.ttf'))
+
+
+class TestFontSubsets(unittest.TestCase):
+
+    def test_subsets_match_separate_runs(self) -> None:
+        font: str = 'tests/EBGaramond-VariableFont_wght.ttf'
+        subsets: dict[str, str] = {"Main": "The quick brown fox", "Critical": "Hello", "Digits": set("0123456789")}
+        with patch('fontTools.ttLib.TTFont', wraps=TTFont) as tt_font:
+            results = optimise_font_subsets(font, subsets, fontpath=self._test_output_dir, print_stats=False)
+        full_parses: list = [c for c in tt_font.call_args_list if c.args and c.args[0] == font and not c.kwargs.get('lazy')]
+        self.assertEqual(len(full_parses), 1)
+
+        self.assertEqual(set(results), set(subsets))
+        for name, text in subsets.items():
+            outfile: str = results[name]["fonts"][font]
+            self.assertEqual(outfile, os.path.join(self._test_output_dir, f'EBGaramond-VariableFont_wght.{name}.woff2'))
+            self.assertEqual(results[name]["stats"]["files"][0]["generated_size"], os.path.getsize(outfile))
+            separate = optimise_fonts("".join(text), font, fontpath=self._test_output_dir, subsetname=f"{name}Separate", print_stats=False)
+            derived: TTFont = TTFont(outfile)
+            expected: TTFont = TTFont(separate["fonts"][font])
+            self.assertEqual(derived.getBestCmap(), expected.getBestCmap())
+            self.assertEqual(derived.getGlyphOrder(), expected.getGlyphOrder())
+
+    def test_single_subset_and_font_writer(self) -> None:
+        written: dict[str, bytes] = {}
+        def store(name: str, data: bytes) -> None:
+            written[name] = data
+        results = optimise_font_subsets('tests/Spirax-Regular.ttf', {"Only": "Hi Ж"}, print_stats=False, font_writer=store)
+        self.assertEqual(list(written), ['tests/Spirax-Regular.Only.woff2'])
+        self.assertEqual(results["Only"]["uncovered"], {'tests/Spirax-Regular.ttf': {'Ж'}})
+
+    def test_no_subsets(self) -> None:
+        """With no subsets, nothing is generated and the font isn't opened."""
+        self.assertEqual(optimise_font_subsets('tests/DOESNOTEXIST.ttf', {}, print_stats=False), {})
+
+
+class TestConcurrentCalls(unittest.TestCase):
+
+    def test_warnings_go_to_their_own_call(self) -> None:
+        import warnings
+        from concurrent.futures import ThreadPoolExecutor
+        def run(name: str) -> dict:
+            outdir: str = os.path.join(self._test_output_dir, name)
+            os.makedirs(outdir)
+            with open(os.path.join(outdir, 'Spirax-Regular.FontimizeSubset.woff2'), 'wb'):
+                pass # Already exists, so each call warns about its own output
+            return optimise_fonts("Hello", 'tests/Spirax-Regular.ttf', fontpath=outdir, print_stats=False)
+        names: list[str] = [f"call{i}" for i in range(6)]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                results = list(executor.map(run, names))
+        for name, res in zip(names, results):
+            self.assertEqual(len(res["warnings"]), 1)
+            self.assertIn(os.path.join(self._test_output_dir, name, ''), res["warnings"][0])
+
+    def test_nested_calls_report_all_warnings(self) -> None:
+        import warnings
+        page: str = os.path.join(self._test_output_dir, 'page.html')
+        with open(page, 'w') as f:
+            f.write('<html><head><link rel="stylesheet" href="https://example.com/site.css"></head><body>Hello</body></html>')
+        with open(os.path.join(self._test_output_dir, 'Spirax-Regular.FontimizeSubset.woff2'), 'wb'):
+            pass
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            res = optimise_fonts_for_files([page], font_output_dir=self._test_output_dir, print_stats=False,
+                                           fonts=['tests/Spirax-Regular.ttf'])
+        # One from optimise_fonts_for_files itself, and one from the optimise_fonts call it makes
+        self.assertEqual(len(res["warnings"]), 2)
+        self.assertIn('Stylesheet is remote', res["warnings"][0])
+        self.assertIn('already exists', res["warnings"][1])
+
+    def test_stylesheets_parsed_in_threads(self) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        css: str = "a { color: rgb(10, 20, 30); } @font-face { font-family: X; src: url('x.ttf') format('truetype'); } " * 20
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: _find_font_face_urls(css), range(64)))
+        self.assertEqual(results, [['x.ttf'] * 20] * 64)
+
+    def test_output_is_logged(self) -> None:
+        with self.assertLogs('fontimize', 'INFO') as logs:
+            optimise_fonts("Hello", 'tests/Spirax-Regular.ttf', fontpath=self._test_output_dir, print_stats=True)
+        self.assertTrue(any('Savings' in line for line in logs.output))
+
+
+class TestLayoutPruning(unittest.TestCase):
+    _font: str = 'tests/EBGaramond-VariableFont_wght.ttf'
+
+    @staticmethod
+    def _ligatures(font: TTFont) -> set[tuple[str, ...]]:
+        found: set[tuple[str, ...]] = set()
+        for lookup in font['GSUB'].table.LookupList.Lookup:
+            for subtable in lookup.SubTable:
+                subtable = getattr(subtable, 'ExtSubTable', subtable)
+                if subtable.LookupType == 4:
+                    found.update((first, *lig.Component) for first, ligs in subtable.ligatures.items() for lig in ligs)
+        return found
+
+    @staticmethod
+    def _kerning(font: TTFont, left: str, right: str) -> list[int]:
+        cmap = font.getBestCmap()
+        first, second = cmap[ord(left)], cmap[ord(right)]
+        found: list[int] = []
+        for lookup in font['GPOS'].table.LookupList.Lookup:
+            for subtable in lookup.SubTable:
+                subtable = getattr(subtable, 'ExtSubTable', subtable)
+                if subtable.LookupType != 2 or first not in subtable.Coverage.glyphs:
+                    continue
+                if subtable.Format == 1:
+                    records = subtable.PairSet[subtable.Coverage.glyphs.index(first)].PairValueRecord
+                    found.extend(r.Value1.XAdvance for r in records if r.SecondGlyph == second)
+                else:
+                    record = subtable.Class1Record[subtable.ClassDef1.classDefs.get(first, 0)]
+                    found.append(record.Class2Record[subtable.ClassDef2.classDefs.get(second, 0)].Value1.XAdvance)
+        return [k for k in found if k]
+
+    def test_text_pairs(self) -> None:
+        pairs: set[str] = _text_pairs("Tom e\u0301t")
+        self.assertTrue({'To', 'om', 'TO', 'to', 'OM'} <= pairs)
+        self.assertIn('et', pairs) # The combining acute accent is skipped
+        self.assertNotIn('Tm', pairs)
+
+    def test_kerning_kept_for_pairs_used(self) -> None:
+        text: str = "To Avery, Watson wrote: Very well."
+        full = optimise_fonts(text, self._font, fontpath=self._test_output_dir, subsetname="Full", print_stats=False)
+        pruned = optimise_fonts(text, self._font, fontpath=self._test_output_dir, subsetname="Pruned", print_stats=False, prune_layout=True)
+        full_font: TTFont = TTFont(full["fonts"][self._font])
+        pruned_font: TTFont = TTFont(pruned["fonts"][self._font])
+        for left, right in zip(text, text[1:]):
+            self.assertEqual(self._kerning(pruned_font, left, right), self._kerning(full_font, left, right))
+        self.assertNotEqual(self._kerning(full_font, 'A', 'W'), []) # Not in the text, so pruned
+        self.assertEqual(self._kerning(pruned_font, 'A', 'W'), [])
+        breakdown = pruned["stats"]["files"][0]["breakdown"]
+        self.assertGreater(breakdown["pruned_kerning"], 0)
+        self.assertLess(breakdown["table_sizes"]["GPOS"], full["stats"]["files"][0]["breakdown"]["table_sizes"]["GPOS"])
+        self.assertEqual(full["stats"]["files"][0]["breakdown"]["pruned_kerning"], 0) # Off by default
+
+    def test_unused_ligatures_removed(self) -> None:
+        res = optimise_fonts("if of fit", self._font, fontpath=self._test_output_dir, print_stats=False, prune_layout=True)
+        ligatures = self._ligatures(TTFont(res["fonts"][self._font]))
+        self.assertIn(('f', 'i'), ligatures)
+
+        res = optimise_fonts("if of", self._font, fontpath=self._test_output_dir, print_stats=False, prune_layout=True)
+        self.assertNotIn(('f', 'i'), self._ligatures(TTFont(res["fonts"][self._font])))
+        self.assertGreater(res["stats"]["files"][0]["breakdown"]["pruned_ligatures"], 0)
+
+    def test_pairs_from_each_text(self) -> None:
+        # The characters of all the texts together include f and i, but no text has them next to each other
+        res = optimise_fonts_for_multiple_text(["if", "of"], self._font, fontpath=self._test_output_dir, print_stats=False, prune_layout=True)
+        self.assertNotIn(('f', 'i'), self._ligatures(TTFont(res["fonts"][self._font])))
+        res = optimise_fonts_for_multiple_text(["if", "of"], self._font, fontpath=self._test_output_dir, print_stats=False, prune_layout=["fi"])
+        self.assertIn(('f', 'i'), self._ligatures(TTFont(res["fonts"][self._font])))
+
+
+class TestLayoutFeatures(unittest.TestCase):
+    _font: str = os.path.abspath('tests/EBGaramond-VariableFont_wght.ttf')
+
+    @staticmethod
+    def _features(font_file: str) -> set[str]:
+        font: TTFont = TTFont(font_file)
+        return {record.FeatureTag for record in font['GSUB'].table.FeatureList.FeatureRecord} if 'GSUB' in font else set()
+
+    def _page(self, css: str, body: str = "Office 1/2 1234") -> str:
+        with open(os.path.join(self._test_output_dir, 'style.css'), 'w') as f:
+            f.write(f'@font-face {{ font-family: "Garamond"; src: url("{self._font}"); }}\n{css}')
+        page: str = os.path.join(self._test_output_dir, 'index.html')
+        with open(page, 'w') as f:
+            f.write(f'<html><head><link rel="stylesheet" href="style.css"></head><body>{body}</body></html>')
+        return page
+
+    def test_find_font_features(self) -> None:
+        self.assertEqual(_find_font_features('h1 { font-feature-settings: "onum", \'ss02\' 1, "liga" off, "dlig" 0; }'), {'onum', 'ss02'})
+        self.assertEqual(_find_font_features('p { font-variant-numeric: oldstyle-nums tabular-nums }'), {'onum', 'tnum'})
+        self.assertEqual(_find_font_features('p { font-variant: all-small-caps; }'), {'smcp', 'c2sc'})
+        self.assertEqual(_find_font_features('p { font: small-caps 12px serif; }'), {'smcp'})
+        self.assertEqual(_find_font_features('/* p { font-variant-caps: small-caps } */ p { font-variant-caps: normal }'), set())
+
+    def test_default_features_unchanged(self) -> None:
+        """Without layout_features, the files and text entry points both keep fontTools' default features."""
+        res = optimise_fonts_for_files([self._page("")], font_output_dir=self._test_output_dir, print_stats=False)
+        self.assertIn('frac', self._features(res["fonts"][self._font]))
+        res = optimise_fonts("Office 1/2", self._font, fontpath=self._test_output_dir, print_stats=False)
+        self.assertIn('frac', self._features(res["fonts"][self._font]))
+
+    def test_only_features_css_uses(self) -> None:
+        res = optimise_fonts_for_files([self._page("")], font_output_dir=self._test_output_dir, print_stats=False, layout_features=True)
+        features: set[str] = self._features(res["fonts"][self._font])
+        self.assertIn('liga', features)
+        self.assertNotIn('onum', features) # Old-style figures aren't turned on
+        self.assertNotIn('frac', features) # Nor fractions, which fontTools keeps by default
+
+        page: str = self._page("p { font-variant-numeric: oldstyle-nums diagonal-fractions; }")
+        res = optimise_fonts_for_files([page], font_output_dir=self._test_output_dir, print_stats=False, layout_features=True)
+        self.assertTrue({'liga', 'onum', 'frac'} <= self._features(res["fonts"][self._font]))
+
+        res = optimise_fonts("Office 1/2", self._font, fontpath=self._test_output_dir, print_stats=False, layout_features=True)
+        self.assertEqual(self._features(res["fonts"][self._font]) & {'onum', 'frac'}, set())
+
+    def test_features_in_page(self) -> None:
+        page: str = self._page("", body='<style>p { font-variant-caps: small-caps }</style><p style="font-feature-settings: \'onum\'">Office 1234</p>')
+        res = optimise_fonts_for_files([page], font_output_dir=self._test_output_dir, print_stats=False, layout_features=True)
+        self.assertTrue({'smcp', 'onum'} <= self._features(res["fonts"][self._font]))
+
+    def test_manual_override(self) -> None:
+        page: str = self._page("p { font-variant-numeric: oldstyle-nums; }")
+        res = optimise_fonts_for_files([page], font_output_dir=self._test_output_dir, print_stats=False, layout_features=['kern'])
+        self.assertEqual(self._features(res["fonts"][self._font]), set())
+        res = optimise_fonts("Office", self._font, fontpath=self._test_output_dir, print_stats=False, layout_features=['*'])
+        self.assertIn('smcp', self._features(res["fonts"][self._font]))
+
+    def test_summary_keeps_features(self) -> None:
+        summary_file: str = os.path.join(self._test_output_dir, 'summary.json')
+        save_summary(collect_summary([self._page("p { font-variant-numeric: oldstyle-nums; }")]), summary_file)
+        summary = load_summary(summary_file)
+        self.assertEqual(summary["features"], {'onum'})
+        res = optimise_fonts_for_summary(summary, font_output_dir=self._test_output_dir, print_stats=False, layout_features=True)
+        self.assertIn('onum', self._features(res["fonts"][self._font]))
+
+
+class TestRenderedText(unittest.TestCase):
+    _font: str = os.path.abspath('tests/Spirax-Regular.ttf')
+    _html: str = ('<html><head><title>Qq</title><script>var z = "Zz";</script></head><body><noscript>Jj</noscript>'
+                  '<p>Hi <img src="a.png" alt="Xx"> <input type="submit" value="Go"> <input placeholder="Kk"></p></body></html>')
+
+    def test_default_unchanged(self) -> None:
+        chars: set[str] = get_used_characters_in_html(self._html)
+        self.assertTrue(set('QqJjHi') <= chars)
+        self.assertFalse(set('ZzXxGoKk') & chars)
+
+    def test_rendered_only(self) -> None:
+        chars: set[str] = get_used_characters_in_html(self._html, rendered_only=True)
+        self.assertEqual(chars, set('HiGo '))
+
+    def test_text_attributes(self) -> None:
+        self.assertEqual(get_used_characters_in_html(self._html, rendered_only=True, text_attributes=True), set('HiGoXxKk '))
+        self.assertEqual(get_used_characters_in_html(self._html, rendered_only=True, text_attributes=['alt']), set('HiGoXx '))
+
+    def test_files_find_noscript_stylesheet(self) -> None:
+        with open(os.path.join(self._test_output_dir, 'style.css'), 'w') as f:
+            f.write(f'@font-face {{ font-family: "Spirax"; src: url("{self._font}"); }}')
+        page: str = os.path.join(self._test_output_dir, 'index.html')
+        with open(page, 'w') as f:
+            f.write('<html><head><noscript><link rel="stylesheet" href="style.css"></noscript></head><body><noscript>Jj</noscript>Hi</body></html>')
+        res = optimise_fonts_for_files([page], font_output_dir=self._test_output_dir, print_stats=False, rendered_only=True, text_attributes=True)
+        self.assertIn(self._font, res["fonts"])
+        self.assertEqual(res["chars"], set('Hi '))
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_import_does_not_load_dependencies(self) -> None:
+        """Importing fontimize should be fast: heavy dependencies are only imported when they're used."""
+        code: str = ("import sys, fontimize; print(' '.join(m for m in ['bs4', 'fontTools', 'cssutils', "
+                     "'pathvalidate', 'beartype', 'http.client'] if m in sys.modules))")
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stdout.strip(), "")
+
+    def test_production_mode_skips_hot_path_checks(self) -> None:
+        """FONTIMIZE_PRODUCTION=1 removes type checks from per-character helpers, but not from the public API."""
+        code: str = ("import fontimize\n"
+                     "fontimize._get_unicode_string('a', withU=1) # Wrong type, but only checked outside production mode\n"
+                     "try:\n    fontimize.optimise_fonts(42, [])\nexcept Exception as e:\n    print(type(e).__name__)")
+        env: dict[str, str] = dict(os.environ, FONTIMIZE_PRODUCTION='1')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('BeartypeCallHintParamViolation', result.stdout)
+
+
 class TestBeartypeValidation(unittest.TestCase):
     """Test that beartype catches invalid argument types at runtime."""
 
@@ -840,6 +2156,64 @@ class TestCLI(unittest.TestCase):
                          f"stdout: {result.stdout}\nstderr: {result.stderr}")
         return result
 
+    def test_batch(self) -> None:
+        """batch should run each job in the job file and report them as JSON."""
+        import json
+        job_file: str = os.path.join(self._test_output_dir, 'jobs.json')
+        with open(job_file, 'w') as f:
+            json.dump({"defaults": {"font_output_dir": self._test_output_dir},
+                       "jobs": [{"name": "html", "files": ["tests/test1-index-css.html"]},
+                                {"name": "text", "files": ["tests/test.txt"], "fonts": ["tests/Whisper-Regular.ttf"], "subsetname": "Text"}]}, f)
+        result = self._run('batch', '--json', job_file)
+        data = json.loads(result.stdout)
+        self.assertEqual(sorted(data['results']), ['html', 'text'])
+        self.assertEqual(data['failed'], {})
+        # Warnings are only in the results of the jobs that raised them; test1-index-css.html's CSS references a missing font
+        self.assertNotIn('warnings', data)
+        self.assertTrue(any('not found' in w for w in data['results']['html']['warnings']))
+        self.assertEqual(data['results']['text']['warnings'], [])
+        self.assertFalse(os.path.exists(job_file + '.checkpoint'))
+
+    def test_json_stream(self) -> None:
+        """--json-stream should print one JSON event per line, ending with the result."""
+        import json
+        result = self._run('tests/test1-index-css.html', '-o', self._test_output_dir, '--json-stream')
+        events = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(events[0], {"event": "files_discovered", "count": 1})
+        # test1-index-css.html's CSS references a missing font; the warnings come from the result, just before it
+        self.assertEqual(events[-1]["event"], "result")
+        warning_events = [e for e in events if e["event"] == "warning"]
+        self.assertTrue(warning_events)
+        self.assertEqual([e["message"] for e in warning_events], events[-1]["warnings"])
+        self.assertEqual(events[-1 - len(warning_events):-1], warning_events)
+        self.assertEqual(len([e for e in events if e["event"] == "font_finished"]), len(events[-1]["fonts"]))
+
+    def test_check_exit_status(self) -> None:
+        """--check should exit with status 1 until the subsets have been generated."""
+        args: list[str] = ['--text', 'Hello', '--fonts', 'tests/Spirax-Regular.ttf', '-o', self._test_output_dir]
+        result = self._run(*args, '--check', expect_returncode=1)
+        self.assertIn('Missing:', result.stdout)
+        self._run(*args)
+        result = self._run(*args, '--plan')
+        self.assertIn('0 of 1 subset fonts would change', result.stdout)
+
+    def test_collect_merge_subset(self) -> None:
+        """collect, merge and subset should together generate the fonts for every shard's pages."""
+        shards: list[str] = []
+        for index, page in enumerate(['tests/test1-index-css.html', 'tests/test.txt']):
+            shards.append(os.path.join(self._test_output_dir, f'shard{index}.json'))
+            self._run('collect', page, '-o', shards[-1], '-f', 'tests/Whisper-Regular.ttf')
+        merged: str = os.path.join(self._test_output_dir, 'merged.json')
+        self._run('merge', '-o', merged, *shards)
+        self._run('subset', '-n', '-o', self._test_output_dir, merged)
+        self.assertTrue(os.path.exists(os.path.join(self._test_output_dir, 'Whisper-Regular.FontimizeSubset.woff2')))
+        self._run('subset', '--check', '-o', self._test_output_dir, merged)
+
+    def test_invalid_max_memory(self) -> None:
+        """--max-memory should reject values that aren't a size."""
+        result = self._run('tests/test1-index-css.html', '--workers', '2', '--max-memory', 'lots', expect_returncode=2)
+        self.assertIn('not a memory size', result.stderr)
+
     def test_no_args_exits_with_error(self) -> None:
         """Running with no arguments should exit with code 1."""
         result = self._run(expect_returncode=1)
@@ -965,6 +2339,19 @@ class TestCLI(unittest.TestCase):
         result = self._run('tests/test1-index-css.html', '-o', self._test_output_dir, '-n')
         self.assertIn('DOESNOTEXIST.ttf', result.stderr)
 
+    def test_preload_requires_outputdir(self) -> None:
+        result = self._run('tests/test1-index-css.html', '--preload', expect_returncode=1)
+        self.assertIn('--outputdir', result.stdout)
+
+    def test_directory_input_with_exclude(self) -> None:
+        """A directory is searched for HTML files; --exclude skips the test output folder."""
+        import json
+        result = self._run('tests', '--exclude', 'output', '-f', 'tests/Whisper-Regular.ttf',
+                           '-o', self._test_output_dir, '--json')
+        data = json.loads(result.stdout)
+        self.assertIn('tests/css_test.css', data['css'])
+        self.assertIn('tests/css_test-index.css', data['css'])
+
     def test_exit_code_zero_on_success(self) -> None:
         """Successful run should exit with code 0."""
         self._run('tests/test1-index-css.html', '-o', self._test_output_dir, '-n')